@@ -2,80 +2,295 @@ import http.server
 import socketserver
 import json
 import os
-import hashlib
-import io
 import re
+import time
+import cProfile
+import argparse
+import threading
+import urllib.parse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import chunkcache
+import chunkgc
+import chunkstore
+import ingest
+import journal
+import metastore
+import metrics
+import multipart
+import snapshot
+import storeconfig
+import uploads
 
 # Configuration
 PORT = 8000
 STORAGE_DIR = "storage"
-METADATA_FILE = "metadata.json"
-CHUNK_SIZE = 4096
+METADATA_DB = "metadata.db"
+WORKERS = 8  # Requests served concurrently
+PROFILE_HEADER = "X-Profile"  # Requests carrying this header are profiled when enabled
+
+ENDPOINTS = ("/api/stats", "/api/files", "/api/events", "/api/upload", "/api/uploads",
+             "/api/uploads/", "/api/config", "/api/download/", "/api/versions/", "/metrics")
+# Store settings a client needs to chunk files the way the server does
+CLIENT_SETTINGS = ("chunker", "chunk_size", "min_size", "avg_size", "max_size", "fingerprint")
+
+_chunk_store = None
+_metastore = None
+_upload_manager = None
+_committer = None
+_open_lock = threading.Lock()
+chunk_cache = chunkcache.ChunkCache()
+collector = None
+event_stream = None  # Started by run_server
+profile_dir = None  # Set by --profile-dir to allow per-request profiling
+
+def get_chunk_store():
+    """Return the process-wide chunk store, opening it on first use."""
+    global _chunk_store
+    with _open_lock:
+        if _chunk_store is None:
+            _chunk_store = chunkstore.open_chunk_store(storeconfig.load_store_config(), STORAGE_DIR)
+    return _chunk_store
+
+def get_metastore():
+    """Return the process-wide metadata database, opening it on first use."""
+    global _metastore
+    store = get_chunk_store()
+    with _open_lock:
+        if _metastore is None:
+            _metastore = metastore.open_metastore(store, METADATA_DB)
+    return _metastore
+
+def get_committer():
+    """Return the process-wide group committer that records uploaded files."""
+    global _committer
+    store = get_chunk_store()
+    meta = get_metastore()
+    with _open_lock:
+        if _committer is None:
+            _committer = journal.GroupCommitter(meta, store, file_recorded)
+    return _committer
+
+def file_recorded(name, version):
+    """Called by the group committer for every new file version."""
+    stats_snapshot.invalidate({"op": "add", "name": name, "version": version})
+
+def get_upload_manager():
+    """Return the process-wide registry of negotiated uploads."""
+    global _upload_manager
+    store = get_chunk_store()
+    meta = get_metastore()
+    committer = get_committer()
+    with _open_lock:
+        if _upload_manager is None:
+            _upload_manager = uploads.UploadManager(meta, store, committer)
+    return _upload_manager
 
 def ensure_directories():
     if not os.path.exists(STORAGE_DIR):
         os.makedirs(STORAGE_DIR)
 
-def get_file_hash(data):
-    return hashlib.sha256(data).hexdigest()
+def dedup_file(filename, stream):
+    """Ingest an upload. Returns (success, message, version).
 
-def load_metadata():
-    if os.path.exists(METADATA_FILE):
-        try:
-            with open(METADATA_FILE, 'r') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
-            return {}
-    return {}
+    A file whose name is taken becomes its new version, and version is
+    None if the content is unchanged. Concurrent uploads share the store
+    flush and metadata commit through the group committer.
+    """
+    committer = get_committer()
+    ensure_directories()
+    chunks, new_chunks, new_bytes, new_raw_bytes, digest = ingest.ingest_stream(
+        stream, storeconfig.load_store_config(), get_chunk_store(), flush=False)
+    try:
+        version = committer.add_file(filename, chunks, new_chunks, new_bytes, new_raw_bytes,
+                                     digest)
+    except metastore.MissingChunkError as e:
+        # Count the chunks this ingest wrote and leave them to the garbage collector
+        get_metastore().add_chunks(chunks, new_chunks, new_bytes, new_raw_bytes,
+                                   get_chunk_store())
+        return False, str(e), None
+    if version is None:
+        return True, "File is unchanged", None
+    return True, "Success", version
 
-def save_metadata(metadata):
-    with open(METADATA_FILE, 'w') as f:
-        json.dump(metadata, f, indent=4)
+def parse_file_path(path, prefix):
+    """Return (file name, version or None) for a prefix + name[?version=N] path.
 
-def dedup_file(filename, file_data):
-    metadata = load_metadata()
-    if filename in metadata:
-        return False, "File already exists"
+    Raises ValueError if the version is not a number.
+    """
+    name, _, query = path[len(prefix):].partition('?')
+    version = urllib.parse.parse_qs(query).get('version')
+    return urllib.parse.unquote(name), int(version[0]) if version else None
 
-    ensure_directories()
-    chunk_hashes = []
-    
-    stream = io.BytesIO(file_data)
-    while True:
-        chunk = stream.read(CHUNK_SIZE)
-        if not chunk:
-            break
-        
-        chunk_hash = get_file_hash(chunk)
-        chunk_hashes.append(chunk_hash)
-        
-        chunk_path = os.path.join(STORAGE_DIR, chunk_hash)
-        if not os.path.exists(chunk_path):
-            with open(chunk_path, 'wb') as f:
-                f.write(chunk)
-                
-    metadata[filename] = chunk_hashes
-    save_metadata(metadata)
-    return True, "Success"
-
-def reconstruct_file_data(filename):
-    metadata = load_metadata()
-    if filename not in metadata:
-        return None
-    
-    hashes = metadata[filename]
-    output = io.BytesIO()
-    for h in hashes:
-        path = os.path.join(STORAGE_DIR, h)
-        if not os.path.exists(path):
-            return None
-        with open(path, 'rb') as f:
-            output.write(f.read())
-            
-    return output.getvalue()
+def parse_range(header, size):
+    """Return (start, end) for a single byte range, or None to send everything.
+
+    Raises ValueError if the range cannot be satisfied.
+    """
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', header or "")
+    if not match or not (match.group(1) or match.group(2)):
+        return None  # Absent, malformed or multi-range: ignore per RFC 9110
+    if match.group(1):
+        start = int(match.group(1))
+        end = int(match.group(2)) + 1 if match.group(2) else size
+    else:
+        start = size - int(match.group(2))
+        end = size
+    start, end = max(start, 0), min(end, size)
+    if start >= end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+def plan_file_read(manifest, start, end):
+    """Locate the stored bytes for [start, end) of a file.
+
+    Returns a list of (chunk hash, location, offset, length) pieces, where
+    location is (path, offset, length, codec) from the chunk store. Raises KeyError
+    if a chunk is missing, so callers can fail before sending anything.
+    """
+    store = get_chunk_store()
+    pieces = []
+    for chunk_hash, offset, length in metastore.slice_manifest(manifest, start, end):
+        location = store.locate(chunk_hash)
+        if location is None:
+            raise KeyError(chunk_hash)
+        pieces.append((chunk_hash, location, offset, length))
+    return pieces
+
+def endpoint_label(path):
+    """Return the route a request path belongs to, keeping metric labels bounded."""
+    path = urllib.parse.urlsplit(path).path
+    for endpoint in ENDPOINTS:
+        if path == endpoint or (endpoint.endswith('/') and path.startswith(endpoint)):
+            return endpoint.rstrip('/')
+    if path.startswith('/api/files/'):
+        return '/api/files'
+    return path if path == '/' else 'other'
+
+def server_metrics():
+    """Values owned by other components, exported alongside the metrics registry."""
+    cache = chunk_cache.stats()
+    counters = get_metastore().get_stats()
+    values = {
+        "dedup_cache_hits_total": ("counter", "Chunk cache hits.", cache["hits"]),
+        "dedup_cache_misses_total": ("counter", "Chunk cache misses.", cache["misses"]),
+        "dedup_cache_bytes": ("gauge", "Bytes held by the chunk cache.", cache["bytes"]),
+        "dedup_files": ("gauge", "Files stored.", counters["files"]),
+        "dedup_logical_bytes": ("gauge", "Logical size of all stored files.",
+                                counters["logical_bytes"]),
+        "dedup_unique_bytes": ("gauge", "Raw size of the unique chunks.", counters["unique_bytes"]),
+        "dedup_physical_bytes": ("gauge", "Bytes the unique chunks occupy on disk.",
+                                 counters["physical_bytes"]),
+        "dedup_unique_chunks": ("gauge", "Unique chunks stored.", counters["unique_chunks"]),
+    }
+    if collector is not None:
+        gc = collector.stats()
+        values["dedup_gc_collected_chunks_total"] = (
+            "counter", "Chunks removed by the garbage collector.", gc["collected_chunks"])
+        values["dedup_gc_dead_bytes"] = ("gauge", "Dead bytes awaiting pack compaction.",
+                                         gc["dead_bytes"])
+    return values
+
+def build_stats():
+    """Return the storage stats served by /api/stats."""
+    counters = get_metastore().get_stats()
+    store = get_chunk_store()
+    total_logical = counters["logical_bytes"]
+    unique = counters["unique_bytes"]
+    actual = counters["physical_bytes"]
+    return {
+        "logical": total_logical,
+        "actual": actual,
+        "saved": total_logical - actual,
+        "efficiency": (1 - actual/total_logical)*100 if total_logical > 0 else 0,
+        "dedup_ratio": total_logical / unique if unique > 0 else 1,
+        "compression_ratio": unique / actual if actual > 0 else 1,
+        "file_count": counters["files"],
+        "version_count": counters["versions"],
+        "unique_chunks": counters["unique_chunks"],
+        "cache": chunk_cache.stats(),
+        "gc": collector.stats() if collector is not None else None,
+        "shards": (store.shard_stats() if isinstance(store, chunkstore.ShardedChunkStore)
+                   else None)
+    }
+
+def list_files_page(offset, limit, sort, descending):
+    return get_metastore().list_files_page(offset, limit, sort, descending)
+
+stats_snapshot = snapshot.Snapshot(build_stats, list_files_page)
+
+def parse_file_query(path):
+    """Return (offset, limit, sort, descending) from a file list query string.
+
+    limit is None when the query asks for no page, meaning the whole list.
+    Raises ValueError on unknown sort keys or bad numbers.
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+    if not query:
+        return 0, None, "name", False
+    offset = int(query.get('offset', ['0'])[0])
+    limit = int(query.get('limit', [snapshot.PAGE_SIZE])[0])
+    sort = query.get('sort', ['name'])[0]
+    order = query.get('order', ['asc'])[0]
+    if offset < 0 or not 0 < limit <= snapshot.MAX_PAGE_SIZE:
+        raise ValueError(f"offset must not be negative and limit must be 1 to "
+                         f"{snapshot.MAX_PAGE_SIZE}")
+    if sort not in metastore.FILE_SORTS or order not in ("asc", "desc"):
+        raise ValueError("Unknown sort key or order")
+    return offset, limit, sort, order == "desc"
 
 class FullStackHandler(http.server.BaseHTTPRequestHandler):
     def do_GET(self):
+        self.dispatch(self.handle_get)
+
+    def do_POST(self):
+        self.dispatch(self.handle_post)
+
+    def do_DELETE(self):
+        self.dispatch(self.handle_delete)
+
+    def dispatch(self, handler):
+        """Run a request handler, recording its latency and status.
+
+        With profiling enabled, a request carrying the X-Profile header is
+        run under cProfile and its stats are saved to the profile directory,
+        named in the response's X-Profile header. Only the request thread is
+        profiled; hashing and compression on the pool show up as waits.
+        """
+        self.status = None
+        self.profile_path = None
+        endpoint = endpoint_label(self.path)
+        profiler = None
+        if profile_dir is not None and self.headers.get(PROFILE_HEADER):
+            route = endpoint.strip('/').replace('/', '-') or 'root'
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.command}-{route}-{threading.get_ident()}.prof"
+            self.profile_path = os.path.join(profile_dir, name)
+            profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                profiler.runcall(handler)
+            else:
+                handler()
+        finally:
+            metrics.observe("dedup_http_request_seconds", time.perf_counter() - start,
+                            method=self.command, endpoint=endpoint)
+            metrics.count("dedup_http_requests_total", method=self.command, endpoint=endpoint,
+                          status=self.status or 0)
+            if profiler is not None:
+                profiler.dump_stats(self.profile_path)
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def end_headers(self):
+        if getattr(self, 'profile_path', None):
+            self.send_header(PROFILE_HEADER, os.path.basename(self.profile_path))
+        super().end_headers()
+
+    def handle_get(self):
         if self.path == '/':
             self.send_response(200)
             self.send_header('Content-type', 'text/html')
@@ -87,40 +302,203 @@ class FullStackHandler(http.server.BaseHTTPRequestHandler):
                 self.wfile.write(b"index.html not found.")
         
         elif self.path == '/api/stats':
+            self.send_cached(*stats_snapshot.stats())
+
+        elif self.path == '/api/files' or self.path.startswith('/api/files?'):
+            try:
+                query = parse_file_query(self.path)
+            except ValueError as e:
+                self.send_error(400, f"Bad Request: {e}")
+                return
+            self.send_cached(*stats_snapshot.files(*query))
+
+        elif self.path == '/api/events':
+            self.open_event_stream()
+
+        elif self.path.startswith('/api/download/'):
+            try:
+                filename, version = parse_file_path(self.path, '/api/download/')
+            except ValueError:
+                self.send_error(400, "Bad Request: Invalid version")
+                return
+            self.send_file(filename, version)
+
+        elif self.path.startswith('/api/versions/'):
+            filename = urllib.parse.unquote(self.path[len('/api/versions/'):])
+            versions = get_metastore().list_versions(filename)
+            if not versions:
+                self.send_error(404, "File not found")
+                return
+            self.send_json(200, [{"version": version, "size": size, "chunks": chunks,
+                                  "created": created}
+                                 for version, size, chunks, created in versions])
+
+        elif self.path == '/api/config':
+            config = storeconfig.load_store_config()
+            self.send_json(200, {key: config.get(key) for key in CLIENT_SETTINGS})
+
+        elif self.path == '/metrics':
+            body = metrics.render(server_metrics()).encode()
             self.send_response(200)
-            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            
-            metadata = load_metadata()
-            total_logical = sum(len(h) * CHUNK_SIZE for h in metadata.values())
-            
-            actual = 0
-            if os.path.exists(STORAGE_DIR):
-                for f in os.listdir(STORAGE_DIR):
-                    actual += os.path.getsize(os.path.join(STORAGE_DIR, f))
-            
-            stats = {
-                "logical": total_logical,
-                "actual": actual,
-                "saved": total_logical - actual,
-                "efficiency": (1 - actual/total_logical)*100 if total_logical > 0 else 0,
-                "files": [{"name": k, "chunks": len(v)} for k, v in metadata.items()]
-            }
-            self.wfile.write(json.dumps(stats).encode())
+            self.wfile.write(body)
 
-        elif self.path.startswith('/api/download/'):
-            filename = self.path[len('/api/download/'):]
-            data = reconstruct_file_data(filename)
-            if data:
-                self.send_response(200)
-                self.send_header('Content-type', 'application/octet-stream')
-                self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
-                self.end_headers()
-                self.wfile.write(data)
-            else:
+    def send_file(self, filename, version=None):
+        """Stream a stored file's version, or the requested byte range of it."""
+        manifest = get_metastore().get_manifest(filename, version)
+        if manifest is None:
+            self.send_error(404, "File not found")
+            return
+        size = sum(length for _, length in manifest)
+        try:
+            byte_range = parse_range(self.headers.get('Range'), size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end = byte_range or (0, size)
+        try:
+            with metrics.timer("dedup_restore_stage_seconds", stage="plan"):
+                pieces = plan_file_read(manifest, start, end)
+        except KeyError:
+            self.send_error(500, "File data is missing from the chunk store")
+            return
+
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-type', 'application/octet-stream')
+        self.send_header('Content-Disposition', f'attachment; filename="{os.path.basename(filename)}"')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start))
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        self.end_headers()
+
+        try:
+            with metrics.timer("dedup_restore_stage_seconds", stage="send"):
+                self.write_pieces(pieces)
+            metrics.count("dedup_restored_bytes_total", end - start)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def write_pieces(self, pieces):
+        """Send planned chunk pieces, zero-copy where the storage allows it.
+
+        Compressed chunks, and chunks that occur more than once in the
+        download, are read through the shared chunk cache and written
+        from memory.
+        """
+        if not hasattr(os, 'sendfile'):
+            for chunk_hash, _, offset, length in pieces:
+                self.write_cached(chunk_hash, offset, length)
+            return
+
+        counts = Counter(chunk_hash for chunk_hash, _, _, _ in pieces)
+        out = self.connection.fileno()
+        path = source = None
+        try:
+            for chunk_hash, (chunk_path, base, _, codec), offset, length in pieces:
+                if codec or counts[chunk_hash] > 1:
+                    self.write_cached(chunk_hash, offset, length)
+                    continue
+                # Consecutive pieces usually share a segment file
+                if chunk_path != path:
+                    if source is not None:
+                        source.close()
+                    path = source = None
+                    try:
+                        source = open(chunk_path, 'rb')
+                    except FileNotFoundError:
+                        # Moved by pack compaction since the read was planned
+                        self.write_cached(chunk_hash, offset, length)
+                        continue
+                    path = chunk_path
+                sent = 0
+                while sent < length:
+                    n = os.sendfile(out, source.fileno(), base + offset + sent, length - sent)
+                    if n == 0:
+                        raise BrokenPipeError("Connection closed during download")
+                    sent += n
+        finally:
+            if source is not None:
+                source.close()
+
+    def write_cached(self, chunk_hash, offset, length):
+        """Send part of a chunk read through the shared chunk cache."""
+        with metrics.timer("dedup_restore_stage_seconds", stage="read"):
+            data = chunk_cache.fetch(get_chunk_store(), chunk_hash)
+        if data is None:
+            raise KeyError(chunk_hash)
+        self.wfile.write(memoryview(data)[offset:offset + length])
+
+    def send_cached(self, body, tag):
+        """Send a cached JSON rendering, or 304 if the client already has it."""
+        if snapshot.etag_matches(self.headers.get('If-None-Match'), tag):
+            self.send_response(304)
+            self.send_header('ETag', tag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', tag)
+        self.send_header('Cache-Control', 'no-cache')  # Revalidate with If-None-Match
+        self.end_headers()
+        self.wfile.write(body)
+
+    def open_event_stream(self):
+        """Hand the connection to the event stream, which pushes stats and file changes."""
+        if event_stream is None or event_stream.full():
+            self.send_error(503, "Too many event streams")
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.close_connection = True
+        self.server.detach(self.connection)
+        event_stream.subscribe(self.connection)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_delete(self):
+        if self.path.startswith('/api/uploads/'):
+            try:
+                get_upload_manager().abort(self.path[len('/api/uploads/'):])
+            except KeyError:
+                self.send_error(404, "Upload not found")
+                return
+            if collector is not None:
+                collector.wake()
+            self.send_json(200, {"success": True, "message": "Upload aborted"})
+        elif self.path.startswith('/api/files/'):
+            try:
+                filename, version = parse_file_path(self.path, '/api/files/')
+            except ValueError:
+                self.send_error(400, "Bad Request: Invalid version")
+                return
+            if not get_metastore().delete_file(filename, version):
                 self.send_error(404, "File not found")
+                return
+            stats_snapshot.invalidate({"op": "delete", "name": filename, "version": version})
+            # Unreferenced chunks are reclaimed in the background
+            if collector is not None:
+                collector.wake()
+            self.send_json(200, {"success": True, "message": "Deleted"})
+        else:
+            self.send_error(404, "Not found")
 
-    def do_POST(self):
+    def handle_post(self):
         if self.path == '/api/upload':
             content_type = self.headers.get('Content-Type')
             if not content_type or 'multipart/form-data' not in content_type:
@@ -133,42 +511,191 @@ class FullStackHandler(http.server.BaseHTTPRequestHandler):
                 self.send_error(400, "Bad Request: Invalid Content-Length")
                 return
 
-            body = self.rfile.read(content_length)
-            
-            # Simple boundary parsing
-            boundary = content_type.split("boundary=")[-1].encode()
-            parts = body.split(b'--' + boundary)
-            
-            filename = None
-            file_data = None
-            
-            for part in parts:
-                if b'Content-Disposition' in part and b'name="file"' in part:
-                    # Find filename
-                    fn_match = re.search(b'filename="([^"]+)"', part)
-                    if fn_match:
-                        filename = fn_match.group(1).decode()
-                    
-                    # Extract file content (after headers, separated by double CRLF)
-                    header_end = part.find(b'\r\n\r\n')
-                    if header_end != -1:
-                        file_data = part[header_end+4:].rstrip(b'\r\n--')
-            
-            if filename and file_data:
-                success, msg = dedup_file(filename, file_data)
-                self.send_response(200 if success else 400)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": success, "message": msg}).encode())
+            # The body is parsed as it arrives and fed straight into the
+            # chunker, so memory use does not depend on the upload size.
+            try:
+                boundary = multipart.parse_boundary(content_type)
+                reader = multipart.MultipartReader(self.rfile, boundary, content_length)
+                part = reader.next_part()
+                while part is not None and not (part.name == "file" and part.filename):
+                    part = reader.next_part()
+                if part is None:
+                    self.send_error(400, "Bad Request: File not found in upload")
+                    return
+
+                stream = multipart.ReadAheadStream(part)
+                try:
+                    success, msg, version = dedup_file(part.filename, stream)
+                finally:
+                    stream.close()
+                if success:
+                    reader.finish()
+                else:
+                    # The rest of the body was not read
+                    self.close_connection = True
+            except multipart.MultipartError as e:
+                self.close_connection = True
+                self.send_error(400, f"Bad Request: {e}")
+                return
+
+            self.send_json(200 if success else 400,
+                           {"success": success, "message": msg, "version": version})
+
+        elif self.path == '/api/uploads' or self.path.startswith('/api/uploads?'):
+            self.begin_upload()
+
+        elif self.path.startswith('/api/uploads/'):
+            session_id, _, action = self.path[len('/api/uploads/'):].partition('/')
+            if action == 'chunks':
+                self.receive_chunks(session_id)
+            elif action == 'commit':
+                self.commit_upload(session_id)
             else:
-                self.send_error(400, "Bad Request: File not found in upload")
+                self.send_error(404, "Not found")
+
+        else:
+            self.send_error(404, "Not found")
+
+    def read_length(self):
+        """Return the request's Content-Length, or None after sending an error."""
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            length = -1
+        if length < 0:
+            self.send_error(400, "Bad Request: Invalid Content-Length")
+            return None
+        return length
+
+    def begin_upload(self):
+        """Start a negotiated upload from the file's manifest.
+
+        The body is the ordered chunk list as manifest entries and the
+        file name is the `name` query parameter. The reply lists the
+        chunks the store lacks.
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        length = self.read_length()
+        if length is None:
+            return
+        manifest = self.rfile.read(length)
+        try:
+            session = get_upload_manager().begin(query.get('name', [''])[0], manifest)
+        except uploads.UploadError as e:
+            self.send_error(400, f"Bad Request: {e}")
+            return
+        self.send_json(200, {"session": session.id, "chunks": len(session.chunks),
+                             "missing": sorted(session.missing)})
+
+    def receive_chunks(self, session_id):
+        length = self.read_length()
+        if length is None:
+            return
+        try:
+            accepted = get_upload_manager().receive(session_id, self.rfile, length,
+                                                    storeconfig.load_store_config())
+        except KeyError:
+            self.close_connection = True
+            self.send_error(404, "Upload not found")
+            return
+        except uploads.UploadError as e:
+            # The rest of the body was not read
+            self.close_connection = True
+            self.send_error(400, f"Bad Request: {e}")
+            return
+        self.send_json(200, {"accepted": accepted})
+
+    def commit_upload(self, session_id):
+        try:
+            version = get_upload_manager().commit(session_id)
+        except KeyError:
+            self.send_error(404, "Upload not found")
+            return
+        except uploads.IncompleteUpload as e:
+            self.send_json(409, {"success": False, "message": str(e), "missing": e.missing})
+            return
+        if version is None:
+            self.send_json(200, {"success": True, "message": "File is unchanged", "version": None})
+            return
+        self.send_json(200, {"success": True, "message": "Success", "version": version})
+
+class PooledHTTPServer(socketserver.TCPServer):
+    """TCP server that hands each connection to a fixed-size thread pool."""
+
+    allow_reuse_address = True  # Faster restarts
+    request_queue_size = 64
+
+    def __init__(self, server_address, handler_class, workers=WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http")
+        self._detached = set()
+        self._detached_lock = threading.Lock()
+        super().__init__(server_address, handler_class)
+
+    def detach(self, request):
+        """Keep a connection open after its handler returns; the caller now owns it."""
+        with self._detached_lock:
+            self._detached.add(request)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self._detached_lock:
+                detached = request in self._detached
+                self._detached.discard(request)
+            if not detached:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
 
-def run_server():
-    print(f"Starting Full Stack System at http://localhost:{PORT}")
-    server = socketserver.TCPServer(("", PORT), FullStackHandler)
-    server.allow_reuse_address = True # Faster restarts
-    server.serve_forever()
+def run_server(port=PORT, workers=WORKERS, cache_size=chunkcache.CACHE_SIZE,
+               gc_rate=chunkgc.GC_RATE, profile=None):
+    global collector, event_stream, profile_dir
+    print(f"Starting Full Stack System at http://localhost:{port} ({workers} workers)")
+    chunk_cache.budget = cache_size
+    if profile is not None:
+        os.makedirs(profile, exist_ok=True)
+        profile_dir = profile
+        print(f"Requests with an {PROFILE_HEADER} header are profiled into '{profile}'.")
+    # Open the stores up front rather than on the first concurrent requests
+    get_metastore()
+    collector = chunkgc.GarbageCollector(get_metastore(), get_chunk_store(), rate=gc_rate,
+                                         cache=chunk_cache)
+    collector.start()
+    event_stream = snapshot.EventStream(stats_snapshot)
+    event_stream.start()
+    with PooledHTTPServer(("", port), FullStackHandler, workers) as server:
+        server.serve_forever()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the deduplication web server.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="number of requests served concurrently")
+    parser.add_argument("--cache-size", type=int, default=chunkcache.CACHE_SIZE // (1024 * 1024),
+                        help="chunk cache budget in MB")
+    parser.add_argument("--gc-rate", type=int, default=chunkgc.GC_RATE,
+                        help="unreferenced chunks removed per second, 0 for no limit")
+    parser.add_argument("--profile-dir",
+                        help=f"allow profiling requests that send an {PROFILE_HEADER} header, "
+                             "saving cProfile stats here")
+    storeconfig.add_store_arguments(parser)
+    args = parser.parse_args()
+    try:
+        storeconfig.apply_store_arguments(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.cache_size < 0:
+        parser.error("--cache-size cannot be negative")
     ensure_directories()
-    run_server()
+    run_server(args.port, args.workers, args.cache_size * 1024 * 1024, args.gc_rate,
+               args.profile_dir)
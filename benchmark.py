@@ -0,0 +1,447 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import hashlib
+import argparse
+import platform
+import contextlib
+import tempfile
+import subprocess
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import chunker
+import chunkcache
+import chunkstore
+import ingest
+import metastore
+import storeconfig
+
+# Configuration
+CORPUS_SIZE = 32  # MB generated per corpus
+SEED = 42
+CLIENTS = 8  # Concurrent HTTP clients
+REQUESTS = 200  # Requests per endpoint
+UPLOAD_SIZE = 256 * 1024  # Bytes per uploaded file in the HTTP benchmark
+SERVER_START_TIMEOUT = 30
+
+CORPORA = ("random", "vm", "versioned", "small")
+BOUNDARY_SAMPLE = 4 * 1024 * 1024  # Bytes of each text and log sample for the boundary check
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def random_corpus(rng, size):
+    """One file of incompressible, unique data: the worst case for dedup."""
+    return [("random.bin", rng.randbytes(size))]
+
+def vm_corpus(rng, size):
+    """Two disk-image-like files built from the same base image.
+
+    Images mix runs of zero blocks, blocks from a shared pool standing in
+    for the operating system, and unique data.
+    """
+    block = 4096
+    pool = [rng.randbytes(block) for _ in range(512)]
+    files = []
+    for n in range(2):
+        image = bytearray()
+        while len(image) < size // 2:
+            kind = rng.random()
+            run = rng.randint(1, 64)
+            if kind < 0.45:
+                image += bytes(block * run)
+            elif kind < 0.8:
+                for _ in range(run):
+                    image += rng.choice(pool)
+            else:
+                image += rng.randbytes(block * run)
+        files.append((f"vm{n}.img", bytes(image[:size // 2])))
+    return files
+
+def versioned_corpus(rng, size, versions=8):
+    """Successive versions of a text document, each with a few small edits."""
+    words = [f"{rng.getrandbits(32):x}" for _ in range(4096)]
+    doc = bytearray(" ".join(rng.choices(words, k=size // versions // 8)).encode())
+    files = []
+    for v in range(versions):
+        files.append((f"report-v{v}.txt", bytes(doc)))
+        for _ in range(32):
+            pos = rng.randrange(len(doc))
+            edit = rng.choice(words).encode()
+            kind = rng.random()
+            if kind < 0.6:
+                doc[pos:pos + len(edit)] = edit
+            elif kind < 0.8:
+                doc[pos:pos] = edit
+            else:
+                del doc[pos:pos + len(edit)]
+    return files
+
+def small_files_corpus(rng, size):
+    """Many small files, some of them copies of a few shared ones."""
+    shared = [rng.randbytes(rng.randint(1024, 16384)) for _ in range(64)]
+    files = []
+    total = 0
+    while total < size:
+        if rng.random() < 0.3:
+            data = rng.choice(shared)
+        else:
+            data = rng.randbytes(rng.randint(512, 32768))
+        files.append((f"small/{len(files):05d}.bin", data))
+        total += len(data)
+    return files
+
+def text_sample(rng, size):
+    """Prose-like text built from a small vocabulary."""
+    words = ("the of and to in is that for it as was with be by on not he this are or "
+             "storage chunk block index file data write read cache request").split()
+    text = bytearray()
+    while len(text) < size:
+        sentence = " ".join(rng.choices(words, k=rng.randint(6, 20)))
+        text += (sentence.capitalize() + ". ").encode()
+    return bytes(text[:size])
+
+def log_sample(rng, size):
+    """Server log lines that differ only in timestamps, ids and numbers."""
+    levels = ("INFO", "INFO", "INFO", "WARN", "ERROR")
+    log = bytearray()
+    n = 0
+    while len(log) < size:
+        log += (f"2024-05-01 12:{n // 3600 % 60:02d}:{n // 60 % 60:02d}.{n % 60:03d} "
+                f"{rng.choice(levels)} worker-{rng.randrange(8)} request "
+                f"id={rng.getrandbits(32):08x} done in {rng.randint(1, 999)}ms\n").encode()
+        n += 1
+    return bytes(log[:size])
+
+def bench_boundaries(seed, config):
+    """Check that chunk boundaries survive an edit on text and log samples.
+
+    One byte is inserted in the middle of each sample. A content-defined
+    chunker should keep every chunk except the edited one, while a fixed-size
+    one shifts every chunk after the edit. Chunks at max_size mean the gear
+    hash found no cut points in the content.
+    """
+    split_chunks = chunker.get_chunker(config)
+    max_size = config.get("max_size", chunker.MAX_SIZE)
+    results = {}
+    for name, sample in (("text", text_sample), ("log", log_sample)):
+        data = sample(random.Random(f"{seed}-{name}"), BOUNDARY_SAMPLE)
+        middle = len(data) // 2
+        edited = data[:middle] + b"!" + data[middle:]
+        chunks = [bytes(c) for c in split_chunks(io.BytesIO(data))]
+        kept = set(chunks).intersection(bytes(c) for c in split_chunks(io.BytesIO(edited)))
+        results[name] = {
+            "chunks": len(chunks),
+            "avg_chunk": len(data) // len(chunks),
+            "max_size_chunks": sum(len(c) >= max_size for c in chunks),
+            "kept_after_insert": round(sum(c in kept for c in chunks) / len(chunks), 4),
+        }
+    return results
+
+GENERATORS = {
+    "random": random_corpus,
+    "vm": vm_corpus,
+    "versioned": versioned_corpus,
+    "small": small_files_corpus,
+}
+
+def write_corpus(files, directory):
+    """Write generated files to disk. Returns (path, name, sha256) triples."""
+    written = []
+    for name, data in files:
+        path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        written.append((path, name, hashlib.sha256(data).hexdigest()))
+    return written
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def mb_per_s(size, seconds):
+    return size / (1024 * 1024) / seconds if seconds > 0 else 0
+
+def bench_corpus(name, size, seed, config):
+    """Ingest and restore one corpus in the current directory. Returns its results."""
+    rng = random.Random(f"{seed}-{name}")
+    corpus = write_corpus(GENERATORS[name](rng, size), "corpus")
+    total = sum(os.path.getsize(path) for path, _, _ in corpus)
+
+    store = chunkstore.open_chunk_store(config)
+    meta = metastore.open_metastore(store)
+    try:
+        start = time.perf_counter()
+        for path, file_name, _ in corpus:
+            with open(path, 'rb') as f:
+                chunks, new_chunks, new_bytes, new_raw_bytes, digest = ingest.ingest_stream(
+                    f, config, store)
+            meta.add_file(file_name, chunks, new_chunks, new_bytes, new_raw_bytes, store, digest)
+        ingest_seconds = time.perf_counter() - start
+        stats = meta.get_stats()
+
+        # Restore as reconstruct.py does, checking every byte
+        cache = chunkcache.ChunkCache()
+        verified = True
+        start = time.perf_counter()
+        for _, file_name, digest in corpus:
+            output_path = os.path.join("restore", file_name)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            checksum = hashlib.sha256()
+            with open(output_path, 'wb') as out_file:
+                for chunk_hash, _ in meta.get_manifest(file_name):
+                    data = cache.fetch(store, chunk_hash)
+                    if data is None:
+                        verified = False
+                        break
+                    out_file.write(data)
+                    checksum.update(data)
+            verified = verified and checksum.hexdigest() == digest
+        restore_seconds = time.perf_counter() - start
+    finally:
+        meta.close()
+        store.close()
+
+    return {
+        "files": len(corpus),
+        "bytes": total,
+        "ingest_seconds": round(ingest_seconds, 3),
+        "ingest_mb_s": round(mb_per_s(total, ingest_seconds), 2),
+        "restore_seconds": round(restore_seconds, 3),
+        "restore_mb_s": round(mb_per_s(total, restore_seconds), 2),
+        "stored_bytes": stats["physical_bytes"],
+        "unique_chunks": stats["unique_chunks"],
+        "dedup_ratio": round(stats["logical_bytes"] / stats["unique_bytes"], 3)
+                       if stats["unique_bytes"] else 1,
+        "compression_ratio": round(stats["unique_bytes"] / stats["physical_bytes"], 3)
+                             if stats["physical_bytes"] else 1,
+        "restore_verified": verified,
+    }
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(port):
+    """Start app.py in the current directory and wait until it answers."""
+    server = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "app.py"), "--port", str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("app.py exited during startup")
+        try:
+            request(port, "GET", "/api/stats")
+            return server
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("app.py did not start in time")
+
+def request(port, method, path, body=None, headers=None):
+    """Send one request and read the whole response. Returns (status, body length)."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        return response.status, len(response.read())
+    finally:
+        conn.close()
+
+def multipart_body(name, data):
+    boundary = f"bench{random.getrandbits(64):016x}"
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n').encode()
+    return head + data + f"\r\n--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+def run_clients(clients, calls):
+    """Run calls on a pool of clients. Returns (latencies in ms, errors, seconds)."""
+    def timed(call):
+        start = time.perf_counter()
+        try:
+            ok = call()
+        except (OSError, http.client.HTTPException):
+            ok = False
+        return (time.perf_counter() - start) * 1000, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(timed, calls))
+    seconds = time.perf_counter() - start
+    return [ms for ms, ok in results if ok], sum(1 for _, ok in results if not ok), seconds
+
+def summarize(latencies, errors, seconds):
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "requests_per_s": round((len(latencies) + errors) / seconds, 1) if seconds else 0,
+        "p50_ms": round(percentile(latencies, 50), 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99), 2) if latencies else None,
+    }
+
+def bench_http(seed, clients, requests, upload_size):
+    """Measure /api/upload, /api/download and /api/stats latency under concurrent clients.
+
+    Uploads are versions of a few base files, so the server dedups part of
+    every upload. Downloads then fetch the uploaded files at random.
+    """
+    rng = random.Random(f"{seed}-http")
+    bases = [rng.randbytes(upload_size) for _ in range(4)]
+    uploads = []
+    for i in range(requests):
+        data = bytearray(rng.choice(bases))
+        for _ in range(4):
+            pos = rng.randrange(len(data) - 64)
+            data[pos:pos + 64] = rng.randbytes(64)
+        uploads.append((f"upload-{i:05d}.bin", bytes(data)))
+
+    port = free_port()
+    server = start_server(port)
+    try:
+        def upload(name, data):
+            body, content_type = multipart_body(name, data)
+            return request(port, "POST", "/api/upload", body, {"Content-Type": content_type})[0] == 200
+
+        def download(name, size):
+            status, length = request(port, "GET", "/api/download/" + urllib.parse.quote(name))
+            return status == 200 and length == size
+
+        def stats():
+            return request(port, "GET", "/api/stats")[0] == 200
+
+        results = {}
+        results["upload"] = summarize(*run_clients(
+            clients, [lambda n=name, d=data: upload(n, d) for name, data in uploads]))
+        picks = [rng.choice(uploads) for _ in range(requests)]
+        results["download"] = summarize(*run_clients(
+            clients, [lambda n=name, d=data: download(n, len(d)) for name, data in picks]))
+        results["stats"] = summarize(*run_clients(clients, [stats] * requests))
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+def compare(baseline, results):
+    """Print how the numeric results changed against a baseline run."""
+    def flatten(tree, prefix=""):
+        for key, value in tree.items():
+            if isinstance(value, dict):
+                yield from flatten(value, f"{prefix}{key}.")
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield f"{prefix}{key}", value
+
+    old = dict(flatten({k: baseline.get(k, {}) for k in ("corpora", "boundaries", "http")}))
+    print(f"\n{'metric':<40} {'baseline':>12} {'current':>12} {'change':>8}")
+    for metric, value in flatten({k: results[k] for k in ("corpora", "boundaries", "http")}):
+        if metric not in old:
+            continue
+        change = f"{(value - old[metric]) / old[metric] * 100:+.1f}%" if old[metric] else ""
+        print(f"{metric:<40} {old[metric]:>12} {value:>12} {change:>8}")
+
+@contextlib.contextmanager
+def work_directory(args):
+    """Run in a fresh temporary directory holding a new store. Yields the store config.
+
+    The chunk store, metadata database and store.json live in the working
+    directory, so every corpus starts from an empty store.
+    """
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="dedup-bench-", dir=args.work_dir)
+    os.chdir(work_dir)
+    try:
+        yield storeconfig.apply_store_arguments(args)
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def run_benchmarks(args):
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "parameters": {
+            "corpus_size": args.size * 1024 * 1024,
+            "seed": args.seed,
+            "clients": args.clients,
+            "requests": args.requests,
+            "upload_size": args.upload_size,
+        },
+        "corpora": {},
+        "boundaries": None,
+        "http": None,
+    }
+
+    for name in args.corpora:
+        print(f"Corpus '{name}'...")
+        with work_directory(args) as config:
+            results["parameters"]["store"] = config
+            results["corpora"][name] = bench_corpus(name, args.size * 1024 * 1024, args.seed, config)
+        print("  " + json.dumps(results["corpora"][name]))
+    print("Boundary stability...")
+    with work_directory(args) as config:
+        results["boundaries"] = bench_boundaries(args.seed, config)
+    print("  " + json.dumps(results["boundaries"]))
+    if args.clients:
+        print(f"HTTP API, {args.clients} clients...")
+        with work_directory(args) as config:
+            results["parameters"]["store"] = config
+            results["http"] = bench_http(args.seed, args.clients, args.requests, args.upload_size)
+        print("  " + json.dumps(results["http"]))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ingest, restore and the HTTP API "
+                                                 "on synthetic corpora.")
+    parser.add_argument("--corpora", default=",".join(CORPORA),
+                        help=f"comma-separated corpora to run ({', '.join(CORPORA)})")
+    parser.add_argument("--size", type=int, default=CORPUS_SIZE, help="MB generated per corpus")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--clients", type=int, default=CLIENTS,
+                        help="concurrent HTTP clients, 0 to skip the HTTP benchmark")
+    parser.add_argument("--requests", type=int, default=REQUESTS, help="requests per endpoint")
+    parser.add_argument("--upload-size", type=int, default=UPLOAD_SIZE,
+                        help="bytes per uploaded file")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare with an earlier results file")
+    parser.add_argument("--work-dir", help="directory for the temporary stores")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary stores")
+    storeconfig.add_store_arguments(parser)
+    args = parser.parse_args()
+    args.corpora = [name.strip() for name in args.corpora.split(",") if name.strip()]
+    unknown = [name for name in args.corpora if name not in GENERATORS]
+    if unknown:
+        parser.error(f"unknown corpus: {', '.join(unknown)}")
+    if args.size < 1 or args.requests < 1 or args.clients < 0 or args.upload_size < 1024:
+        parser.error("--size and --requests must be positive and --upload-size at least 1024")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    try:
+        results = run_benchmarks(args)
+    except (RuntimeError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"Results written to '{args.output}'.")
+    else:
+        print(json.dumps(results, indent=4))
+    if baseline is not None:
+        compare(baseline, results)
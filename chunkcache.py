@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+
+# Configuration
+CACHE_SIZE = 64 * 1024 * 1024  # Bytes of chunk data kept in memory
+
+class ChunkCache:
+    """Least-recently-used cache of chunk contents, bounded in bytes.
+
+    The budget counts chunk data only. One cache is meant to be shared by
+    every thread of a process, so all access goes through a lock.
+    """
+
+    def __init__(self, budget=CACHE_SIZE):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chunk_hash):
+        """Return cached chunk bytes, or None on a miss."""
+        with self._lock:
+            data = self._entries.get(chunk_hash)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(chunk_hash)
+            self.hits += 1
+            return data
+
+    def put(self, chunk_hash, data):
+        """Cache a chunk, evicting the least recently used ones to fit."""
+        if len(data) > self.budget:
+            return
+        with self._lock:
+            old = self._entries.pop(chunk_hash, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[chunk_hash] = data
+            self.size += len(data)
+            while self.size > self.budget:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def fetch(self, store, chunk_hash):
+        """Return a chunk from the cache, reading it from the store on a miss."""
+        data = self.get(chunk_hash)
+        if data is None:
+            data = store.get(chunk_hash)
+            if data is not None:
+                data = bytes(data)
+                self.put(chunk_hash, data)
+        return data
+
+    def discard(self, chunk_hash):
+        with self._lock:
+            data = self._entries.pop(chunk_hash, None)
+            if data is not None:
+                self.size -= len(data)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Return the cache counters as a dict."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0,
+                "chunks": len(self._entries),
+                "bytes": self.size,
+                "budget": self.budget,
+            }
@@ -0,0 +1,190 @@
+import random
+
+# Configuration
+CHUNK_SIZE = 4096  # 4KB, used by the fixed-size chunker
+READ_SIZE = 1024 * 1024  # Bytes pulled from the stream per scan batch
+MIN_SIZE = 2048
+AVG_SIZE = 8192
+MAX_SIZE = 65536
+
+CHUNKERS = ("fixed", "fastcdc")
+
+# The gear hash h = (h << 1) + GEAR_TABLE[byte] is kept to its low
+# HASH_BITS bits, which depend on the last HASH_BITS bytes only. Hashes
+# are computed HASH_BLOCK positions at a time, each position a LANE_SIZE
+# byte lane of one big integer whose top byte absorbs carries.
+HASH_BITS = 24
+LANE_SIZE = 4
+HASH_BLOCK = 65536
+
+def _build_gear_table(seed=0x5EED):
+    """Build the gear table: a random 64-bit value for every byte value."""
+    rnd = random.Random(seed)
+    return [rnd.getrandbits(64) for _ in range(256)]
+
+GEAR_TABLE = _build_gear_table()
+# Byte k of every gear value, as bytes.translate tables
+_GEAR_BYTES = [bytes((g >> (8 * k)) & 0xFF for g in GEAR_TABLE) for k in range(HASH_BITS // 8)]
+_lane_masks = {}
+
+def fixed_chunks(stream, chunk_size=CHUNK_SIZE):
+    """Yield fixed-size chunks read from a binary stream."""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def spread_mask(bits):
+    """Return a hash mask of `bits` one bits spread evenly over the hash.
+
+    As in FastCDC, spreading the bits makes a match depend on the whole
+    HASH_BITS byte window instead of only the last few bytes.
+    """
+    bits = min(bits, HASH_BITS)
+    return sum(1 << (HASH_BITS - 1 - (m * HASH_BITS) // bits) for m in range(bits))
+
+def _lane_mask(value):
+    """Return value repeated in every lane of a block, as one integer."""
+    mask = _lane_masks.get(value)
+    if mask is None:
+        lanes = value.to_bytes(LANE_SIZE, 'little') * (HASH_BLOCK + HASH_BITS)
+        mask = _lane_masks[value] = int.from_bytes(lanes, 'little')
+    return mask
+
+def gear_maps(data, masks):
+    """Return one map per mask of where the gear hash of data matches it.
+
+    In each map, the LANE_SIZE bytes at LANE_SIZE * i are zero exactly when
+    the gear hash after data[i] has none of the mask's bits set, so matches
+    are found with bytes.find. The hash starts from zero at data[0].
+
+    Hashing byte by byte in Python would run at a few MB/s. Instead every
+    position of a block gets its own lane of one big integer, holding its
+    gear value. Adding each lane, shifted left by d bits, to the lane d
+    positions on turns sums of d terms into sums of 2d terms, so after
+    log2(HASH_BITS) rounds of whole-block integer operations every lane
+    holds the rolling hash of its position.
+    """
+    n = len(data)
+    maps = [[] for _ in masks]
+    context = HASH_BITS - 1  # Bytes before a block that its first hashes depend on
+    lane_bits = LANE_SIZE * 8
+    full = _lane_mask((1 << HASH_BITS) - 1)
+    for start in range(0, n, HASH_BLOCK):
+        lead = min(start, context)
+        block = data[start - lead:start + HASH_BLOCK]
+        lanes = bytearray(LANE_SIZE * (HASH_BLOCK + HASH_BITS))
+        for k, table in enumerate(_GEAR_BYTES):
+            lanes[k:LANE_SIZE * len(block):LANE_SIZE] = block.translate(table)
+        h = int.from_bytes(lanes, 'little')
+        d = 1
+        while d < HASH_BITS:
+            # Masking first keeps each shifted lane within HASH_BITS bits
+            h += (h & _lane_mask((1 << (HASH_BITS - d)) - 1)) << (d + lane_bits * d)
+            d *= 2
+        h &= full
+        first, last = LANE_SIZE * lead, LANE_SIZE * (lead + min(HASH_BLOCK, n - start))
+        for found, mask in zip(maps, masks):
+            found.append((h & _lane_mask(mask)).to_bytes(len(lanes), 'little')[first:last])
+    return [b"".join(found) for found in maps]
+
+def find_match(gear_map, lo, hi):
+    """Return the first position in [lo, hi) whose lane of a gear map is zero, or -1."""
+    zero = bytes(LANE_SIZE)
+    pos = gear_map.find(zero, lo * LANE_SIZE, hi * LANE_SIZE)
+    while pos != -1 and pos % LANE_SIZE:
+        # Zero bytes straddling two lanes; resume at the next lane
+        pos = gear_map.find(zero, pos + LANE_SIZE - pos % LANE_SIZE, hi * LANE_SIZE)
+    return pos // LANE_SIZE if pos != -1 else -1
+
+def _mask_bits(size):
+    """Number of hash bits that must be zero for cut points size bytes apart on average."""
+    return max(size.bit_length() - 1, 1)
+
+def chunk_masks(avg_size):
+    """Return the (strict, loose) masks used before and after avg_size."""
+    bits = _mask_bits(avg_size)
+    return spread_mask(bits + 2), spread_mask(max(bits - 2, 1))
+
+def find_cut_points(strict_map, loose_map, start, end, available, min_size, avg_size,
+                    max_size):
+    """Return end offsets of the chunks starting in data[start:end].
+
+    strict_map and loose_map are gear_maps of the data for the
+    chunk_masks of avg_size, covering `available` bytes. As in FastCDC,
+    the first min_size bytes of a chunk are skipped, and a cut point is
+    where the gear hash matches the strict mask before avg_size bytes and
+    the loose mask after, which keeps chunk sizes close to avg_size.
+    """
+    cuts = []
+    while start < end and available - start > min_size:
+        limit = min(start + max_size, available)
+        normal = min(start + avg_size, limit)
+        skip = start + min_size
+        pos = find_match(strict_map, skip, normal)
+        if pos == -1:
+            pos = find_match(loose_map, max(skip, normal), limit)
+        cut = pos + 1 if pos != -1 else limit
+        cuts.append(cut)
+        start = cut
+    return cuts
+
+def cdc_chunks(stream, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE,
+               read_size=READ_SIZE):
+    """Yield content-defined chunks read from a binary stream."""
+    if not 0 < min_size <= avg_size <= max_size:
+        raise ValueError("Chunk sizes must satisfy 0 < min <= avg <= max")
+
+    masks = chunk_masks(avg_size)
+    buf = b""
+    eof = False
+    while not eof:
+        data = stream.read(read_size)
+        if data:
+            buf += data
+        else:
+            eof = True
+
+        # Only cut where a full max_size window is buffered, so boundaries do
+        # not depend on how the stream happened to be split into reads.
+        if not eof and len(buf) < max_size + read_size:
+            continue
+
+        end = len(buf) if eof else len(buf) - max_size
+        strict_map, loose_map = gear_maps(buf, masks)
+        cuts = find_cut_points(strict_map, loose_map, 0, end, len(buf),
+                               min_size, avg_size, max_size)
+        start = 0
+        for cut in cuts:
+            yield buf[start:cut]
+            start = cut
+        buf = buf[start:]
+
+    if buf:
+        yield buf
+
+def default_settings():
+    """Return the chunker settings used for a new store."""
+    return {
+        "chunker": "fixed",
+        "chunk_size": CHUNK_SIZE,
+        "min_size": MIN_SIZE,
+        "avg_size": AVG_SIZE,
+        "max_size": MAX_SIZE,
+    }
+
+def get_chunker(settings):
+    """Return a function mapping a binary stream to an iterator of chunks."""
+    name = settings.get("chunker", "fixed")
+    if name == "fixed":
+        chunk_size = settings.get("chunk_size", CHUNK_SIZE)
+        return lambda stream: fixed_chunks(stream, chunk_size)
+    if name == "fastcdc":
+        min_size = settings.get("min_size", MIN_SIZE)
+        avg_size = settings.get("avg_size", AVG_SIZE)
+        max_size = settings.get("max_size", MAX_SIZE)
+        if not 0 < min_size <= avg_size <= max_size:
+            raise ValueError("Chunk sizes must satisfy 0 < min <= avg <= max")
+        return lambda stream: cdc_chunks(stream, min_size, avg_size, max_size)
+    raise ValueError(f"Unknown chunker '{name}'")
@@ -0,0 +1,136 @@
+import sys
+import time
+import argparse
+import threading
+
+# Configuration
+GC_INTERVAL = 30  # Seconds between scans while there is no garbage
+GC_BATCH = 256  # Unreferenced chunks removed per step
+GC_RATE = 2000  # Chunks removed per second at most
+COMPACT_STEP = 4 * 1024 * 1024  # Bytes of live chunks moved per compaction step
+COMPACT_RATE = 16 * 1024 * 1024  # Bytes moved per second at most
+MIN_DEAD_RATIO = 0.5  # Compact a pack segment once half of it is dead
+
+def collect_garbage(meta, store, limit=GC_BATCH, cache=None):
+    """Remove up to limit unreferenced chunks. Returns (chunks, bytes) freed."""
+    chunks = freed = 0
+    for digest in meta.unreferenced_chunks(limit):
+        stored = meta.collect_chunk(digest, store)
+        if stored is None:
+            continue  # Referenced again since the scan
+        chunks += 1
+        freed += stored
+        if cache is not None:
+            cache.discard(digest.hex())
+    return chunks, freed
+
+class GarbageCollector(threading.Thread):
+    """Background thread that removes unreferenced chunks incrementally.
+
+    Work is done in small steps: a batch of chunks, each deleted in its
+    own short transaction, or a few megabytes of pack compaction. The
+    thread sleeps between steps to stay under its rates, so uploads and
+    downloads are never held up for long. It idles while there is no
+    garbage and can be woken early after a delete.
+    """
+
+    def __init__(self, meta, store, rate=GC_RATE, compact_rate=COMPACT_RATE,
+                 interval=GC_INTERVAL, cache=None):
+        super().__init__(daemon=True, name="gc")
+        self.meta = meta
+        self.store = store
+        self.rate = rate
+        self.compact_rate = compact_rate
+        self.interval = interval
+        self.cache = cache
+        self.collected_chunks = 0
+        self.freed_bytes = 0
+        self.compacted_bytes = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                busy = self.step()
+            except Exception as e:
+                print(f"Garbage collection failed: {e}")
+                busy = False
+            if not busy:
+                self._wake.wait(self.interval)
+                self._wake.clear()
+
+    def step(self):
+        """Do one batch of collection and compaction. Returns True if there was work."""
+        chunks, freed = collect_garbage(self.meta, self.store, GC_BATCH, self.cache)
+        self.collected_chunks += chunks
+        self.freed_bytes += freed
+        if chunks and self.rate:
+            self._stop.wait(chunks / self.rate)
+
+        moved = self.store.compact_step(COMPACT_STEP, MIN_DEAD_RATIO)
+        self.compacted_bytes += moved
+        if moved and self.compact_rate:
+            self._stop.wait(moved / self.compact_rate)
+        return bool(chunks or moved)
+
+    def wake(self):
+        """Start the next step now instead of after the idle interval."""
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self.join()
+
+    def stats(self):
+        return {
+            "collected_chunks": self.collected_chunks,
+            "freed_bytes": self.freed_bytes,
+            "compacted_bytes": self.compacted_bytes,
+            "dead_bytes": self.store.dead_size(),
+        }
+
+if __name__ == "__main__":
+    import chunkstore
+    import metastore
+    import storeconfig
+
+    parser = argparse.ArgumentParser(description="Delete files and reclaim unreferenced chunks.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    delete_parser = subparsers.add_parser("delete", help="delete stored files, then collect garbage")
+    delete_parser.add_argument("names", nargs="+", metavar="name")
+    delete_parser.add_argument("--version", type=int,
+                               help="delete only this version, all versions by default")
+    subparsers.add_parser("collect", help="remove unreferenced chunks and compact packfiles")
+    parser.add_argument("--rate", type=int, default=GC_RATE,
+                        help="chunks removed per second, 0 for no limit")
+    args = parser.parse_args()
+    store = chunkstore.open_chunk_store(storeconfig.load_store_config())
+    meta = metastore.open_metastore(store)
+
+    try:
+        if args.command == "delete":
+            deleted = 0
+            for name in args.names:
+                if meta.delete_file(name, args.version):
+                    print(f"Deleted '{name}'." if args.version is None else
+                          f"Deleted version {args.version} of '{name}'.")
+                    deleted += 1
+                elif args.version is None:
+                    print(f"Error: No metadata found for '{name}'.")
+                else:
+                    print(f"Error: No version {args.version} found for '{name}'.")
+            if not deleted:
+                sys.exit(1)
+
+        start = time.time()
+        collector = GarbageCollector(meta, store, rate=args.rate, compact_rate=0)
+        while collector.step():
+            pass
+        print(f"Removed {collector.collected_chunks} chunks "
+              f"({collector.freed_bytes / 1024:.2f} KB), compacted "
+              f"{collector.compacted_bytes / 1024:.2f} KB in {time.time() - start:.2f}s.")
+    finally:
+        meta.close()
+        store.close()
@@ -0,0 +1,237 @@
+import os
+import mmap
+import array
+import struct
+import threading
+
+# Configuration
+DIGEST_SIZE = 32
+COMPACT_THRESHOLD = 1 << 20  # Recent digests merged into the sorted file past this
+BLOOM_BITS_PER_ENTRY = 10  # About 1% false positives with 7 hashes
+BLOOM_HASHES = 7
+
+INDEX_MAGIC = b"CHKIDX01"
+BLOOM_MAGIC = b"CHKBLM01"
+FANOUT_SIZE = 65536  # Buckets keyed by the first two digest bytes
+INDEX_HEADER = struct.Struct("<8sQ")
+BLOOM_HEADER = struct.Struct("<8sQI")
+INDEX_DATA_START = INDEX_HEADER.size + FANOUT_SIZE * 4
+
+class BloomFilter:
+    """Bit-array Bloom filter over chunk digests.
+
+    Digests are already uniformly distributed, so the bit positions are
+    derived from the digest bytes by double hashing instead of rehashing.
+    """
+
+    def __init__(self, bits, hashes=BLOOM_HASHES, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity):
+        return cls(max(capacity, 1024) * BLOOM_BITS_PER_ENTRY)
+
+    def _positions(self, digest):
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, digest):
+        data = self.data
+        for pos in self._positions(digest):
+            data[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, digest):
+        data = self.data
+        for pos in self._positions(digest):
+            if not data[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+class ChunkIndex:
+    """Set of chunk digests kept as a sorted, memory-mapped array.
+
+    Lookups first ask an in-memory Bloom filter, so a chunk that has never
+    been stored is usually rejected without touching the mapped file. Hits
+    are confirmed with a search inside the digest's two-byte fanout bucket.
+    Digests added since the last compaction live in a small in-memory set
+    and are appended to a log, and they are merged into the sorted file once
+    COMPACT_THRESHOLD of them have accumulated or the index is closed.
+
+    The index is a cache of what the chunk store holds. A missed digest
+    only costs a redundant write attempt, so the log is not fsynced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._recent = set()
+        self._removed = set()
+        self._map = None
+        self._fanout = None
+        self.count = 0
+        self.bloom = None
+        self._log = open(path + ".log", 'ab')
+        self._load()
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(path + ".digests")
+
+    def _load(self):
+        if os.path.exists(self.path + ".digests"):
+            self._load_sorted()
+
+        bloom_path = self.path + ".bloom"
+        if os.path.exists(bloom_path):
+            with open(bloom_path, 'rb') as f:
+                magic, bits, hashes = BLOOM_HEADER.unpack(f.read(BLOOM_HEADER.size))
+                if magic == BLOOM_MAGIC:
+                    self.bloom = BloomFilter(bits, hashes, f.read())
+        if self.bloom is None or self.bloom.bits < self.count * BLOOM_BITS_PER_ENTRY:
+            self.bloom = BloomFilter.for_capacity(self.count * 2)
+            for digest in self._sorted_digests():
+                self.bloom.add(digest)
+
+        log_path = self.path + ".log"
+        if os.path.exists(log_path):
+            with open(log_path, 'rb') as f:
+                data = f.read()
+            usable = len(data) - len(data) % DIGEST_SIZE
+            if usable < len(data):
+                # Drop a torn trailing record so new appends stay aligned
+                self._log.truncate(usable)
+            for i in range(0, usable, DIGEST_SIZE):
+                digest = data[i:i + DIGEST_SIZE]
+                if digest not in self._recent and not self._in_sorted(digest):
+                    self._recent.add(digest)
+                    self.bloom.add(digest)
+
+    def _sorted_digests(self):
+        if self._map is None:
+            return []
+        data = self._map[INDEX_DATA_START:INDEX_DATA_START + self.count * DIGEST_SIZE]
+        return [data[i:i + DIGEST_SIZE] for i in range(0, len(data), DIGEST_SIZE)]
+
+    def _in_sorted(self, digest):
+        if self._map is None:
+            return False
+        bucket = digest[0] << 8 | digest[1]
+        lo = self._fanout[bucket - 1] if bucket else 0
+        start = INDEX_DATA_START + lo * DIGEST_SIZE
+        end = INDEX_DATA_START + self._fanout[bucket] * DIGEST_SIZE
+        pos = self._map.find(digest, start, end)
+        while pos != -1 and (pos - INDEX_DATA_START) % DIGEST_SIZE:
+            pos = self._map.find(digest, pos + 1, end)
+        return pos != -1
+
+    def __contains__(self, digest):
+        # compact() and rebuild() swap the recent set, Bloom filter and map
+        # in several steps, so lookups must not run in between
+        with self._lock:
+            if digest in self._recent:
+                return True
+            if digest not in self.bloom or digest in self._removed:
+                return False
+            return self._in_sorted(digest)
+
+    def __len__(self):
+        with self._lock:
+            return self.count + len(self._recent) - len(self._removed)
+
+    def add(self, digest):
+        with self._lock:
+            self._removed.discard(digest)
+            if digest in self._recent or self._in_sorted(digest):
+                return
+            self._recent.add(digest)
+            self.bloom.add(digest)
+            self._log.write(digest)
+            self._log.flush()
+            if len(self._recent) >= COMPACT_THRESHOLD:
+                self.compact()
+
+    def discard(self, digest):
+        """Forget a digest. Bloom bits stay set until the next rebuild."""
+        with self._lock:
+            if digest in self._recent:
+                self._recent.discard(digest)
+            elif self._in_sorted(digest):
+                self._removed.add(digest)
+
+    def compact(self):
+        """Merge recent additions and removals into the sorted digest file."""
+        with self._lock:
+            if not self._recent and not self._removed and os.path.exists(self.path + ".digests"):
+                return
+            # Start from the file on disk, which another process may have compacted
+            if os.path.exists(self.path + ".digests"):
+                self._load_sorted()
+            digests = sorted(set(self._sorted_digests()).union(self._recent) - self._removed)
+            self._write(digests)
+            self._recent.clear()
+            self._log.truncate(0)
+            if self._removed or len(digests) * BLOOM_BITS_PER_ENTRY > self.bloom.bits:
+                self.bloom = BloomFilter.for_capacity(len(digests) * 2)
+                for digest in digests:
+                    self.bloom.add(digest)
+            self._removed.clear()
+            self._write_bloom()
+            self._load_sorted()
+
+    def rebuild(self, digests):
+        """Replace the index contents with the given digests."""
+        with self._lock:
+            self._recent = set(digests)
+            self._removed.clear()
+            self._map = None
+            self.count = 0
+            self.bloom = BloomFilter.for_capacity(len(self._recent) * 2)
+            for digest in self._recent:
+                self.bloom.add(digest)
+            self.compact()
+
+    def _write(self, digests):
+        fanout = array.array('I', [0] * FANOUT_SIZE)
+        for digest in digests:
+            fanout[digest[0] << 8 | digest[1]] += 1
+        total = 0
+        for bucket in range(FANOUT_SIZE):
+            total += fanout[bucket]
+            fanout[bucket] = total
+
+        tmp_path = f"{self.path}.digests.tmp-{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(digests)))
+            f.write(fanout.tobytes())
+            f.write(b"".join(digests))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path + ".digests")
+
+    def _write_bloom(self):
+        tmp_path = f"{self.path}.bloom.tmp-{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(BLOOM_HEADER.pack(BLOOM_MAGIC, self.bloom.bits, self.bloom.hashes))
+            f.write(self.bloom.data)
+        os.replace(tmp_path, self.path + ".bloom")
+
+    def _load_sorted(self):
+        """Map the sorted digest file. A replaced map is left to the garbage collector."""
+        path = self.path + ".digests"
+        with open(path, 'rb') as f:
+            magic, count = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+            if magic != INDEX_MAGIC:
+                raise ValueError(f"'{path}' is not a chunk index")
+            fanout = array.array('I')
+            fanout.frombytes(f.read(FANOUT_SIZE * 4))
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if count else None
+        self._fanout, self._map, self.count = fanout, mapped, count
+
+    def close(self):
+        with self._lock:
+            if self._recent or self._removed:
+                self.compact()
+            self._log.close()
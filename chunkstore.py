@@ -0,0 +1,942 @@
+import os
+import sys
+import mmap
+import bisect
+import shutil
+import struct
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import compression
+import journal
+import similarity
+from chunkindex import ChunkIndex
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-writer only
+    fcntl = None
+
+# Configuration
+STORAGE_DIR = "storage"
+PACK_DIR = "packs"
+INDEX_FILE = "index"
+LOCK_FILE = "lock"
+CHUNK_INDEX = ".chunkindex"  # Digest index of the per-file layout
+SEGMENT_SIZE = 256 * 1024 * 1024  # Roll over to a new segment past 256MB
+VIRTUAL_NODES = 128  # Ring points per shard; more points spread chunks more evenly
+REBALANCE_BATCH = 1024  # Chunks copied between syncs before their old copies go
+
+BACKENDS = ("file", "pack")
+# Kept in the storage directory whatever the backend or shard layout
+ROOT_FILES = (journal.JOURNAL_DIR, similarity.SIMILARITY_FILE)
+
+# digest, codec << 24 | segment number, offset, stored length. A later
+# record for the same digest supersedes earlier ones, and segment 0 marks
+# a deleted chunk.
+INDEX_RECORD = struct.Struct("<32sIQI")
+SEGMENT_MASK = 0xFFFFFF
+
+def _decode(store, stored):
+    """Decode a (payload, codec) pair, resolving delta chunks through their bases."""
+    payload, codec = stored
+    if codec == compression.DELTA:
+        base = store.get(compression.delta_header(payload)[1].hex())
+        if base is None:
+            return None
+        return compression.decode_delta(payload, base)
+    return compression.decode(codec, payload)
+
+class FileChunkStore:
+    """Legacy layout: one file per chunk, named by its hex digest.
+
+    Compressed chunks carry their codec as a suffix, as in `<digest>.zlib`.
+    Existence checks go to a ChunkIndex instead of the filesystem. The
+    index is built by one directory scan the first time a store is opened.
+    """
+
+    backend = "file"
+
+    def __init__(self, root=STORAGE_DIR):
+        self.root = root
+        self.similarity = None  # Set by open_chunk_store when delta encoding is on
+        self.journal = None  # Set by open_chunk_store
+        if not os.path.exists(root):
+            os.makedirs(root)
+        index_path = os.path.join(root, CHUNK_INDEX)
+        rebuild = not ChunkIndex.exists(index_path)
+        self.index = ChunkIndex(index_path)
+        if rebuild:
+            self.index.rebuild(bytes.fromhex(h) for h in self.hashes())
+
+    def _path(self, chunk_hash, codec=0):
+        if codec:
+            chunk_hash += "." + compression.CODECS[codec]
+        return os.path.join(self.root, chunk_hash)
+
+    def has(self, chunk_hash):
+        return bytes.fromhex(chunk_hash) in self.index
+
+    def verify(self, chunk_hash):
+        """Check on disk that a chunk exists, correcting the index if not."""
+        if self._find(chunk_hash) is not None:
+            return True
+        self.index.discard(bytes.fromhex(chunk_hash))
+        return False
+
+    def put(self, chunk_hash, data, codec=0):
+        """Store a chunk payload unless present. Returns True if it was written.
+
+        The chunk is written to a temp file and linked into place, so readers
+        never see a partial chunk and concurrent writers of the same chunk
+        store it exactly once.
+        """
+        digest = bytes.fromhex(chunk_hash)
+        if digest in self.index:
+            return False
+        path = self._path(chunk_hash, codec)
+        tmp_path = os.path.join(self.root, f".tmp-{chunk_hash}-{os.getpid()}-{threading.get_ident()}")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            # Written by another process since our index was loaded
+            self.index.add(digest)
+            return False
+        except OSError:
+            # Filesystem without hard links: rename is still atomic
+            if os.path.exists(path):
+                self.index.add(digest)
+                return False
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.index.add(digest)
+        return True
+
+    def put_many(self, items):
+        """Store (hex digest, payload, codec) items. Returns the copies written per item."""
+        return [self.put(*item) for item in items]
+
+    def _find(self, chunk_hash):
+        """Return (path, codec) of a stored chunk, or None."""
+        for codec in range(len(compression.CODECS)):
+            path = self._path(chunk_hash, codec)
+            if os.path.exists(path):
+                return path, codec
+        return None
+
+    def locate(self, chunk_hash):
+        """Return (path, offset, length, codec) of the chunk's bytes, or None."""
+        found = self._find(chunk_hash)
+        if found is None:
+            return None
+        path, codec = found
+        try:
+            return path, 0, os.path.getsize(path), codec
+        except OSError:
+            return None
+
+    def stored_size(self, chunk_hash):
+        """Return the bytes a chunk occupies in the store, or 0 if it is missing."""
+        location = self.locate(chunk_hash)
+        return location[2] if location is not None else 0
+
+    def read_stored(self, chunk_hash):
+        """Return (payload, codec) as stored, or None if the chunk is missing."""
+        found = self._find(chunk_hash)
+        if found is None:
+            return None
+        path, codec = found
+        try:
+            with open(path, 'rb') as f:
+                return f.read(), codec
+        except FileNotFoundError:
+            return None
+
+    def get(self, chunk_hash):
+        """Return the decoded chunk bytes, or None if the chunk or its base is missing."""
+        stored = self.read_stored(chunk_hash)
+        if stored is None:
+            return None
+        return _decode(self, stored)
+
+    def base_of(self, chunk_hash):
+        """Return the digest of the chunk a delta chunk is encoded against, or None."""
+        found = self._find(chunk_hash)
+        if found is None or found[1] != compression.DELTA:
+            return None
+        stored = self.read_stored(chunk_hash)
+        return compression.delta_header(stored[0])[1] if stored is not None else None
+
+    def delete(self, chunk_hash):
+        """Remove a chunk. Returns its stored length, or None if it was missing."""
+        self.index.discard(bytes.fromhex(chunk_hash))
+        found = self._find(chunk_hash)
+        if found is None:
+            return None
+        try:
+            size = os.path.getsize(found[0])
+            os.remove(found[0])
+        except FileNotFoundError:
+            return None
+        return size
+
+    def compact_step(self, max_bytes, min_dead_ratio):
+        """Deleted chunk files free their space at once; nothing to compact."""
+        return 0
+
+    def dead_size(self):
+        return 0
+
+    def _files(self):
+        """Return (hex digest, filename) for every stored chunk."""
+        return [(name.partition(".")[0], name) for name in os.listdir(self.root)
+                if not name.startswith(".") and os.path.isfile(os.path.join(self.root, name))]
+
+    def hashes(self):
+        return [chunk_hash for chunk_hash, _ in self._files()]
+
+    def chunk_count(self):
+        return len(self._files())
+
+    def physical_size(self):
+        return sum(os.path.getsize(os.path.join(self.root, name)) for _, name in self._files())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.index.close()
+        if self.similarity is not None:
+            self.similarity.close()
+        if self.journal is not None:
+            self.journal.close()
+
+class PackChunkStore:
+    """Chunks appended to large segment files, located through an index.
+
+    The index is an append-only file of fixed-size records mapping a digest
+    to (segment, offset, length). It is loaded into memory when the store is
+    opened. Segments are read through mmap. Writers are serialized with a
+    thread lock inside a process and a lock file across processes, and they
+    pick up each other's index records before appending.
+
+    Deleting a chunk appends a tombstone record. Its bytes stay in the
+    segment and are counted as dead until compact_step() moves the live
+    chunks of a mostly dead segment to the end of the pack and removes it.
+    """
+
+    backend = "pack"
+
+    def __init__(self, root=STORAGE_DIR, segment_size=SEGMENT_SIZE):
+        self.root = root
+        self.pack_dir = os.path.join(root, PACK_DIR)
+        self.segment_size = segment_size
+        self.similarity = None  # Set by open_chunk_store when delta encoding is on
+        self.journal = None  # Set by open_chunk_store
+        if not os.path.exists(self.pack_dir):
+            os.makedirs(self.pack_dir)
+
+        self.index = {}
+        self.dead = {}  # Segment number -> bytes of deleted or moved chunks
+        self._compaction = None
+        self._index_pos = 0
+        self._index_file = open(os.path.join(self.pack_dir, INDEX_FILE), 'ab')
+        self._lock_file = open(os.path.join(self.pack_dir, LOCK_FILE), 'ab')
+        self._segment = None
+        self._segment_no = 0
+        self._maps = {}
+        self._mutex = threading.RLock()
+        self._lock()
+        try:
+            self._trim_index()
+            self._load_index()
+        finally:
+            self._unlock()
+
+    def _segment_path(self, segment_no):
+        return os.path.join(self.pack_dir, f"{segment_no:06d}.pack")
+
+    def _load_index(self):
+        """Read index records appended since the last load."""
+        path = os.path.join(self.pack_dir, INDEX_FILE)
+        with self._mutex:
+            size = os.path.getsize(path)
+            if size <= self._index_pos:
+                return
+            with open(path, 'rb') as f:
+                f.seek(self._index_pos)
+                data = f.read(size - self._index_pos)
+            # Ignore a torn trailing record left by a crash mid-append
+            usable = len(data) - len(data) % INDEX_RECORD.size
+            for digest, segment_field, offset, length in INDEX_RECORD.iter_unpack(data[:usable]):
+                segment_no = segment_field & SEGMENT_MASK
+                old = self.index.pop(digest, None)
+                if old is not None:
+                    self.dead[old[0]] = self.dead.get(old[0], 0) + old[2]
+                if segment_no:
+                    self.index[digest] = (segment_no, offset, length, segment_field >> 24)
+                    self._segment_no = max(self._segment_no, segment_no)
+            self._index_pos += usable
+
+    def _lock(self):
+        self._mutex.acquire()
+        if fcntl:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        if fcntl:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._mutex.release()
+
+    def _open_segment(self):
+        """Return the segment to append to, positioned at its end."""
+        self._segment_no = max(self._segment_no, 1)
+        while True:
+            path = self._segment_path(self._segment_no)
+            if self._segment is None or self._segment.name != path:
+                if self._segment is not None:
+                    # flush() only syncs the segment being appended to
+                    os.fsync(self._segment.fileno())
+                    self._segment.close()
+                self._segment = open(path, 'ab')
+            self._segment.seek(0, os.SEEK_END)
+            if self._segment.tell() < self.segment_size:
+                return self._segment
+            self._segment_no += 1
+
+    def has(self, chunk_hash):
+        return bytes.fromhex(chunk_hash) in self.index
+
+    def verify(self, chunk_hash):
+        """Check a chunk exists after picking up other processes' index records."""
+        self._load_index()
+        return bytes.fromhex(chunk_hash) in self.index
+
+    def _trim_index(self):
+        """Drop a torn trailing index record so appends stay aligned. Needs the lock."""
+        size = os.fstat(self._index_file.fileno()).st_size
+        if size % INDEX_RECORD.size:
+            self._index_file.truncate(size - size % INDEX_RECORD.size)
+
+    def _append_record(self, digest, segment_field, offset, length):
+        # A process that crashed mid-append may have left a torn record
+        self._trim_index()
+        self._index_file.write(INDEX_RECORD.pack(digest, segment_field, offset, length))
+        self._index_file.flush()
+        self._index_pos = self._index_file.tell()
+
+    def put(self, chunk_hash, data, codec=0):
+        """Append a chunk payload unless present. Returns True if it was written."""
+        digest = bytes.fromhex(chunk_hash)
+        if digest in self.index:
+            return False
+        self._lock()
+        try:
+            self._load_index()
+            if digest in self.index:
+                return False
+            segment = self._open_segment()
+            offset = segment.tell()
+            segment.write(data)
+            segment.flush()
+            self._append_record(digest, codec << 24 | self._segment_no, offset, len(data))
+            self.index[digest] = (self._segment_no, offset, len(data), codec)
+        finally:
+            self._unlock()
+        return True
+
+    def put_many(self, items):
+        """Store (hex digest, payload, codec) items. Returns the copies written per item."""
+        return [self.put(*item) for item in items]
+
+    def _entry(self, chunk_hash):
+        digest = bytes.fromhex(chunk_hash)
+        entry = self.index.get(digest)
+        if entry is None:
+            # Another process may have appended it since we loaded the index
+            self._load_index()
+            entry = self.index.get(digest)
+        return entry
+
+    def locate(self, chunk_hash):
+        """Return (segment path, offset, length, codec) for a chunk, or None."""
+        entry = self._entry(chunk_hash)
+        if entry is None:
+            return None
+        segment_no, offset, length, codec = entry
+        return self._segment_path(segment_no), offset, length, codec
+
+    def stored_size(self, chunk_hash):
+        """Return the bytes a chunk occupies in the store, or 0 if it is missing."""
+        entry = self._entry(chunk_hash)
+        return entry[2] if entry is not None else 0
+
+    def _map(self, segment_no, end):
+        """Return an mmap of a segment covering at least `end` bytes."""
+        mapped = self._maps.get(segment_no)
+        if mapped is None or len(mapped) < end:
+            with self._mutex:
+                mapped = self._maps.get(segment_no)
+                if mapped is None or len(mapped) < end:
+                    # A replaced map is left to be freed once no reader holds it
+                    with open(self._segment_path(segment_no), 'rb') as f:
+                        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._maps[segment_no] = mapped
+        return mapped
+
+    def read_stored(self, chunk_hash):
+        """Return (payload, codec) as stored, or None if the chunk is missing."""
+        for attempt in range(2):
+            entry = self._entry(chunk_hash)
+            if entry is None:
+                return None
+            segment_no, offset, length, codec = entry
+            try:
+                return self._map(segment_no, offset + length)[offset:offset + length], codec
+            except (OSError, ValueError):
+                # Another process may have compacted the segment away
+                self._load_index()
+        return None
+
+    def get(self, chunk_hash):
+        """Return the decoded chunk bytes, or None if the chunk or its base is missing."""
+        stored = self.read_stored(chunk_hash)
+        if stored is None:
+            return None
+        return _decode(self, stored)
+
+    def base_of(self, chunk_hash):
+        """Return the digest of the chunk a delta chunk is encoded against, or None."""
+        entry = self._entry(chunk_hash)
+        if entry is None or entry[3] != compression.DELTA:
+            return None
+        stored = self.read_stored(chunk_hash)
+        return compression.delta_header(stored[0])[1] if stored is not None else None
+
+    def delete(self, chunk_hash):
+        """Remove a chunk. Returns its stored length, or None if it was missing."""
+        digest = bytes.fromhex(chunk_hash)
+        self._lock()
+        try:
+            self._load_index()
+            entry = self.index.pop(digest, None)
+            if entry is None:
+                return None
+            self._append_record(digest, 0, 0, 0)
+            self.dead[entry[0]] = self.dead.get(entry[0], 0) + entry[2]
+        finally:
+            self._unlock()
+        return entry[2]
+
+    def _compaction_candidate(self, min_dead_ratio):
+        for segment_no, dead in sorted(self.dead.items()):
+            if segment_no >= self._segment_no:
+                continue  # Still being appended to
+            path = self._segment_path(segment_no)
+            if os.path.exists(path) and dead >= os.path.getsize(path) * min_dead_ratio:
+                return segment_no
+        return None
+
+    def _relocate(self, digest, segment_no):
+        """Append a live chunk of a segment being compacted to the active segment."""
+        self._lock()
+        try:
+            self._load_index()
+            entry = self.index.get(digest)
+            if entry is None or entry[0] != segment_no:
+                return 0
+            _, offset, length, codec = entry
+            data = self._map(segment_no, offset + length)[offset:offset + length]
+            segment = self._open_segment()
+            new_offset = segment.tell()
+            segment.write(data)
+            segment.flush()
+            self._append_record(digest, codec << 24 | self._segment_no, new_offset, length)
+            self.index[digest] = (self._segment_no, new_offset, length, codec)
+            self.dead[segment_no] = self.dead.get(segment_no, 0) + length
+        finally:
+            self._unlock()
+        return length
+
+    def _remove_segment(self, segment_no):
+        self._lock()
+        try:
+            self._load_index()
+            if any(entry[0] == segment_no for entry in self.index.values()):
+                return False
+            # Moved chunks must be durable before their old copies go
+            self.flush()
+            try:
+                os.remove(self._segment_path(segment_no))
+            except FileNotFoundError:
+                pass
+            # Readers may still hold the map; it is freed once they drop it
+            self._maps.pop(segment_no, None)
+            self.dead.pop(segment_no, None)
+        finally:
+            self._unlock()
+        return True
+
+    def compact_step(self, max_bytes, min_dead_ratio):
+        """Move up to max_bytes of live chunks out of a mostly dead segment.
+
+        A segment qualifies once min_dead_ratio of it is dead, and it is
+        deleted when its last live chunk has moved. Returns the bytes moved,
+        so callers can pace themselves.
+        """
+        if self._compaction is None:
+            self._load_index()
+            segment_no = self._compaction_candidate(min_dead_ratio)
+            if segment_no is None:
+                return 0
+            live = [digest for digest, entry in self.index.items() if entry[0] == segment_no]
+            self._compaction = (segment_no, live)
+        segment_no, live = self._compaction
+        moved = 0
+        while live and moved < max_bytes:
+            moved += self._relocate(live.pop(), segment_no)
+        if not live:
+            self._compaction = None
+            self._remove_segment(segment_no)
+        return moved
+
+    def hashes(self):
+        return [digest.hex() for digest in self.index]
+
+    def chunk_count(self):
+        return len(self.index)
+
+    def physical_size(self):
+        """Bytes of live chunks; dead bytes are reclaimed by compaction."""
+        return sum(entry[2] for entry in self.index.values())
+
+    def dead_size(self):
+        """Bytes of deleted or moved chunks still held by segments."""
+        return sum(dead for segment_no, dead in self.dead.items()
+                   if os.path.exists(self._segment_path(segment_no)))
+
+    def flush(self):
+        """Force segment and index writes to disk."""
+        if self._segment is not None:
+            os.fsync(self._segment.fileno())
+        os.fsync(self._index_file.fileno())
+
+    def close(self):
+        for mapped in self._maps.values():
+            mapped.close()
+        self._maps.clear()
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+        self._index_file.close()
+        self._lock_file.close()
+        if self.similarity is not None:
+            self.similarity.close()
+        if self.journal is not None:
+            self.journal.close()
+
+class HashRing:
+    """Consistent hash ring mapping chunk digests to shards.
+
+    Every shard owns VIRTUAL_NODES points on a 64-bit ring, derived from
+    its id, and a chunk belongs to the shards owning the first points
+    after its digest. Adding a shard only takes over the ring segments
+    in front of its own points, so about 1/N of the chunks move.
+    """
+
+    def __init__(self, shard_ids, vnodes=VIRTUAL_NODES):
+        points = sorted(
+            (int.from_bytes(hashlib.blake2b(f"{shard_id}#{i}".encode(), digest_size=8).digest(),
+                            "big"), index)
+            for index, shard_id in enumerate(shard_ids) for i in range(vnodes))
+        self._positions = [position for position, _ in points]
+        self._owners = [index for _, index in points]
+        self.shard_count = len(shard_ids)
+
+    def lookup(self, digest, replicas=1):
+        """Return the indexes of the distinct shards holding a digest, primary first."""
+        replicas = min(replicas, self.shard_count)
+        start = bisect.bisect(self._positions, int.from_bytes(digest[:8], "big"))
+        shards = []
+        for i in range(len(self._owners)):
+            owner = self._owners[(start + i) % len(self._owners)]
+            if owner not in shards:
+                shards.append(owner)
+                if len(shards) == replicas:
+                    break
+        return shards
+
+class ShardedChunkStore:
+    """Chunks spread over several store roots, standing in for disks or nodes.
+
+    Each root holds an ordinary file or pack store. A HashRing places
+    every chunk on `replicas` distinct shards, and writes to different
+    shards run in parallel on one thread per shard. Lookups check every
+    shard, so a chunk is found even where the ring no longer puts it, for
+    example after a shard was added but before rebalance() ran. Chunk
+    counts are of distinct chunks, while sizes count every copy.
+    """
+
+    def __init__(self, roots, backend="pack", segment_size=SEGMENT_SIZE, replicas=1):
+        if not roots:
+            raise ValueError("A sharded store needs at least one root")
+        if replicas < 1:
+            raise ValueError("The replica count must be at least 1")
+        self.backend = backend
+        self.roots = [os.path.normpath(root) for root in roots]
+        self.replicas = replicas
+        self.similarity = None  # Set by open_chunk_store when delta encoding is on
+        self.journal = None  # Set by open_chunk_store
+        self.shards = [_open_backend(backend, root, segment_size) for root in self.roots]
+        self.ring = HashRing(self.roots)
+        self._pool = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix="shard")
+
+    def _placement(self, chunk_hash):
+        return self.ring.lookup(bytes.fromhex(chunk_hash), self.replicas)
+
+    def _holders(self, chunk_hash):
+        """Yield every shard, those the ring places the chunk on first."""
+        placement = self._placement(chunk_hash)
+        for index in placement:
+            yield self.shards[index]
+        for index, shard in enumerate(self.shards):
+            if index not in placement:
+                yield shard
+
+    def _find(self, chunk_hash, read):
+        """Return the first result of read(shard) from a shard holding the chunk, or None."""
+        for shard in self._holders(chunk_hash):
+            if shard.has(chunk_hash):
+                result = read(shard)
+                if result is not None:
+                    return result
+        # Written by another process since the shard indexes were loaded
+        for shard in self._holders(chunk_hash):
+            result = read(shard)
+            if result is not None:
+                return result
+        return None
+
+    def _parallel(self, func, indexes=None):
+        """Run func on each shard index at once, all shards by default. Returns the results."""
+        if indexes is None:
+            indexes = range(len(self.shards))
+        return [future.result() for future in [self._pool.submit(func, index) for index in indexes]]
+
+    def has(self, chunk_hash):
+        return any(shard.has(chunk_hash) for shard in self.shards)
+
+    def verify(self, chunk_hash):
+        return any(shard.verify(chunk_hash) for shard in self._holders(chunk_hash))
+
+    def put(self, chunk_hash, data, codec=0):
+        """Store a chunk on its shards unless present. Returns the copies written."""
+        return self.put_many([(chunk_hash, data, codec)])[0]
+
+    def put_many(self, items):
+        """Store (hex digest, payload, codec) items, writing to all shards in parallel.
+
+        Returns the copies written per item, 0 for chunks already stored.
+        """
+        work = {}  # Shard index -> [(item index, item), ...]
+        seen = set()
+        for i, item in enumerate(items):
+            if item[0] in seen or self.has(item[0]):
+                continue
+            seen.add(item[0])
+            for index in self._placement(item[0]):
+                work.setdefault(index, []).append((i, item))
+        written = [0] * len(items)
+
+        def write(index):
+            return [(i, self.shards[index].put(*item)) for i, item in work[index]]
+
+        for results in self._parallel(write, sorted(work)):
+            for i, copied in results:
+                written[i] += copied
+        return written
+
+    def locate(self, chunk_hash):
+        """Return (path, offset, length, codec) of one copy of a chunk, or None."""
+        return self._find(chunk_hash, lambda shard: shard.locate(chunk_hash))
+
+    def stored_size(self, chunk_hash):
+        """Return the bytes every copy of a chunk occupies together."""
+        return sum(shard.stored_size(chunk_hash) for shard in self.shards)
+
+    def read_stored(self, chunk_hash):
+        """Return (payload, codec) as stored, or None if the chunk is missing."""
+        return self._find(chunk_hash, lambda shard: shard.read_stored(chunk_hash))
+
+    def get(self, chunk_hash):
+        """Return the decoded chunk bytes, or None if the chunk or its base is missing."""
+        stored = self.read_stored(chunk_hash)
+        if stored is None:
+            return None
+        return _decode(self, stored)
+
+    def base_of(self, chunk_hash):
+        """Return the digest of the chunk a delta chunk is encoded against, or None."""
+        return self._find(chunk_hash, lambda shard: shard.base_of(chunk_hash))
+
+    def delete(self, chunk_hash):
+        """Remove every copy of a chunk. Returns their stored length, or None if missing."""
+        sizes = [size for size in (shard.delete(chunk_hash) for shard in self.shards)
+                 if size is not None]
+        return sum(sizes) if sizes else None
+
+    def compact_step(self, max_bytes, min_dead_ratio):
+        moved = 0
+        for shard in self.shards:
+            moved += shard.compact_step(max_bytes - moved, min_dead_ratio)
+            if moved >= max_bytes:
+                break
+        return moved
+
+    def dead_size(self):
+        return sum(shard.dead_size() for shard in self.shards)
+
+    def hashes(self):
+        return list({chunk_hash for shard in self.shards for chunk_hash in shard.hashes()})
+
+    def chunk_count(self):
+        return len(self.hashes())
+
+    def physical_size(self):
+        return sum(shard.physical_size() for shard in self.shards)
+
+    def shard_stats(self):
+        """Return the chunks, bytes and volume free space of every shard."""
+        def stats(index):
+            shard = self.shards[index]
+            return {
+                "root": shard.root,
+                "chunks": shard.chunk_count(),
+                "bytes": shard.physical_size(),
+                "dead_bytes": shard.dead_size(),
+                "free_bytes": shutil.disk_usage(shard.root).free,
+            }
+        return self._parallel(stats)
+
+    def rebalance(self):
+        """Move chunks to the shards the ring places them on. Returns (copied, removed).
+
+        Only chunks whose placement changed are touched: each is copied to
+        the shards that lack it, the copies are synced, and only then is it
+        removed from shards the ring no longer assigns it to. Shards are
+        scanned in parallel.
+        """
+        def drain(source):
+            shard = self.shards[source]
+            copied = removed = 0
+            pending = []
+            for chunk_hash in shard.hashes():
+                placement = self._placement(chunk_hash)
+                missing = [index for index in placement if not self.shards[index].has(chunk_hash)]
+                if missing:
+                    stored = shard.read_stored(chunk_hash)
+                    if stored is None:
+                        continue
+                    payload = bytes(stored[0])
+                    for index in missing:
+                        copied += bool(self.shards[index].put(chunk_hash, payload, stored[1]))
+                if source not in placement:
+                    pending.append(chunk_hash)
+                if len(pending) >= REBALANCE_BATCH:
+                    removed += self._remove_copies(shard, pending)
+                    pending = []
+            return copied, removed + self._remove_copies(shard, pending)
+
+        results = self._parallel(drain)
+        return sum(copied for copied, _ in results), sum(removed for _, removed in results)
+
+    def _remove_copies(self, shard, chunk_hashes):
+        if not chunk_hashes:
+            return 0
+        for other in self.shards:
+            if other is not shard:
+                other.flush()  # The new copies must be durable first
+        removed = 0
+        for chunk_hash in chunk_hashes:
+            if shard.delete(chunk_hash) is not None:
+                removed += 1
+        return removed
+
+    def flush(self):
+        self._parallel(lambda index: self.shards[index].flush())
+
+    def close(self):
+        self._pool.shutdown()
+        for shard in self.shards:
+            shard.close()
+        if self.similarity is not None:
+            self.similarity.close()
+        if self.journal is not None:
+            self.journal.close()
+
+def _open_backend(backend, root, segment_size=SEGMENT_SIZE):
+    if backend == "file":
+        return FileChunkStore(root)
+    if backend == "pack":
+        return PackChunkStore(root, segment_size)
+    raise ValueError(f"Unknown storage backend '{backend}'")
+
+def open_chunk_store(config, root=STORAGE_DIR):
+    """Open the chunk store backend selected in the store config.
+
+    With shard roots configured, chunks are spread over them and root only
+    keeps the similarity index and the ingest journal.
+    """
+    backend = config.get("backend", "file")
+    segment_size = config.get("segment_size", SEGMENT_SIZE)
+    if config.get("shards"):
+        store = ShardedChunkStore(config["shards"], backend, segment_size,
+                                  config.get("replicas", 1))
+    else:
+        store = _open_backend(backend, root, segment_size)
+    if config.get("delta"):
+        store.similarity = similarity.open_similarity_index(root)
+    store.journal = journal.open_journal(root, config.get("durability", "normal"))
+    return store
+
+def detect_backend(root=STORAGE_DIR, shards=()):
+    """Guess the backend of an existing store.
+
+    With shard roots, the chunks are in the shards and root only keeps the
+    similarity index and the ingest journal, so the shards are looked at
+    instead. Those two never mark a directory as a per-file store.
+    """
+    roots = list(shards) or [root]
+    if any(os.path.isdir(os.path.join(path, PACK_DIR)) for path in roots):
+        return "pack"
+    for path in roots:
+        if os.path.isdir(path):
+            with os.scandir(path) as entries:
+                if any(entry.name not in ROOT_FILES for entry in entries):
+                    return "file"
+    return None
+
+def migrate_to_pack(root=STORAGE_DIR, segment_size=SEGMENT_SIZE):
+    """Move every chunk of a per-file storage directory into packfiles.
+
+    Payloads are copied as stored, keeping their codec, and delta chunks
+    still name their base by digest. Chunks are appended to the pack and
+    synced to disk before their legacy files are removed, so an
+    interrupted migration can simply be rerun.
+    """
+    legacy = FileChunkStore(root)
+    legacy_files = legacy._files()
+    pack = PackChunkStore(root, segment_size)
+    migrated = 0
+    try:
+        for chunk_hash, _ in legacy_files:
+            stored = legacy.read_stored(chunk_hash)
+            if stored is not None and pack.put(chunk_hash, *stored):
+                migrated += 1
+        pack.flush()
+        for _, name in legacy_files:
+            os.remove(os.path.join(root, name))
+    finally:
+        pack.close()
+        legacy.close()
+    for suffix in (".digests", ".bloom", ".log"):
+        path = os.path.join(root, CHUNK_INDEX + suffix)
+        if os.path.exists(path):
+            os.remove(path)
+    return migrated, len(legacy_files)
+
+if __name__ == "__main__":
+    import storeconfig
+
+    parser = argparse.ArgumentParser(description="Chunk store maintenance.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate", help="convert a per-file storage directory to packfiles")
+    add_parser = subparsers.add_parser("add-shard", help="spread chunks over more storage roots")
+    add_parser.add_argument("roots", nargs="+", metavar="root")
+    rebalance_parser = subparsers.add_parser(
+        "rebalance", help="move chunks to the shards the hash ring places them on")
+    rebalance_parser.add_argument("--replicas", type=int, help="copies to keep of every chunk")
+    subparsers.add_parser("stats", help="show per-shard usage")
+    args = parser.parse_args()
+    config = storeconfig.load_store_config()
+
+    if args.command in ("add-shard", "rebalance"):
+        import metastore
+
+        shards = list(config["shards"]) or [STORAGE_DIR]
+        if args.command == "add-shard":
+            if not config["shards"]:
+                # The storage directory's chunks become the first shard, if it has any
+                current = detect_backend(STORAGE_DIR)
+                if current is None:
+                    shards = []
+                elif current != config["backend"]:
+                    print(f"Error: '{STORAGE_DIR}' holds a '{current}' store; "
+                          "run 'python chunkstore.py migrate' first.")
+                    sys.exit(1)
+            for root in args.roots:
+                if os.path.normpath(root) in map(os.path.normpath, shards):
+                    print(f"Error: '{root}' is already a shard.")
+                    sys.exit(1)
+                current = detect_backend(root)
+                if current not in (None, config["backend"]):
+                    print(f"Error: '{root}' holds a '{current}' store, not '{config['backend']}'.")
+                    sys.exit(1)
+            shards += args.roots
+        elif args.replicas is not None:
+            if args.replicas < 1:
+                parser.error("--replicas must be at least 1")
+            config["replicas"] = args.replicas
+        if config["replicas"] > len(shards):
+            print(f"Warning: {config['replicas']} replicas need as many shards; "
+                  f"keeping {len(shards)} copies.")
+        config["shards"] = shards
+        storeconfig.save_store_config(config)
+        store = open_chunk_store(config)
+        try:
+            print(f"Rebalancing {store.chunk_count()} chunks over {len(shards)} shards "
+                  f"with {config['replicas']} replicas...")
+            copied, removed = store.rebalance()
+            print(f"Copied {copied} chunks and removed {removed} misplaced copies.")
+            # Replicas change the stored size, so rebuild the counters
+            meta = metastore.MetaStore()
+            try:
+                meta.recount(store)
+            finally:
+                meta.close()
+        finally:
+            store.close()
+
+    elif args.command == "stats":
+        store = open_chunk_store(config)
+        try:
+            if isinstance(store, ShardedChunkStore):
+                for shard in store.shard_stats():
+                    print(f"'{shard['root']}': {shard['chunks']} chunks, "
+                          f"{shard['bytes'] / (1024 * 1024):.2f} MB, "
+                          f"{shard['dead_bytes'] / (1024 * 1024):.2f} MB dead, "
+                          f"{shard['free_bytes'] / (1024 ** 3):.1f} GB free")
+            else:
+                print(f"Store is not sharded: {store.chunk_count()} chunks, "
+                      f"{store.physical_size() / (1024 * 1024):.2f} MB in '{STORAGE_DIR}'.")
+        finally:
+            store.close()
+
+    elif args.command == "migrate":
+        if config["shards"]:
+            print("Error: Sharded stores cannot be migrated.")
+            sys.exit(1)
+        if config["backend"] == "pack":
+            print("Store already uses the pack backend.")
+            sys.exit(0)
+        print(f"Migrating '{STORAGE_DIR}' to packfiles...")
+        migrated, total = migrate_to_pack(STORAGE_DIR, config.get("segment_size", SEGMENT_SIZE))
+        config["backend"] = "pack"
+        storeconfig.save_store_config(config)
+        print(f"Migrated {migrated} of {total} chunks. Store now uses the pack backend.")
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import argparse
+import http.client
+import urllib.parse
+
+import chunker
+import ingest
+import metastore
+
+# Configuration
+SERVER_URL = "http://localhost:8000"
+BATCH_SIZE = 8 * 1024 * 1024  # Bytes of chunks sent per request
+COMMIT_ATTEMPTS = 3  # Chunks can be garbage collected between negotiation and commit
+TIMEOUT = 300
+
+class UploadError(RuntimeError):
+    pass
+
+class DedupClient:
+    """Reference client for the negotiated upload protocol.
+
+    Files are chunked and fingerprinted locally with the server's store
+    settings. Only the manifest goes over the wire at first, and then only
+    the chunks the server does not already have:
+
+        POST /api/uploads?name=NAME        manifest entries -> {"session", "missing"}
+        POST /api/uploads/ID/chunks        entry + bytes per chunk, repeated
+        POST /api/uploads/ID/commit        records the file atomically
+        DELETE /api/uploads/ID             gives up, freeing the sent chunks
+    """
+
+    def __init__(self, url=SERVER_URL, batch_size=BATCH_SIZE):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != "http" or not parts.hostname:
+            raise ValueError(f"Unsupported server URL '{url}'")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.batch_size = batch_size
+        self._settings = None
+
+    def _request(self, method, path, body=None):
+        """Send a request. Returns (status, decoded JSON body or None)."""
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=TIMEOUT)
+        try:
+            conn.request(method, path, body, {"Content-Type": "application/octet-stream"})
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            conn.close()
+        try:
+            return response.status, json.loads(data) if data else None
+        except ValueError:
+            return response.status, None
+
+    def settings(self):
+        """Return the server's chunking and fingerprint settings."""
+        if self._settings is None:
+            status, settings = self._request("GET", "/api/config")
+            if status != 200 or settings is None:
+                raise UploadError(f"Server did not return its settings (HTTP {status})")
+            self._settings = settings
+        return self._settings
+
+    def manifest(self, path):
+        """Chunk and fingerprint a local file. Returns (chunks, offsets).
+
+        chunks is the ordered (hex digest, length) list and offsets maps
+        each digest to the file offset of its first occurrence.
+        """
+        settings = self.settings()
+        split_chunks = chunker.get_chunker(settings)
+        fingerprint = ingest.get_fingerprint(settings["fingerprint"])
+        chunks = []
+        offsets = {}
+        offset = 0
+        with open(path, 'rb') as f:
+            for chunk in split_chunks(f):
+                chunk_hash = fingerprint(chunk)
+                chunks.append((chunk_hash, len(chunk)))
+                offsets.setdefault(chunk_hash, offset)
+                offset += len(chunk)
+        return chunks, offsets
+
+    def upload(self, path, name=None):
+        """Upload a file, sending only the chunks the server lacks.
+
+        Returns a dict with the file size, chunk counts, bytes sent and the
+        stored version, which is None if the server already had this
+        content under the name. Raises UploadError on failure.
+        """
+        name = name or os.path.basename(path)
+        chunks, offsets = self.manifest(path)
+        status, reply = self._request("POST", "/api/uploads?" + urllib.parse.urlencode({"name": name}),
+                                      metastore.pack_manifest(chunks))
+        if status != 200:
+            raise UploadError(f"Server refused the upload (HTTP {status})")
+        session = reply["session"]
+        missing = reply["missing"]
+        sizes = dict(chunks)
+        result = {"size": sum(length for _, length in chunks), "chunks": len(chunks),
+                  "missing_chunks": len(missing), "sent_bytes": 0}
+
+        try:
+            for _ in range(COMMIT_ATTEMPTS):
+                result["sent_bytes"] += self._send_chunks(path, session, missing, offsets, sizes)
+                status, reply = self._request("POST", f"/api/uploads/{session}/commit")
+                if status == 200:
+                    result["version"] = reply.get("version")
+                    return result
+                if status == 409 and reply and "missing" in reply:
+                    missing = reply["missing"]  # Removed by the garbage collector; resend
+                    continue
+                raise UploadError(f"Commit failed (HTTP {status})")
+            raise UploadError(f"{len(missing)} chunks are still missing after {COMMIT_ATTEMPTS} attempts")
+        except BaseException:
+            try:
+                self._request("DELETE", f"/api/uploads/{session}")
+            except OSError:
+                pass  # The server expires abandoned uploads itself
+            raise
+
+    def _send_chunks(self, path, session, missing, offsets, sizes):
+        """Send the missing chunks in batches of about batch_size bytes. Returns bytes sent."""
+        sent = 0
+        batch = []
+        batch_bytes = 0
+        with open(path, 'rb') as f:
+            # Read in file order so the local disk is scanned sequentially
+            for chunk_hash in sorted(missing, key=offsets.get):
+                f.seek(offsets[chunk_hash])
+                data = f.read(sizes[chunk_hash])
+                batch.append(metastore.MANIFEST_ENTRY.pack(bytes.fromhex(chunk_hash), len(data)))
+                batch.append(data)
+                batch_bytes += len(data)
+                if batch_bytes >= self.batch_size:
+                    sent += self._post_batch(session, batch)
+                    batch = []
+                    batch_bytes = 0
+        if batch:
+            sent += self._post_batch(session, batch)
+        return sent
+
+    def _post_batch(self, session, batch):
+        body = b"".join(batch)
+        status, reply = self._request("POST", f"/api/uploads/{session}/chunks", body)
+        if status != 200:
+            raise UploadError(f"Server rejected a chunk batch (HTTP {status})")
+        return len(body)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload files, sending only chunks the server lacks.")
+    parser.add_argument("paths", nargs="+", metavar="path")
+    parser.add_argument("--server", default=SERVER_URL, help="server URL")
+    parser.add_argument("--name", help="stored name, for a single file")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE // (1024 * 1024),
+                        help="MB of chunks sent per request")
+    args = parser.parse_args()
+    if args.name and len(args.paths) > 1:
+        parser.error("--name needs exactly one path")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+
+    client = DedupClient(args.server, args.batch_size * 1024 * 1024)
+    failed = 0
+    for path in args.paths:
+        name = args.name or os.path.basename(path)
+        try:
+            result = client.upload(path, name)
+        except (OSError, UploadError) as e:
+            print(f"Error uploading '{path}': {e}")
+            failed += 1
+            continue
+        if result["version"] is None:
+            print(f"File '{name}' is unchanged on the server.")
+            continue
+        version = f" as version {result['version']}" if result["version"] > 1 else ""
+        print(f"Uploaded '{name}'{version}: {result['missing_chunks']} of {result['chunks']} chunks were new, "
+              f"sent {result['sent_bytes'] / (1024 * 1024):.2f} MB for "
+              f"{result['size'] / (1024 * 1024):.2f} MB.")
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,99 @@
+import bz2
+import lzma
+import math
+import zlib
+import struct
+from collections import Counter
+
+# Configuration
+DEFAULT_LEVELS = {"zlib": 6, "lzma": 6, "bz2": 9}
+ENTROPY_SAMPLE = 1024  # Bytes sampled to estimate a chunk's entropy
+ENTROPY_LIMIT = 7.5  # Bits per byte above which a chunk is stored raw
+MIN_SAVING = 0.05  # Keep the chunk raw unless compression saves 5%
+
+# Codec ids are stored with every chunk; never renumber them. Delta chunks
+# are written by the similarity layer and cannot be chosen as a codec.
+CODECS = ("none", "zlib", "lzma", "bz2", "delta")
+CHOICES = CODECS[:4]
+DELTA = 4
+
+# Delta payload header: chain depth, digest of the base chunk
+DELTA_HEADER = struct.Struct("<B32s")
+DELTA_WINDOW = 32 * 1024  # Deflate can only refer back this far into the base
+
+_COMPRESSORS = {
+    1: lambda data, level: zlib.compress(data, level),
+    2: lambda data, level: lzma.compress(data, preset=level),
+    3: lambda data, level: bz2.compress(data, level),
+}
+
+_DECOMPRESSORS = {
+    1: zlib.decompress,
+    2: lzma.decompress,
+    3: bz2.decompress,
+}
+
+_LEVEL_RANGES = {"zlib": range(0, 10), "lzma": range(0, 10), "bz2": range(1, 10)}
+
+def codec_id(name):
+    """Return the stored id of a codec name."""
+    if name not in CHOICES:
+        raise ValueError(f"Unknown compression codec '{name}'")
+    return CODECS.index(name)
+
+def codec_level(name, level=None):
+    """Return the level to use for a codec, validating an explicit one."""
+    if name == "none":
+        return 0
+    if level is None:
+        return DEFAULT_LEVELS[name]
+    if level not in _LEVEL_RANGES[name]:
+        levels = _LEVEL_RANGES[name]
+        raise ValueError(f"{name} levels range from {levels[0]} to {levels[-1]}")
+    return level
+
+def sample_entropy(data):
+    """Estimate the Shannon entropy of data in bits per byte from a sample."""
+    if len(data) > ENTROPY_SAMPLE:
+        step = len(data) // ENTROPY_SAMPLE
+        data = data[::step][:ENTROPY_SAMPLE]
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(n / total * math.log2(n / total) for n in Counter(data).values())
+
+def encode(data, codec, level):
+    """Compress a chunk. Returns (codec, payload), with codec 0 if stored raw."""
+    if not codec or sample_entropy(data) > ENTROPY_LIMIT:
+        return 0, data
+    payload = _COMPRESSORS[codec](data, level)
+    if len(payload) > len(data) * (1 - MIN_SAVING):
+        return 0, data
+    return codec, payload
+
+def decode(codec, payload):
+    """Return the raw bytes of a stored chunk payload other than a delta."""
+    if not codec:
+        return payload
+    try:
+        return _DECOMPRESSORS[codec](payload)
+    except KeyError:
+        raise ValueError(f"Unknown compression codec id {codec}")
+
+def encode_delta(data, base, base_digest, depth):
+    """Encode a chunk as a delta payload against a similar base chunk.
+
+    The chunk is deflated with the base as a preset dictionary, so the
+    stretches it shares with the base become back-references.
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=base[-DELTA_WINDOW:])
+    return DELTA_HEADER.pack(depth, base_digest) + compressor.compress(data) + compressor.flush()
+
+def delta_header(payload):
+    """Return (depth, base digest) of a delta payload."""
+    return DELTA_HEADER.unpack_from(payload)
+
+def decode_delta(payload, base):
+    """Return the raw bytes of a delta payload given its decoded base."""
+    decompressor = zlib.decompressobj(-15, zdict=base[-DELTA_WINDOW:])
+    return decompressor.decompress(payload[DELTA_HEADER.size:]) + decompressor.flush()
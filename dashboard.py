@@ -1,230 +1,298 @@
 import http.server
 import socketserver
-import json
 import os
+import urllib.parse
+from collections import OrderedDict
+
+import metastore
+import snapshot
 
 # Configuration
 PORT = 8000
-STORAGE_DIR = "storage"
-METADATA_FILE = "metadata.json"
-CHUNK_SIZE = 4096
+METADATA_DB = "metadata.db"
+PAGE_SIZE = snapshot.PAGE_SIZE  # Files listed per page
+PAGE_CACHE = snapshot.PAGE_CACHE  # Rendered pages kept while the counters are unchanged
 
-class DashboardHandler(http.server.BaseHTTPRequestHandler):
-    def get_stats(self):
-        if not os.path.exists(METADATA_FILE):
-            return {"files": {}, "logical": 0, "actual": 0, "saved": 0, "efficiency": 0}
-        
-        with open(METADATA_FILE, 'r') as f:
-            metadata = json.load(f)
-            
-        total_logical_size = 0
-        for hashes in metadata.values():
-            total_logical_size += len(hashes) * CHUNK_SIZE
-            
-        actual_storage_size = 0
-        if os.path.exists(STORAGE_DIR):
-            for chunk_name in os.listdir(STORAGE_DIR):
-                actual_storage_size += os.path.getsize(os.path.join(STORAGE_DIR, chunk_name))
-                
-        saved_space = total_logical_size - actual_storage_size
-        efficiency = (saved_space / total_logical_size * 100) if total_logical_size > 0 else 0
-        
-        return {
-            "files": metadata,
-            "logical": total_logical_size,
-            "actual": actual_storage_size,
-            "saved": saved_space,
-            "efficiency": efficiency
-        }
+_meta = None
+_counters = None  # Counters the cached pages were rendered from
+_pages = OrderedDict()  # Page number -> (html, etag)
+
+def get_metastore():
+    """Return the metadata store, or None before anything was stored."""
+    global _meta
+    if _meta is None and os.path.exists(METADATA_DB):
+        _meta = metastore.MetaStore(METADATA_DB)
+    return _meta
+
+def cached_page(page):
+    """Return (html, etag) of a dashboard page, rendering it only if the catalogue changed.
+
+    Every ingest and delete moves the running counters, so a page rendered
+    from the same counters is still current.
+    """
+    global _counters
+    meta = get_metastore()
+    counters = meta.get_stats() if meta is not None else None
+    if counters != _counters:
+        _pages.clear()
+        _counters = counters
+    cached = _pages.get(page)
+    if cached is None:
+        body = render_page(get_stats(meta, counters, page))
+        cached = _pages[page] = (body, snapshot.etag(body))
+        while len(_pages) > PAGE_CACHE:
+            _pages.popitem(last=False)
+    else:
+        _pages.move_to_end(page)
+    return cached
+
+def get_stats(meta, counters, page=0):
+    if meta is None:
+        return {"files": [], "logical": 0, "actual": 0, "saved": 0, "efficiency": 0,
+                "dedup_ratio": 1, "compression_ratio": 1, "page": 0, "pages": 1}
+
+    pages = max(1, -(-counters["files"] // PAGE_SIZE))
+    page = min(page, pages - 1)
+    files = meta.list_files_page(page * PAGE_SIZE, PAGE_SIZE)
+    total_logical_size = counters["logical_bytes"]
+    unique_size = counters["unique_bytes"]
+    actual_storage_size = counters["physical_bytes"]
 
+    saved_space = total_logical_size - actual_storage_size
+    efficiency = (saved_space / total_logical_size * 100) if total_logical_size > 0 else 0
+
+    return {
+        "files": files,
+        "logical": total_logical_size,
+        "actual": actual_storage_size,
+        "saved": saved_space,
+        "efficiency": efficiency,
+        "dedup_ratio": total_logical_size / unique_size if unique_size > 0 else 1,
+        "compression_ratio": unique_size / actual_storage_size if actual_storage_size > 0 else 1,
+        "page": page,
+        "pages": pages
+    }
+
+def render_page(stats):
+    page, pages = stats['page'], stats['pages']
+    pager = f"Page {page + 1} of {pages}"
+    if page > 0:
+        pager = f"<a href='/?page={page}'>&larr; Previous</a> &middot; " + pager
+    if page + 1 < pages:
+        pager += f" &middot; <a href='/?page={page + 2}'>Next &rarr;</a>"
+    html = f"""
+        <!DOCTYPE html>
+        <html lang="en">
+        <head>
+            <meta charset="UTF-8">
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <title>Deduplication Dashboard</title>
+            <link href="https://fonts.googleapis.com/css2?family=Inter:wght@300;400;600;700&display=swap" rel="stylesheet">
+            <style>
+                :root {{
+                    --primary: #6366f1;
+                    --bg: #0f172a;
+                    --card: #1e293b;
+                    --text: #f8fafc;
+                    --text-dim: #94a3b8;
+                    --accent: #38bdf8;
+                }}
+                body {{
+                    font-family: 'Inter', sans-serif;
+                    background-color: var(--bg);
+                    color: var(--text);
+                    margin: 0;
+                    padding: 40px;
+                    display: flex;
+                    flex-direction: column;
+                    align-items: center;
+                }}
+                .container {{
+                    max-width: 1000px;
+                    width: 100%;
+                }}
+                header {{
+                    margin-bottom: 40px;
+                    text-align: center;
+                }}
+                h1 {{
+                    font-size: 2.5rem;
+                    font-weight: 700;
+                    background: linear-gradient(to right, #818cf8, #c084fc);
+                    -webkit-background-clip: text;
+                    -webkit-text-fill-color: transparent;
+                    margin-bottom: 10px;
+                }}
+                .stats-grid {{
+                    display: grid;
+                    grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
+                    gap: 20px;
+                    margin-bottom: 40px;
+                }}
+                .card {{
+                    background: var(--card);
+                    border: 1px solid rgba(255,255,255,0.1);
+                    border-radius: 16px;
+                    padding: 24px;
+                    box-shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.1);
+                    transition: transform 0.2s;
+                }}
+                .card:hover {{
+                    transform: translateY(-5px);
+                    border-color: var(--primary);
+                }}
+                .card-label {{
+                    font-size: 0.875rem;
+                    color: var(--text-dim);
+                    margin-bottom: 8px;
+                    text-transform: uppercase;
+                    letter-spacing: 0.05em;
+                }}
+                .card-value {{
+                    font-size: 1.5rem;
+                    font-weight: 600;
+                }}
+                .efficiency-bar-container {{
+                    width: 100%;
+                    height: 12px;
+                    background: #334155;
+                    border-radius: 6px;
+                    margin-top: 20px;
+                    overflow: hidden;
+                }}
+                .efficiency-bar {{
+                    height: 100%;
+                    background: linear-gradient(90deg, var(--primary), var(--accent));
+                    width: {stats['efficiency']}%;
+                    transition: width 1s ease-out;
+                }}
+                table {{
+                    width: 100%;
+                    border-collapse: collapse;
+                    background: var(--card);
+                    border-radius: 16px;
+                    overflow: hidden;
+                    border: 1px solid rgba(255,255,255,0.1);
+                }}
+                th, td {{
+                    padding: 16px 24px;
+                    text-align: left;
+                }}
+                th {{
+                    background: rgba(255,255,255,0.05);
+                    font-weight: 600;
+                    color: var(--text-dim);
+                    font-size: 0.75rem;
+                    text-transform: uppercase;
+                    letter-spacing: 0.05em;
+                }}
+                tr:not(:last-child) {{
+                    border-bottom: 1px solid rgba(255,255,255,0.05);
+                }}
+                .status-active {{
+                    color: #4ade80;
+                    background: rgba(74, 222, 128, 0.1);
+                    padding: 4px 12px;
+                    border-radius: 12px;
+                    font-size: 0.75rem;
+                }}
+                .refresh-btn {{
+                    background: var(--primary);
+                    color: white;
+                    border: none;
+                    padding: 10px 20px;
+                    border-radius: 8px;
+                    cursor: pointer;
+                    font-weight: 600;
+                    margin-bottom: 20px;
+                    transition: filter 0.2s;
+                }}
+                .pager {{
+                    color: var(--text-dim);
+                    text-align: center;
+                }}
+                .pager a {{
+                    color: var(--accent);
+                }}
+                .refresh-btn:hover {{
+                    filter: brightness(1.1);
+                }}
+            </style>
+        </head>
+        <body>
+            <div class="container">
+                <header>
+                    <h1>Intelligent Deduplication Dashboard</h1>
+                    <p style="color: var(--text-dim)">Real-time storage optimization statistics</p>
+                </header>
+
+                <div class="stats-grid">
+                    <div class="card">
+                        <div class="card-label">Logical Size</div>
+                        <div class="card-value">{stats['logical'] / 1024:.2f} KB</div>
+                    </div>
+                    <div class="card">
+                        <div class="card-label">Actual Stored</div>
+                        <div class="card-value">{stats['actual'] / 1024:.2f} KB</div>
+                    </div>
+                    <div class="card">
+                        <div class="card-label">Space Saved</div>
+                        <div class="card-value">{stats['saved'] / 1024:.2f} KB</div>
+                    </div>
+                    <div class="card">
+                        <div class="card-label">Efficiency Ratio</div>
+                        <div class="card-value">{stats['efficiency']:.1f}%</div>
+                        <div class="efficiency-bar-container">
+                            <div class="efficiency-bar"></div>
+                        </div>
+                        <div class="card-label">Dedup {stats['dedup_ratio']:.2f}x &middot; Compression {stats['compression_ratio']:.2f}x</div>
+                    </div>
+                </div>
+
+                <button class="refresh-btn" onclick="window.location.reload()">Refresh Data</button>
+
+                <table>
+                    <thead>
+                        <tr>
+                            <th>Filename</th>
+                            <th>Total Chunks</th>
+                            <th>Version</th>
+                            <th>Status</th>
+                        </tr>
+                    </thead>
+                    <tbody>
+                        {"".join([f"<tr><td>{f}</td><td>{chunks}</td><td>{version}</td><td><span class='status-active'>Optimized</span></td></tr>" for f, size, chunks, version in stats['files']])}
+                    </tbody>
+                </table>
+                <p class="pager">{pager}</p>
+            </div>
+        </body>
+        </html>
+        """
+    return html.encode('utf-8')
+
+class DashboardHandler(http.server.BaseHTTPRequestHandler):
     def do_GET(self):
-        if self.path == '/':
+        path, _, query = self.path.partition('?')
+        if path == '/':
+            try:
+                page = max(0, int(urllib.parse.parse_qs(query).get('page', ['1'])[0]) - 1)
+            except ValueError:
+                self.send_error(400, "Bad Request: Invalid page")
+                return
+            body, tag = cached_page(page)
+            if snapshot.etag_matches(self.headers.get('If-None-Match'), tag):
+                self.send_response(304)
+                self.send_header('ETag', tag)
+                self.end_headers()
+                return
             self.send_response(200)
             self.send_header('Content-type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', tag)
+            self.send_header('Cache-Control', 'no-cache')
             self.end_headers()
-            
-            stats = self.get_stats()
-            
-            html = f"""
-            <!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>Deduplication Dashboard</title>
-                <link href="https://fonts.googleapis.com/css2?family=Inter:wght@300;400;600;700&display=swap" rel="stylesheet">
-                <style>
-                    :root {{
-                        --primary: #6366f1;
-                        --bg: #0f172a;
-                        --card: #1e293b;
-                        --text: #f8fafc;
-                        --text-dim: #94a3b8;
-                        --accent: #38bdf8;
-                    }}
-                    body {{
-                        font-family: 'Inter', sans-serif;
-                        background-color: var(--bg);
-                        color: var(--text);
-                        margin: 0;
-                        padding: 40px;
-                        display: flex;
-                        flex-direction: column;
-                        align-items: center;
-                    }}
-                    .container {{
-                        max-width: 1000px;
-                        width: 100%;
-                    }}
-                    header {{
-                        margin-bottom: 40px;
-                        text-align: center;
-                    }}
-                    h1 {{
-                        font-size: 2.5rem;
-                        font-weight: 700;
-                        background: linear-gradient(to right, #818cf8, #c084fc);
-                        -webkit-background-clip: text;
-                        -webkit-text-fill-color: transparent;
-                        margin-bottom: 10px;
-                    }}
-                    .stats-grid {{
-                        display: grid;
-                        grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
-                        gap: 20px;
-                        margin-bottom: 40px;
-                    }}
-                    .card {{
-                        background: var(--card);
-                        border: 1px solid rgba(255,255,255,0.1);
-                        border-radius: 16px;
-                        padding: 24px;
-                        box-shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.1);
-                        transition: transform 0.2s;
-                    }}
-                    .card:hover {{
-                        transform: translateY(-5px);
-                        border-color: var(--primary);
-                    }}
-                    .card-label {{
-                        font-size: 0.875rem;
-                        color: var(--text-dim);
-                        margin-bottom: 8px;
-                        text-transform: uppercase;
-                        letter-spacing: 0.05em;
-                    }}
-                    .card-value {{
-                        font-size: 1.5rem;
-                        font-weight: 600;
-                    }}
-                    .efficiency-bar-container {{
-                        width: 100%;
-                        height: 12px;
-                        background: #334155;
-                        border-radius: 6px;
-                        margin-top: 20px;
-                        overflow: hidden;
-                    }}
-                    .efficiency-bar {{
-                        height: 100%;
-                        background: linear-gradient(90deg, var(--primary), var(--accent));
-                        width: {stats['efficiency']}%;
-                        transition: width 1s ease-out;
-                    }}
-                    table {{
-                        width: 100%;
-                        border-collapse: collapse;
-                        background: var(--card);
-                        border-radius: 16px;
-                        overflow: hidden;
-                        border: 1px solid rgba(255,255,255,0.1);
-                    }}
-                    th, td {{
-                        padding: 16px 24px;
-                        text-align: left;
-                    }}
-                    th {{
-                        background: rgba(255,255,255,0.05);
-                        font-weight: 600;
-                        color: var(--text-dim);
-                        font-size: 0.75rem;
-                        text-transform: uppercase;
-                        letter-spacing: 0.05em;
-                    }}
-                    tr:not(:last-child) {{
-                        border-bottom: 1px solid rgba(255,255,255,0.05);
-                    }}
-                    .status-active {{
-                        color: #4ade80;
-                        background: rgba(74, 222, 128, 0.1);
-                        padding: 4px 12px;
-                        border-radius: 12px;
-                        font-size: 0.75rem;
-                    }}
-                    .refresh-btn {{
-                        background: var(--primary);
-                        color: white;
-                        border: none;
-                        padding: 10px 20px;
-                        border-radius: 8px;
-                        cursor: pointer;
-                        font-weight: 600;
-                        margin-bottom: 20px;
-                        transition: filter 0.2s;
-                    }}
-                    .refresh-btn:hover {{
-                        filter: brightness(1.1);
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <header>
-                        <h1>Intelligent Deduplication Dashboard</h1>
-                        <p style="color: var(--text-dim)">Real-time storage optimization statistics</p>
-                    </header>
-
-                    <div class="stats-grid">
-                        <div class="card">
-                            <div class="card-label">Logical Size</div>
-                            <div class="card-value">{stats['logical'] / 1024:.2f} KB</div>
-                        </div>
-                        <div class="card">
-                            <div class="card-label">Actual Stored</div>
-                            <div class="card-value">{stats['actual'] / 1024:.2f} KB</div>
-                        </div>
-                        <div class="card">
-                            <div class="card-label">Space Saved</div>
-                            <div class="card-value">{stats['saved'] / 1024:.2f} KB</div>
-                        </div>
-                        <div class="card">
-                            <div class="card-label">Efficiency Ratio</div>
-                            <div class="card-value">{stats['efficiency']:.1f}%</div>
-                            <div class="efficiency-bar-container">
-                                <div class="efficiency-bar"></div>
-                            </div>
-                        </div>
-                    </div>
-
-                    <button class="refresh-btn" onclick="window.location.reload()">Refresh Data</button>
-
-                    <table>
-                        <thead>
-                            <tr>
-                                <th>Filename</th>
-                                <th>Total Chunks</th>
-                                <th>Status</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                            {"".join([f"<tr><td>{f}</td><td>{len(h)}</td><td><span class='status-active'>Optimized</span></td></tr>" for f, h in stats['files'].items()])}
-                        </tbody>
-                    </table>
-                </div>
-            </body>
-            </html>
-            """
-            self.wfile.write(html.encode('utf-8'))
+            self.wfile.write(body)
         else:
             self.send_error(404)
 
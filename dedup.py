@@ -1,94 +1,217 @@
 import os
-import hashlib
-import json
-import sys
+import time
+import argparse
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor
+
+import chunkstore
+import ingest
+import metastore
+import storeconfig
 
 # Configuration
-CHUNK_SIZE = 4096  # 4KB
 STORAGE_DIR = "storage"
-METADATA_FILE = "metadata.json"
+METADATA_DB = "metadata.db"
+JOBS = os.cpu_count() or 1  # Worker processes for bulk ingest
+BATCH_FILES = 256  # Files recorded per metadata transaction
+
+_worker_store = None
+_worker_meta = None
+_worker_config = None
 
 def ensure_directories():
     """Ensure required directories exist."""
     if not os.path.exists(STORAGE_DIR):
         os.makedirs(STORAGE_DIR)
 
-def get_file_hash(data):
-    """Calculate SHA-256 hash of data."""
-    return hashlib.sha256(data).hexdigest()
-
-def load_metadata():
-    """Load metadata from JSON file."""
-    if os.path.exists(METADATA_FILE):
-        try:
-            with open(METADATA_FILE, 'r') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
-            return {}
-    return {}
-
-def save_metadata(metadata):
-    """Save metadata to JSON file."""
-    with open(METADATA_FILE, 'w') as f:
-        json.dump(metadata, f, indent=4)
-
-def deduplicate_file(file_path):
-    """Chunk file, hash chunks, and store unique chunks."""
+def deduplicate_file(file_path, config=None):
+    """Chunk file, hash chunks, and store unique chunks.
+
+    A file whose name is taken becomes that file's new version, unless its
+    content is unchanged.
+    """
     if not os.path.exists(file_path):
         print(f"Error: File '{file_path}' not found.")
         return
 
     filename = os.path.basename(file_path)
-    metadata = load_metadata()
-
-    if filename in metadata:
-        print(f"File '{filename}' has already been processed. Skipping.")
-        return
-
     ensure_directories()
-    
-    chunk_hashes = []
-    logical_size = 0
-    
+    if config is None:
+        config = storeconfig.load_store_config()
+    store = chunkstore.open_chunk_store(config, STORAGE_DIR)
+    meta = metastore.open_metastore(store, METADATA_DB)
+
     try:
         with open(file_path, 'rb') as f:
-            while True:
-                chunk = f.read(CHUNK_SIZE)
-                if not chunk:
-                    break
-                
-                logical_size += len(chunk)
-                chunk_hash = get_file_hash(chunk)
-                chunk_hashes.append(chunk_hash)
-                
-                chunk_path = os.path.join(STORAGE_DIR, chunk_hash)
-                if not os.path.exists(chunk_path):
-                    with open(chunk_path, 'wb') as chunk_file:
-                        chunk_file.write(chunk)
+            chunks, new_chunks, new_bytes, new_raw_bytes, digest = ingest.ingest_file(
+                f, config, store, meta)
         
-        metadata[filename] = chunk_hashes
-        save_metadata(metadata)
+        version = meta.add_file(filename, chunks, new_chunks, new_bytes, new_raw_bytes, store, digest)
+        if version is None:
+            print(f"File '{filename}' is unchanged. Skipping.")
+            return
         
-        print(f"Successfully processed '{filename}'.")
-        display_stats(metadata)
+        if version > 1:
+            print(f"Successfully processed '{filename}' as version {version}.")
+        else:
+            print(f"Successfully processed '{filename}'.")
+        display_stats(meta)
         
     except IOError as e:
         print(f"Error reading file: {e}")
+    except metastore.MissingChunkError as e:
+        # Count the chunks this ingest wrote and leave them to the garbage collector
+        meta.add_chunks(chunks, new_chunks, new_bytes, new_raw_bytes, store)
+        print(f"Error: {e}")
+    finally:
+        meta.close()
+        store.close()
+
+def iter_files(paths):
+    """Yield (path, name) for every file under the given files and directories.
+
+    Names are paths relative to the parent of each argument, with '/'
+    separators, so a file keeps its basename and a directory's files are
+    prefixed with the directory name. Two arguments can therefore give the
+    same name, which deduplicate_paths() refuses.
+    """
+    for path in paths:
+        base = os.path.dirname(os.path.abspath(path))
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    file_path = os.path.join(dirpath, filename)
+                    if os.path.isfile(file_path):
+                        yield file_path, _file_name(file_path, base)
+        elif os.path.isfile(path):
+            yield path, _file_name(path, base)
+        else:
+            print(f"Error: File '{path}' not found.")
+
+def _file_name(path, base):
+    return os.path.relpath(os.path.abspath(path), base).replace(os.sep, "/")
+
+def _init_worker(config):
+    """Open a chunk store per worker process; stores are safe across processes.
+
+    Workers also read the metadata database to find identical stored files.
+    Both are closed when the worker exits, which compacts the chunk index
+    and removes the worker's ingest journal once its chunks are recorded.
+    """
+    global _worker_store, _worker_meta, _worker_config
+    ingest.HASH_WORKERS = 1  # Parallelism comes from the processes
+    _worker_config = config
+    _worker_store = chunkstore.open_chunk_store(config, STORAGE_DIR)
+    _worker_meta = metastore.MetaStore(METADATA_DB)
+    # Pool workers leave through os._exit, which skips atexit handlers
+    multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
 
-def display_stats(metadata):
-    """Calculate and display deduplication statistics."""
-    total_logical_size = 0
-    for filename, hashes in metadata.items():
-        # Note: This is an approximation as we don't store individual chunk sizes in metadata
-        # for this simple version, but we know most are CHUNK_SIZE.
-        # A more accurate way would be to track the size of each file during dedup.
-        total_logical_size += len(hashes) * CHUNK_SIZE 
-
-    # Calculate actual storage size
-    actual_storage_size = 0
-    if os.path.exists(STORAGE_DIR):
-        for chunk_name in os.listdir(STORAGE_DIR):
-            actual_storage_size += os.path.getsize(os.path.join(STORAGE_DIR, chunk_name))
+def _close_worker():
+    _worker_meta.close()
+    _worker_store.close()
+
+def _ingest_worker(item):
+    path, name = item
+    try:
+        with open(path, 'rb') as f:
+            result = ingest.ingest_file(f, _worker_config, _worker_store, _worker_meta)
+    except IOError as e:
+        return name, None, str(e)
+    return name, result, None
+
+def deduplicate_paths(paths, config=None, jobs=JOBS, batch_files=BATCH_FILES):
+    """Ingest every file under the given paths using a pool of processes.
+
+    Files are chunked, hashed and stored by the workers, and the parent
+    records finished files in one metadata transaction per batch. Files
+    already stored under their name get a new version if they changed.
+    """
+    ensure_directories()
+    if config is None:
+        config = storeconfig.load_store_config()
+    store = chunkstore.open_chunk_store(config, STORAGE_DIR)
+    meta = metastore.open_metastore(store, METADATA_DB)
+
+    try:
+        todo = []
+        seen = {}
+        for path, name in iter_files(paths):
+            other = seen.get(name)
+            if other is None:
+                seen[name] = path
+                todo.append((path, name))
+                continue
+            if os.path.samefile(other, path):
+                continue  # Given twice
+            # Ingesting both would record one as a version of the other
+            print(f"Error: '{other}' and '{path}' would both be stored as '{name}'. "
+                  "Ingest them separately or rename one.")
+            return
+        skipped = 0
+        sizes = {name: os.path.getsize(path) for path, name in todo}
+        total_bytes = sum(sizes.values())
+        print(f"Ingesting {len(todo)} files ({total_bytes / (1024 * 1024):.1f} MB) "
+              f"with {jobs} workers...")
+
+        start = time.time()
+        done = failed = 0
+        done_bytes = 0
+        batch = []
+
+        def commit():
+            nonlocal skipped, failed
+            try:
+                skipped += meta.add_files(batch, store).count(None)
+            except metastore.MissingChunkError:
+                # Record the rest of the batch without the affected files
+                for entry in batch:
+                    try:
+                        skipped += meta.add_files([entry], store).count(None)
+                    except metastore.MissingChunkError as e:
+                        _, chunks, new_chunks, new_bytes, new_raw_bytes, _ = entry
+                        meta.add_chunks(chunks, new_chunks, new_bytes, new_raw_bytes, store)
+                        failed += 1
+                        print(f"Error: {e}")
+            batch.clear()
+            elapsed = time.time() - start
+            print(f"  {done}/{len(todo)} files, {done_bytes / (1024 * 1024):.1f} MB, "
+                  f"{done_bytes / (1024 * 1024) / elapsed if elapsed else 0:.1f} MB/s")
+
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(config,)) as pool:
+            for name, result, error in pool.map(_ingest_worker, todo):
+                done += 1
+                if error is not None:
+                    failed += 1
+                    print(f"Error reading '{name}': {error}")
+                    continue
+                done_bytes += sizes[name]
+                batch.append((name,) + result)
+                if len(batch) >= batch_files:
+                    commit()
+        if batch:
+            commit()
+        # The workers have exited, so their journals can be cleared now
+        # that every file is recorded. Chunks of files that failed are
+        # left to the garbage collector.
+        store.journal.recover(meta, store)
+
+        elapsed = time.time() - start
+        print(f"\nIngested {done - failed} files ({done_bytes / (1024 * 1024):.1f} MB) in {elapsed:.2f}s"
+              f" - {done_bytes / (1024 * 1024) / elapsed if elapsed else 0:.1f} MB/s,"
+              f" {skipped} unchanged, {failed} failed.")
+        display_stats(meta)
+    finally:
+        meta.close()
+        store.close()
+
+def display_stats(meta):
+    """Display deduplication statistics from the running counters."""
+    stats = meta.get_stats()
+    total_logical_size = stats["logical_bytes"]
+    unique_size = stats["unique_bytes"]
+    actual_storage_size = stats["physical_bytes"]
 
     saved_space = total_logical_size - actual_storage_size
     
@@ -96,12 +219,31 @@ def display_stats(metadata):
     print(f"Total Logical Data Size: {total_logical_size / 1024:.2f} KB")
     print(f"Actual Stored Size:     {actual_storage_size / 1024:.2f} KB")
     print(f"Space Saved:            {saved_space / 1024:.2f} KB")
+    print(f"Files / Unique Chunks:  {stats['files']} / {stats['unique_chunks']}")
     if total_logical_size > 0:
         print(f"Efficiency:             {(saved_space / total_logical_size) * 100:.2f}%")
+    if unique_size > 0 and actual_storage_size > 0:
+        print(f"Dedup Ratio:            {total_logical_size / unique_size:.2f}x")
+        print(f"Compression Ratio:      {unique_size / actual_storage_size:.2f}x")
     print("-----------------------------------\n")
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python dedup.py <file_path>")
+    parser = argparse.ArgumentParser(description="Deduplicate files into the chunk store.")
+    parser.add_argument("paths", nargs="+", metavar="path",
+                        help="file to deduplicate, or a directory to ingest recursively")
+    parser.add_argument("--jobs", type=int, default=JOBS,
+                        help="worker processes for bulk ingest")
+    parser.add_argument("--batch-size", type=int, default=BATCH_FILES,
+                        help="files recorded per metadata transaction")
+    storeconfig.add_store_arguments(parser)
+    args = parser.parse_args()
+    try:
+        config = storeconfig.apply_store_arguments(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.jobs < 1 or args.batch_size < 1:
+        parser.error("--jobs and --batch-size must be at least 1")
+    if len(args.paths) == 1 and os.path.isfile(args.paths[0]):
+        deduplicate_file(args.paths[0], config)
     else:
-        deduplicate_file(sys.argv[1])
+        deduplicate_paths(args.paths, config, args.jobs, args.batch_size)
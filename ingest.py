@@ -0,0 +1,252 @@
+import os
+import queue
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import chunker
+import compression
+import journal
+import metrics
+import similarity
+
+# Configuration
+BATCH_SIZE = 8 * 1024 * 1024  # Bytes of chunks fingerprinted per batch
+HASH_WORKERS = os.cpu_count() or 1
+WRITE_QUEUE_DEPTH = 4  # Batches of new chunks waiting for the writer
+READ_SIZE = 1024 * 1024  # Bytes read at a time when digesting a whole file
+
+# Every fingerprint is 256 bits so digests fit the manifest and pack index
+FINGERPRINTS = {
+    "sha256": lambda data: hashlib.sha256(data).hexdigest(),
+    "blake2b": lambda data: hashlib.blake2b(data, digest_size=32).hexdigest(),
+}
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+def get_fingerprint(name):
+    """Return the function mapping chunk bytes to a hex digest for an algorithm."""
+    try:
+        return FINGERPRINTS[name]
+    except KeyError:
+        raise ValueError(f"Unknown fingerprint algorithm '{name}'")
+
+def content_digest(f):
+    """Return the SHA-256 of a binary file's content from its current position."""
+    digest = hashlib.sha256()
+    with metrics.timer("dedup_ingest_stage_seconds", stage="digest"):
+        for block in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(block)
+    return digest.digest()
+
+def get_hash_pool():
+    """Return the process-wide thread pool used for fingerprinting."""
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash")
+    return _hash_pool
+
+def _batches(chunks, batch_size):
+    batch = []
+    size = 0
+    for chunk in chunks:
+        batch.append(chunk)
+        size += len(chunk)
+        if size >= batch_size:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+def _hash_slice(fingerprint, chunks):
+    with metrics.timer("dedup_ingest_stage_seconds", stage="hash"):
+        return [fingerprint(chunk) for chunk in chunks]
+
+def _encode_slice(codec, level, store, chunks):
+    """Compress new chunks, or delta encode them when the store has a similarity index."""
+    records = []
+    with metrics.timer("dedup_ingest_stage_seconds", stage="encode"):
+        for chunk_hash, data in chunks:
+            supers, depth, payload = None, 0, None
+            if store.similarity is not None:
+                supers, depth, payload = similarity.encode_delta(store, data,
+                                                                  chunk_hash=chunk_hash)
+            if payload is not None:
+                records.append((chunk_hash, len(data), compression.DELTA, payload, supers, depth))
+            else:
+                records.append((chunk_hash, len(data)) + compression.encode(data, codec, level)
+                               + (supers, depth))
+    return records
+
+def _submit_slices(pool, func, items, *args):
+    """Split items into one contiguous slice per worker and run func on each."""
+    slices = min(HASH_WORKERS, len(items))
+    step = -(-len(items) // slices)
+    return [pool.submit(func, *args, items[i:i + step])
+            for i in range(0, len(items), step)]
+
+class ChunkWriter(threading.Thread):
+    """Background thread that stores new chunks while ingest continues.
+
+    Queue items are lists of futures from the hash pool, each resolving to
+    (hex digest, raw length, codec, payload, super-features, delta depth)
+    records. Sketched chunks are added to the similarity index once stored.
+    """
+
+    def __init__(self, store):
+        super().__init__(daemon=True)
+        self.store = store
+        self.queue = queue.Queue(WRITE_QUEUE_DEPTH)
+        self.new_chunks = 0
+        self.new_bytes = 0
+        self.new_raw_bytes = 0
+        self.error = None
+        self.start()
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue  # Keep draining so the producer never blocks
+            try:
+                for future in batch:
+                    records = future.result()
+                    with metrics.timer("dedup_ingest_stage_seconds", stage="write"):
+                        self.write(records)
+            except Exception as e:
+                self.error = e
+
+    def write(self, records):
+        if self.store.journal is not None:
+            self.store.journal.log([record[0] for record in records])
+        # Sharded stores write to their shards in parallel
+        written = self.store.put_many([(chunk_hash, payload, codec)
+                                       for chunk_hash, _, codec, payload, _, _ in records])
+        for (chunk_hash, size, codec, payload, supers, depth), copies in zip(records, written):
+            if copies:
+                self.new_chunks += 1
+                self.new_bytes += len(payload) * copies
+                self.new_raw_bytes += size
+                if supers is not None:
+                    self.store.similarity.add(supers, bytes.fromhex(chunk_hash), depth)
+
+    def finish(self):
+        """Wait for queued writes and re-raise any write error."""
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+def _codec_settings(config):
+    codec_name = config.get("compression", "none")
+    return (compression.codec_id(codec_name),
+            compression.codec_level(codec_name, config.get("compression_level")))
+
+def store_chunks(chunks, config, store):
+    """Compress and store chunks that were split and fingerprinted elsewhere.
+
+    chunks is a list of (hex digest, data) pairs whose digests the caller
+    has checked. Chunks already in the store are skipped. They are not
+    flushed; the commit that records them does that. Returns (new_chunks,
+    new_bytes, new_raw_bytes) as for ingest_stream.
+    """
+    codec, level = _codec_settings(config)
+    new = [(chunk_hash, data) for chunk_hash, data in chunks if not store.has(chunk_hash)]
+    writer = ChunkWriter(store)
+    try:
+        if new:
+            writer.queue.put(_submit_slices(get_hash_pool(), _encode_slice, new, codec, level, store))
+    finally:
+        writer.finish()
+    metrics.count("dedup_stored_bytes_total", writer.new_bytes)
+    return writer.new_chunks, writer.new_bytes, writer.new_raw_bytes
+
+def ingest_stream(stream, config, store, flush=True):
+    """Chunk, fingerprint, compress and store a binary stream.
+
+    Reading and chunking the next batch overlaps with hashing the current
+    one on the hash pool (hashlib and the codecs release the GIL on
+    chunk-sized buffers). New chunks are compressed on the same pool and
+    written by a separate thread. With delta encoding on, a new chunk
+    similar to a stored one is stored as a delta against it instead. Returns
+    (chunks, new_chunks, new_bytes, new_raw_bytes, digest) where chunks is
+    the ordered list of (hex digest, length) pairs, new_bytes is what the
+    new chunks occupy after compression and digest is the SHA-256 of the
+    whole stream. Pass flush=False when the commit that records the file
+    flushes the store, as a GroupCommitter does.
+    """
+    split_chunks = chunker.get_chunker(config)
+    fingerprint = get_fingerprint(config.get("fingerprint", "sha256"))
+    codec, level = _codec_settings(config)
+    pool = get_hash_pool()
+    writer = ChunkWriter(store)
+
+    chunks = []
+    queued = set()
+    content = hashlib.sha256()
+
+    def collect(batch, futures):
+        new = []
+        hashes = [h for future in futures for h in future.result()]
+        with metrics.timer("dedup_ingest_stage_seconds", stage="lookup"):
+            for data, chunk_hash in zip(batch, hashes):
+                chunks.append((chunk_hash, len(data)))
+                if chunk_hash not in queued and not store.has(chunk_hash):
+                    queued.add(chunk_hash)
+                    new.append((chunk_hash, data))
+        if new:
+            writer.queue.put(_submit_slices(pool, _encode_slice, new, codec, level, store))
+
+    try:
+        pending = None
+        batches = _batches(split_chunks(stream), BATCH_SIZE)
+        while True:
+            # Reading includes waiting for the client on uploads
+            with metrics.timer("dedup_ingest_stage_seconds", stage="read"):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            futures = _submit_slices(pool, _hash_slice, batch, fingerprint)
+            # Runs while the pool fingerprints the batch
+            with metrics.timer("dedup_ingest_stage_seconds", stage="digest"):
+                for data in batch:
+                    content.update(data)
+            if pending is not None:
+                collect(*pending)
+            pending = (batch, futures)
+        if pending is not None:
+            collect(*pending)
+    finally:
+        writer.finish()
+    if flush:
+        journal.sync_store(store)
+    metrics.count("dedup_ingested_bytes_total", sum(length for _, length in chunks))
+    metrics.count("dedup_stored_bytes_total", writer.new_bytes)
+    metrics.count("dedup_chunks_total", writer.new_chunks, kind="new")
+    metrics.count("dedup_chunks_total", len(chunks) - writer.new_chunks, kind="duplicate")
+    return chunks, writer.new_chunks, writer.new_bytes, writer.new_raw_bytes, content.digest()
+
+def ingest_file(f, config, store, meta):
+    """Ingest an open binary file, reusing the manifest of identical stored content.
+
+    Only when a stored version has the same size is the file digested
+    first. On a match its manifest is returned without chunking anything,
+    otherwise the file is ingested with ingest_stream. Returns the same
+    tuple as ingest_stream.
+    """
+    size = os.fstat(f.fileno()).st_size
+    if meta.has_size(size):
+        digest = content_digest(f)
+        chunks = meta.find_content(size, digest)
+        if chunks is not None:
+            metrics.count("dedup_ingested_bytes_total", size)
+            metrics.count("dedup_chunks_total", len(chunks), kind="duplicate")
+            metrics.count("dedup_whole_file_matches_total")
+            return chunks, 0, 0, 0, digest
+        f.seek(0)
+    return ingest_stream(f, config, store)
@@ -0,0 +1,288 @@
+import os
+import zlib
+import struct
+import secrets
+import threading
+
+import metastore
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-writer only
+    fcntl = None
+
+# Configuration
+JOURNAL_DIR = ".journal"  # Kept in the storage directory, one file per writing process
+COMPACT_SIZE = 4 * 1024 * 1024  # Journal bytes before recorded chunks are dropped from it
+RECOVER_BATCH = 1024  # Orphaned chunks recorded per transaction on recovery
+
+# off: leave syncing to the OS. normal: fsync the journal and new chunks
+# before the metadata commit, which may still roll back on power loss.
+# full: also fsync the journal before chunks are written and each commit.
+DURABILITY = ("off", "normal", "full")
+
+# Payload length, CRC-32 of the payload. The payload is 32-byte digests.
+RECORD_HEADER = struct.Struct("<II")
+DIGEST_SIZE = 32
+
+def _read_digests(f):
+    """Return the digests in a journal file, stopping at a torn or corrupt record."""
+    digests = []
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            break
+        length, crc = RECORD_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(payload) != crc or length % DIGEST_SIZE:
+            break
+        digests.extend(payload[i:i + DIGEST_SIZE] for i in range(0, length, DIGEST_SIZE))
+    return digests
+
+def _record(digests):
+    payload = b"".join(digests)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+class IngestJournal:
+    """Write-ahead log of chunks written by ingests that are not recorded yet.
+
+    Chunks reach the store before the file that uses them is recorded in
+    the metadata database. A crash in between leaves chunks no row refers
+    to, which the garbage collector never sees. So ingests log the digests
+    of new chunks here before writing them, and on the next start recover()
+    gives every logged chunk without a row an unreferenced one, letting the
+    garbage collector reclaim it.
+
+    Each process appends to its own file and holds a lock on it while it
+    runs, so recovery only replays journals of processes that have exited.
+    Once the journal grows past COMPACT_SIZE, compact() rewrites it without
+    chunks that have rows, through a temporary file renamed over it.
+    """
+
+    def __init__(self, root, durability="normal"):
+        if durability not in DURABILITY:
+            raise ValueError(f"Unknown durability '{durability}'")
+        self.dir = os.path.join(root, JOURNAL_DIR)
+        self.durability = durability
+        self.path = None
+        self.size = 0
+        self._file = None  # Created on the first write, so readers leave no journal
+        self._lock = threading.Lock()
+
+    def _create(self, path):
+        f = open(path, 'wb')
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)  # Held until this process closes it or exits
+        return f
+
+    def log(self, chunk_hashes):
+        """Append the hex digests of chunks about to be written."""
+        if not chunk_hashes:
+            return
+        record = _record([bytes.fromhex(h) for h in chunk_hashes])
+        with self._lock:
+            if self._file is None:
+                os.makedirs(self.dir, exist_ok=True)
+                self.path = os.path.join(self.dir, f"{os.getpid()}-{secrets.token_hex(4)}.wal")
+                self._file = self._create(self.path)
+            self._file.write(record)
+            self._file.flush()
+            if self.durability == "full":
+                os.fsync(self._file.fileno())
+            self.size += len(record)
+
+    def sync(self):
+        """Force logged digests to disk, before the chunks they describe."""
+        with self._lock:
+            if self._file is not None and self.durability != "off":
+                os.fsync(self._file.fileno())
+
+    def compact(self, meta):
+        """Drop chunks that have been recorded once the journal is large."""
+        with self._lock:
+            if self._file is None or self.size < COMPACT_SIZE:
+                return
+            with open(self.path, 'rb') as f:
+                pending = meta.unrecorded_chunks(_read_digests(f))
+            # The new file is locked before it replaces the old one, so
+            # another process never sees it unlocked
+            replacement = self._create(self.path + ".tmp")
+            if pending:
+                replacement.write(_record(pending))
+            replacement.flush()
+            if self.durability != "off":
+                os.fsync(replacement.fileno())
+            os.replace(replacement.name, self.path)
+            self._file.close()
+            self._file = replacement
+            self.size = replacement.tell()
+
+    def recover(self, meta, store):
+        """Record chunks logged by processes that exited before recording them.
+
+        Chunks that are still in the store get an unreferenced row and are
+        added to the storage counters. Returns how many were recovered.
+        """
+        if not os.path.isdir(self.dir):
+            return 0
+        recovered = 0
+        for name in sorted(os.listdir(self.dir)):
+            path = os.path.join(self.dir, name)
+            if self.path is not None and path in (self.path, self.path + ".tmp"):
+                continue
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue  # Renamed or recovered since it was listed
+            with f:
+                if fcntl:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue  # Its process is still running
+                    if not _still_at(f, path):
+                        continue  # Compacted by its running process since it was opened
+                orphans = meta.unrecorded_chunks(_read_digests(f))
+                for i in range(0, len(orphans), RECOVER_BATCH):
+                    recovered += _record_orphans(meta, store, orphans[i:i + RECOVER_BATCH])
+                os.remove(path)
+        if recovered:
+            metrics.count("dedup_recovered_chunks_total", recovered)
+        return recovered
+
+    def close(self):
+        """Close the journal, leaving it for the next start to recover."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def _still_at(f, path):
+    """Return whether path still names the open file f.
+
+    compact() renames its new journal over the old one before it closes the
+    old one, so a lock taken on a file opened just before the rename is on
+    a file that is no longer at path. Once the lock is held on the file at
+    path, its process has exited and nothing renames over it any more.
+    """
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+def _record_orphans(meta, store, digests):
+    chunks = []
+    new_bytes = new_raw_bytes = 0
+    for digest in digests:
+        chunk_hash = digest.hex()
+        if not store.verify(chunk_hash):
+            continue  # Never written, or written but lost
+        data = store.get(chunk_hash)
+        length = len(data) if data is not None else 0  # A delta whose base is gone
+        chunks.append((chunk_hash, length))
+        new_bytes += store.stored_size(chunk_hash)
+        new_raw_bytes += length
+    if chunks:
+        meta.add_chunks(chunks, len(chunks), new_bytes, new_raw_bytes, store)
+    return len(chunks)
+
+def open_journal(root, durability="normal"):
+    return IngestJournal(root, durability)
+
+def sync_store(store):
+    """Make newly written chunks durable according to the store's durability.
+
+    The journal goes to disk first, so every chunk that survives a crash
+    was logged.
+    """
+    journal = store.journal
+    if journal is not None and journal.durability == "off":
+        return
+    with metrics.timer("dedup_ingest_stage_seconds", stage="flush"):
+        if journal is not None:
+            journal.sync()
+        store.flush()
+
+class _Pending:
+    def __init__(self, entry):
+        self.entry = entry
+        self.done = False
+        self.version = None
+        self.error = None
+
+class GroupCommitter:
+    """Records files from concurrent ingests in shared commits.
+
+    Ingests that go through a committer skip their own store flush. Each
+    caller queues its file and waits. One caller at a time becomes the
+    leader: it takes every queued file, makes their chunks durable with one
+    store flush, records them all in one transaction and wakes the others.
+    Files queued while it works go into the next group, so under load the
+    cost of the flush and the metadata sync is shared by every upload in a
+    group, while a lone upload commits at once. listener, if given, is
+    called with the name and version of every new version recorded.
+    """
+
+    def __init__(self, meta, store, listener=None):
+        self.meta = meta
+        self.store = store
+        self.listener = listener
+        self._cond = threading.Condition()
+        self._queue = []
+        self._leader = False
+
+    def add_file(self, name, chunks, new_chunks=0, new_bytes=0, new_raw_bytes=0, digest=None):
+        """Record a file as MetaStore.add_file does. Returns its version, or None if unchanged."""
+        pending = _Pending((name, chunks, new_chunks, new_bytes, new_raw_bytes, digest))
+        with self._cond:
+            self._queue.append(pending)
+            while self._leader and not pending.done:
+                self._cond.wait()
+            if not pending.done:
+                self._leader = True
+                group = self._queue
+                self._queue = []
+        if not pending.done:
+            try:
+                self._commit(group)
+            finally:
+                with self._cond:
+                    self._leader = False
+                    self._cond.notify_all()
+        if pending.error is not None:
+            raise pending.error
+        return pending.version
+
+    def _commit(self, group):
+        try:
+            sync_store(self.store)
+            with metrics.timer("dedup_ingest_stage_seconds", stage="commit"):
+                try:
+                    versions = self.meta.add_files([p.entry for p in group], self.store)
+                    for p, version in zip(group, versions):
+                        p.version = version
+                except metastore.MissingChunkError:
+                    # Record the other files without the one that lost chunks
+                    for p in group:
+                        try:
+                            p.version = self.meta.add_files([p.entry], self.store)[0]
+                        except Exception as e:
+                            p.error = e
+        except Exception as e:
+            for p in group:
+                p.error = e
+        finally:
+            for p in group:
+                p.done = True
+        metrics.count("dedup_group_commits_total")
+        metrics.count("dedup_group_commit_files_total", len(group))
+        if self.listener is not None:
+            for p in group:
+                if p.version is not None:
+                    self.listener(p.entry[0], p.version)
+        if self.store.journal is not None:
+            try:
+                self.store.journal.compact(self.meta)
+            except OSError as e:
+                print(f"Warning: could not compact the ingest journal: {e}")
@@ -0,0 +1,689 @@
+import os
+import sys
+import json
+import time
+import struct
+import sqlite3
+import argparse
+import threading
+import contextlib
+
+# Configuration
+METADATA_DB = "metadata.db"
+LEGACY_METADATA_FILE = "metadata.json"
+
+# One manifest entry per chunk: digest, chunk length
+MANIFEST_ENTRY = struct.Struct("<32sI")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    chunk_count INTEGER NOT NULL,
+    created REAL NOT NULL,
+    manifest BLOB NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    digest BLOB
+);
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    chunk_count INTEGER NOT NULL,
+    created REAL NOT NULL,
+    digest BLOB,
+    base INTEGER,
+    manifest BLOB NOT NULL,
+    PRIMARY KEY (name, version)
+);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    digest BLOB PRIMARY KEY,
+    refs INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_unreferenced ON chunks (digest) WHERE refs <= 0;
+CREATE INDEX IF NOT EXISTS files_content ON files (size, digest);
+CREATE INDEX IF NOT EXISTS versions_content ON versions (size, digest);
+CREATE INDEX IF NOT EXISTS files_created ON files (created);
+"""
+
+# Columns added to the files table after its first release
+FILE_COLUMNS = (("version", "INTEGER NOT NULL DEFAULT 1"), ("digest", "BLOB"))
+
+# Running counters kept in the stats table. unique_bytes is the raw size
+# of the unique chunks and physical_bytes their size after compression.
+# files counts names and versions every stored version of them.
+STAT_NAMES = ("files", "versions", "logical_bytes", "unique_bytes", "physical_bytes",
+              "unique_chunks")
+
+# Columns the file list can be sorted by, keyed by their name in the API
+FILE_SORTS = {"name": "name", "size": "size", "chunks": "chunk_count", "version": "version",
+              "created": "created"}
+
+# Older versions of a file are stored as edits of the manifest of the next
+# newer version: a copy of count entries from start, or LITERAL followed by
+# count new entries.
+VERSION_OP = struct.Struct("<II")
+LITERAL = 0xFFFFFFFF
+MAX_VERSION_CHAIN = 16  # Every this many versions the manifest is stored in full
+
+# SQLite synchronous setting for each store durability (see journal.DURABILITY)
+SYNCHRONOUS = {"off": "OFF", "normal": "NORMAL", "full": "FULL"}
+
+class MissingChunkError(RuntimeError):
+    pass
+
+def pack_manifest(chunks):
+    """Encode a list of (hex digest, length) pairs as a manifest blob."""
+    return b"".join(MANIFEST_ENTRY.pack(bytes.fromhex(h), size) for h, size in chunks)
+
+def unpack_manifest(blob):
+    """Decode a manifest blob into a list of (hex digest, length) pairs."""
+    return [(digest.hex(), size) for digest, size in MANIFEST_ENTRY.iter_unpack(blob)]
+
+def slice_manifest(manifest, start, end):
+    """Yield (hex digest, offset, length) pieces covering bytes [start, end) of a file."""
+    pos = 0
+    for chunk_hash, size in manifest:
+        if pos >= end:
+            break
+        if pos + size > start:
+            lo = max(start - pos, 0)
+            hi = min(end - pos, size)
+            yield chunk_hash, lo, hi - lo
+        pos += size
+
+def diff_manifest(blob, reference):
+    """Encode a manifest blob as edits of a reference manifest blob."""
+    size = MANIFEST_ENTRY.size
+    count = len(blob) // size
+    ref_count = len(reference) // size
+    positions = {}
+    for j in range(ref_count - 1, -1, -1):
+        positions[reference[j * size:(j + 1) * size]] = j
+    ops = []
+    literal = 0
+    i = 0
+    while i < count:
+        j = positions.get(blob[i * size:(i + 1) * size])
+        if j is None:
+            literal += 1
+            i += 1
+            continue
+        if literal:
+            ops.append(VERSION_OP.pack(LITERAL, literal))
+            ops.append(blob[(i - literal) * size:i * size])
+            literal = 0
+        # Grow the run in doubling steps, comparing whole slices at a time
+        run = 1
+        step = 1
+        while step:
+            end = run + step
+            if (i + end <= count and j + end <= ref_count and
+                    blob[(i + run) * size:(i + end) * size] ==
+                    reference[(j + run) * size:(j + end) * size]):
+                run = end
+                step *= 2
+            else:
+                step //= 2
+        ops.append(VERSION_OP.pack(j, run))
+        i += run
+    if literal:
+        ops.append(VERSION_OP.pack(LITERAL, literal))
+        ops.append(blob[(count - literal) * size:])
+    return b"".join(ops)
+
+def patch_manifest(delta, reference):
+    """Rebuild a manifest blob from diff_manifest edits and their reference."""
+    size = MANIFEST_ENTRY.size
+    parts = []
+    pos = 0
+    while pos < len(delta):
+        start, count = VERSION_OP.unpack_from(delta, pos)
+        pos += VERSION_OP.size
+        if start == LITERAL:
+            parts.append(delta[pos:pos + count * size])
+            pos += count * size
+        else:
+            parts.append(reference[start * size:(start + count) * size])
+    return b"".join(parts)
+
+class MetaStore:
+    """SQLite-backed catalogue of stored files and their chunk manifests.
+
+    Each file is one row, so adding a file writes only that file's record
+    and looking a file up reads only its row. Storage statistics are kept
+    as running counters updated in the same transaction as each ingest.
+
+    Storing a changed file under a taken name makes it the file's new
+    version. Older versions move to the versions table, where each manifest
+    is kept as edits of the next newer one, so a version that changed a few
+    chunks costs a few manifest entries. Files also record the SHA-256 of
+    their content, which lets an identical file reuse a stored manifest
+    without being chunked.
+
+    The chunks table counts, for every stored chunk, how many files
+    reference it, counting every version. A delta chunk also holds one
+    reference on its base.
+    Chunks whose count drops to zero are left for the garbage collector.
+
+    Every thread gets its own connection. In WAL mode readers never block,
+    and concurrent writers are serialized by SQLite itself. durability
+    picks how often SQLite syncs its log: with "full" every commit is on
+    disk before it returns.
+    """
+
+    def __init__(self, path=METADATA_DB, timeout=30, durability="normal"):
+        self.path = path
+        self.timeout = timeout
+        self.synchronous = SYNCHRONOUS[durability]
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        has_refs = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chunks'").fetchone()
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(files)")}
+        if columns:
+            for column, definition in FILE_COLUMNS:
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE files ADD COLUMN {column} {definition}")
+        self.conn.executescript(SCHEMA)
+        with self.conn:
+            added = self.conn.executemany("INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0)",
+                                          [(name,) for name in STAT_NAMES]).rowcount
+        # Databases created before a counter or the reference counts
+        # existed need one full recount
+        self.needs_recount = (added > 0 or not has_refs) and self.conn.execute(
+            "SELECT 1 FROM files LIMIT 1").fetchone() is not None
+
+    @property
+    def conn(self):
+        """The calling thread's connection, opened on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def _write_transaction(self):
+        """Run a transaction that takes the write lock before its first read."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        with self.conn:
+            yield
+
+    def has_file(self, name):
+        row = self.conn.execute("SELECT 1 FROM files WHERE name = ?", (name,)).fetchone()
+        return row is not None
+
+    def _bump(self, **deltas):
+        self.conn.executemany("UPDATE stats SET value = value + ? WHERE name = ?",
+                              [(delta, name) for name, delta in deltas.items() if delta])
+
+    def add_file(self, name, chunks, new_chunks=0, new_bytes=0, new_raw_bytes=0,
+                 chunk_store=None, digest=None):
+        """Record a file's manifest. Returns its version, or None if unchanged.
+
+        new_chunks, new_bytes and new_raw_bytes count the chunks this ingest
+        added to the chunk store, with their stored and raw sizes. They are
+        applied to the counters even when the file is unchanged, because
+        those chunks were written either way. digest is the SHA-256 of the
+        content, if known.
+        """
+        totals = dict.fromkeys(STAT_NAMES, 0)
+        with self._write_transaction():
+            version = self._record_file(name, chunks, new_chunks, new_bytes, new_raw_bytes,
+                                        digest, chunk_store, totals)
+            self._bump(**totals)
+        return version
+
+    def add_files(self, entries, chunk_store=None):
+        """Record many files in one transaction. Returns each file's version, None if unchanged.
+
+        Each entry is (name, chunks, new_chunks, new_bytes, new_raw_bytes,
+        digest) as for add_file, and each new version adds one reference to
+        every distinct chunk it uses. Given the chunk store, chunks that had
+        no reference row are checked to still exist, since the garbage
+        collector may have removed them after the ingest found them. Those
+        that are deltas add a reference to their base, which is checked the
+        same way. Raises MissingChunkError, recording nothing, if one is gone.
+        """
+        versions = []
+        totals = dict.fromkeys(STAT_NAMES, 0)
+        with self._write_transaction():
+            for name, chunks, new_chunks, new_bytes, new_raw_bytes, digest in entries:
+                versions.append(self._record_file(name, chunks, new_chunks, new_bytes,
+                                                  new_raw_bytes, digest, chunk_store, totals))
+            self._bump(**totals)
+        return versions
+
+    def _record_file(self, name, chunks, new_chunks, new_bytes, new_raw_bytes, digest,
+                     chunk_store, totals):
+        """Add a file or a new version of it inside a transaction, updating totals.
+
+        A file whose manifest or digest equals its latest version is left
+        alone. Otherwise the latest version moves to the versions table.
+        """
+        totals["unique_chunks"] += new_chunks
+        totals["unique_bytes"] += new_raw_bytes
+        totals["physical_bytes"] += new_bytes
+        size = sum(length for _, length in chunks)
+        blob = pack_manifest(chunks)
+        refs = {bytes.fromhex(h): length for h, length in chunks}
+        missing = self._create_chunk_rows(refs, chunk_store)
+        if missing:
+            raise MissingChunkError(
+                f"{len(missing)} chunks of '{name}' were removed during ingest; try again")
+
+        row = self.conn.execute(
+            "SELECT version, size, chunk_count, created, manifest, digest FROM files "
+            "WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            version = 1
+            self.conn.execute(
+                "INSERT INTO files (name, size, chunk_count, created, manifest, version, digest) "
+                "VALUES (?, ?, ?, ?, ?, 1, ?)",
+                (name, size, len(chunks), time.time(), blob, digest))
+            totals["files"] += 1
+        else:
+            latest, old_size, old_count, created, old_blob, old_digest = row
+            if old_blob == blob or (digest is not None and digest == old_digest):
+                if old_digest is None and digest is not None and old_blob == blob:
+                    self.conn.execute("UPDATE files SET digest = ? WHERE name = ?", (digest, name))
+                return None
+            version = latest + 1
+            base, stored = None, old_blob
+            if latest % MAX_VERSION_CHAIN:
+                delta = diff_manifest(old_blob, blob)
+                if len(delta) < len(old_blob):
+                    base, stored = version, delta
+            self.conn.execute(
+                "INSERT INTO versions (name, version, size, chunk_count, created, digest, base, "
+                "manifest) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, latest, old_size, old_count, created, old_digest, base, stored))
+            self.conn.execute(
+                "UPDATE files SET size = ?, chunk_count = ?, created = ?, manifest = ?, "
+                "version = ?, digest = ? WHERE name = ?",
+                (size, len(chunks), time.time(), blob, version, digest, name))
+        self.conn.executemany("UPDATE chunks SET refs = refs + 1 WHERE digest = ?",
+                              [(chunk,) for chunk in refs])
+        totals["versions"] += 1
+        totals["logical_bytes"] += size
+        return version
+
+    def _create_chunk_rows(self, sizes, chunk_store=None):
+        """Add unreferenced rows for chunks that have none. Returns digests missing from the store.
+
+        sizes maps digests to raw chunk lengths. A new row for a delta chunk
+        also adds a reference to its base.
+        """
+        created = [digest for digest, length in sizes.items() if self.conn.execute(
+            "INSERT OR IGNORE INTO chunks (digest, refs, size) VALUES (?, 0, ?)",
+            (digest, length)).rowcount]
+        if chunk_store is None:
+            return []
+        missing = [digest for digest in created if not chunk_store.verify(digest.hex())]
+        for digest in created:
+            base = chunk_store.base_of(digest.hex())
+            if base is None:
+                continue
+            if self.conn.execute(
+                    "INSERT OR IGNORE INTO chunks (digest, refs, size) VALUES (?, 0, 0)",
+                    (base,)).rowcount and not chunk_store.verify(base.hex()):
+                missing.append(base)
+            self.conn.execute("UPDATE chunks SET refs = refs + 1 WHERE digest = ?", (base,))
+        return missing
+
+    def add_chunks(self, chunks, new_chunks=0, new_bytes=0, new_raw_bytes=0, chunk_store=None):
+        """Record chunks stored without a file, such as those of an abandoned upload.
+
+        chunks is a list of (hex digest, length) pairs and the counts are as
+        for add_file. The chunks get no references, so the garbage collector
+        reclaims them unless a file starts using them first.
+        """
+        with self.conn:
+            self._create_chunk_rows({bytes.fromhex(h): length for h, length in chunks}, chunk_store)
+            self._bump(unique_chunks=new_chunks, unique_bytes=new_raw_bytes, physical_bytes=new_bytes)
+
+    def unrecorded_chunks(self, digests):
+        """Return the distinct digests, as bytes, that have no chunk row."""
+        return [digest for digest in dict.fromkeys(digests) if self.conn.execute(
+            "SELECT 1 FROM chunks WHERE digest = ?", (digest,)).fetchone() is None]
+
+    def delete_file(self, name, version=None):
+        """Remove a file, or one version of it, releasing chunk references.
+
+        Deleting the latest version makes the previous one current.
+        Returns False if the file or version is absent.
+        """
+        with self._write_transaction():
+            row = self.conn.execute("SELECT version, size, manifest FROM files WHERE name = ?",
+                                    (name,)).fetchone()
+            if row is None:
+                return False
+            latest, size, manifest = row
+            if version is None:
+                sizes = [size] + [size for (size,) in self.conn.execute(
+                    "SELECT size FROM versions WHERE name = ?", (name,))]
+                for blob in self._all_versions(name, latest, manifest):
+                    self._release(blob)
+                self.conn.execute("DELETE FROM files WHERE name = ?", (name,))
+                self.conn.execute("DELETE FROM versions WHERE name = ?", (name,))
+                self._bump(files=-1, versions=-len(sizes), logical_bytes=-sum(sizes))
+            elif version == latest:
+                previous = self.conn.execute(
+                    "SELECT version, size, chunk_count, created, digest FROM versions "
+                    "WHERE name = ? ORDER BY version DESC LIMIT 1", (name,)).fetchone()
+                if previous is None:
+                    self.conn.execute("DELETE FROM files WHERE name = ?", (name,))
+                    self._bump(files=-1)
+                else:
+                    # Older versions stored as edits of the previous one
+                    # now find it in the files table
+                    blob = self._manifest_blob(name, previous[0])
+                    self.conn.execute(
+                        "UPDATE files SET version = ?, size = ?, chunk_count = ?, created = ?, "
+                        "digest = ?, manifest = ? WHERE name = ?", previous + (blob, name))
+                    self.conn.execute("DELETE FROM versions WHERE name = ? AND version = ?",
+                                      (name, previous[0]))
+                self._release(manifest)
+                self._bump(versions=-1, logical_bytes=-size)
+            else:
+                row = self.conn.execute(
+                    "SELECT size, base FROM versions WHERE name = ? AND version = ?",
+                    (name, version)).fetchone()
+                if row is None:
+                    return False
+                size, base = row
+                blob = self._manifest_blob(name, version)
+                dependent = self.conn.execute(
+                    "SELECT version FROM versions WHERE name = ? AND base = ?",
+                    (name, version)).fetchone()
+                if dependent is not None:
+                    # Re-encode the next older version against this one's reference
+                    older = self._manifest_blob(name, dependent[0])
+                    stored = older
+                    if base is not None:
+                        delta = diff_manifest(older, self._manifest_blob(name, base))
+                        if len(delta) < len(older):
+                            stored = delta
+                    self.conn.execute(
+                        "UPDATE versions SET base = ?, manifest = ? WHERE name = ? AND version = ?",
+                        (base if stored is not older else None, stored, name, dependent[0]))
+                self.conn.execute("DELETE FROM versions WHERE name = ? AND version = ?",
+                                  (name, version))
+                self._release(blob)
+                self._bump(versions=-1, logical_bytes=-size)
+        return True
+
+    def _release(self, blob):
+        """Drop one reference to every distinct chunk of a manifest blob."""
+        digests = {digest for digest, _ in MANIFEST_ENTRY.iter_unpack(blob)}
+        self.conn.executemany("UPDATE chunks SET refs = refs - 1 WHERE digest = ?",
+                              [(digest,) for digest in digests])
+
+    def unreferenced_chunks(self, limit):
+        """Return up to limit digests of chunks that no file references."""
+        return [digest for (digest,) in self.conn.execute(
+            "SELECT digest FROM chunks WHERE refs <= 0 LIMIT ?", (limit,))]
+
+    def collect_chunk(self, digest, chunk_store):
+        """Delete an unreferenced chunk from the catalogue and the chunk store.
+
+        Both happen in one write transaction, so a concurrent ingest either
+        adds its reference first, which keeps the chunk, or finds it gone.
+        Removing a delta chunk releases its reference on the base. Returns
+        the stored bytes freed, or None if the chunk is referenced.
+        """
+        with self._write_transaction():
+            row = self.conn.execute("SELECT size FROM chunks WHERE digest = ? AND refs <= 0",
+                                    (digest,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("DELETE FROM chunks WHERE digest = ?", (digest,))
+            base = chunk_store.base_of(digest.hex())
+            stored = chunk_store.delete(digest.hex())
+            if base is not None:
+                self.conn.execute("UPDATE chunks SET refs = refs - 1 WHERE digest = ?", (base,))
+            if stored is None:
+                return 0  # Already gone from the store
+            self._bump(unique_chunks=-1, unique_bytes=-row[0], physical_bytes=-stored)
+        return stored
+
+    def get_manifest(self, name, version=None):
+        """Return the (hex digest, length) list of a file's version, or None.
+
+        version defaults to the latest.
+        """
+        blob = self._manifest_blob(name, version)
+        if blob is None:
+            return None
+        return unpack_manifest(blob)
+
+    def _manifest_blob(self, name, version=None):
+        row = self.conn.execute("SELECT version, manifest FROM files WHERE name = ?",
+                                (name,)).fetchone()
+        if row is None:
+            return None
+        latest, blob = row
+        deltas = []
+        while version is not None and version != latest:
+            row = self.conn.execute("SELECT base, manifest FROM versions WHERE name = ? AND version = ?",
+                                    (name, version)).fetchone()
+            if row is None:
+                return None
+            version, stored = row
+            if version is None:
+                blob = stored  # Stored in full
+            else:
+                deltas.append(stored)
+        for delta in reversed(deltas):
+            blob = patch_manifest(delta, blob)
+        return blob
+
+    def _all_versions(self, name, latest, manifest):
+        """Yield the manifest blob of every version of a file, newest first."""
+        yield manifest
+        blobs = {latest: manifest}
+        for version, base, stored in self.conn.execute(
+                "SELECT version, base, manifest FROM versions WHERE name = ? "
+                "ORDER BY version DESC", (name,)).fetchall():
+            # Each version is the reference of at most the next older one
+            blob = stored if base is None else patch_manifest(stored, blobs.pop(base))
+            blobs[version] = blob
+            yield blob
+
+    def list_files(self):
+        """Return (name, size, chunk_count, version) for every stored file."""
+        return self.conn.execute(
+            "SELECT name, size, chunk_count, version FROM files ORDER BY name").fetchall()
+
+    def list_files_page(self, offset=0, limit=100, sort="name", descending=False):
+        """Return (name, size, chunk_count, version) for one page of stored files.
+
+        sort is one of FILE_SORTS. Ties are broken by name, so pages are
+        stable while the catalogue is unchanged.
+        """
+        column = FILE_SORTS[sort]
+        order = "DESC" if descending else "ASC"
+        return self.conn.execute(
+            f"SELECT name, size, chunk_count, version FROM files ORDER BY {column} {order}, "
+            f"name {order} LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+
+    def list_versions(self, name):
+        """Return (version, size, chunk_count, created) for every version of a file, newest first."""
+        return self.conn.execute(
+            "SELECT version, size, chunk_count, created FROM files WHERE name = ? "
+            "UNION ALL SELECT version, size, chunk_count, created FROM versions WHERE name = ? "
+            "ORDER BY version DESC", (name, name)).fetchall()
+
+    def has_size(self, size):
+        """Return whether any version with a known digest has this size."""
+        return self.conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM files WHERE size = ? AND digest IS NOT NULL) "
+            "OR EXISTS (SELECT 1 FROM versions WHERE size = ? AND digest IS NOT NULL)",
+            (size, size)).fetchone()[0] == 1
+
+    def find_content(self, size, digest):
+        """Return the manifest of a stored version with this size and digest, or None."""
+        row = self.conn.execute("SELECT manifest FROM files WHERE size = ? AND digest = ? LIMIT 1",
+                                (size, digest)).fetchone()
+        if row is not None:
+            return unpack_manifest(row[0])
+        row = self.conn.execute(
+            "SELECT name, version FROM versions WHERE size = ? AND digest = ? LIMIT 1",
+            (size, digest)).fetchone()
+        if row is None:
+            return None
+        return self.get_manifest(*row)
+
+    def get_stats(self):
+        """Return the running storage counters as a dict."""
+        return dict(self.conn.execute("SELECT name, value FROM stats").fetchall())
+
+    def recount(self, chunk_store):
+        """Rebuild the counters and reference counts from the catalogue and a chunk store scan.
+
+        Raw chunk sizes are taken from manifests, or by decoding delta
+        bases that no file references, so unique_bytes counts the distinct
+        chunks referenced by files or deltas. Stored chunks that no file or
+        delta references get a zero count and are garbage collected.
+        """
+        files, logical = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+        versions, old_logical = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM versions").fetchone()
+        refs = {}
+        sizes = {}
+        for name, latest, manifest in self.conn.execute(
+                "SELECT name, version, manifest FROM files").fetchall():
+            for blob in self._all_versions(name, latest, manifest):
+                for digest, size in dict(MANIFEST_ENTRY.iter_unpack(blob)).items():
+                    refs[digest] = refs.get(digest, 0) + 1
+                    sizes[digest] = size
+        for chunk_hash in chunk_store.hashes():
+            digest = bytes.fromhex(chunk_hash)
+            if digest not in refs:
+                refs[digest] = 0
+                sizes[digest] = 0
+        for chunk_hash in chunk_store.hashes():
+            base = chunk_store.base_of(chunk_hash)
+            if base is not None:
+                refs[base] = refs.get(base, 0) + 1
+                if not sizes.get(base):
+                    # A base kept only by deltas is in no manifest
+                    data = chunk_store.get(base.hex())
+                    sizes[base] = len(data) if data is not None else 0
+        values = {
+            "files": files,
+            "versions": files + versions,
+            "logical_bytes": logical + old_logical,
+            "unique_bytes": sum(sizes.values()),
+            "physical_bytes": chunk_store.physical_size(),
+            "unique_chunks": chunk_store.chunk_count(),
+        }
+        with self.conn:
+            self.conn.execute("DELETE FROM chunks")
+            self.conn.executemany("INSERT INTO chunks (digest, refs, size) VALUES (?, ?, ?)",
+                                  [(digest, count, sizes[digest]) for digest, count in refs.items()])
+            self.conn.executemany("UPDATE stats SET value = ? WHERE name = ?",
+                                  [(value, name) for name, value in values.items()])
+        self.needs_recount = False
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+def import_metadata_json(meta, chunk_store, json_path=LEGACY_METADATA_FILE):
+    """Import a legacy metadata.json catalogue into a MetaStore.
+
+    The JSON only lists hashes, so exact chunk lengths are taken from the
+    chunk store. Files that are already catalogued are left untouched.
+    Returns (imported, skipped) counts.
+    """
+    with open(json_path, 'r') as f:
+        metadata = json.load(f)
+
+    sizes = {}
+    imported = skipped = 0
+    for name, hashes in metadata.items():
+        if meta.has_file(name):
+            skipped += 1
+            continue
+        chunks = []
+        for h in hashes:
+            if h not in sizes:
+                data = chunk_store.get(h)
+                if data is None:
+                    break
+                sizes[h] = len(data)
+            chunks.append((h, sizes[h]))
+        else:
+            if meta.add_file(name, chunks):
+                imported += 1
+                continue
+        skipped += 1
+    return imported, skipped
+
+def open_metastore(chunk_store=None, path=METADATA_DB, json_path=LEGACY_METADATA_FILE):
+    """Open the metadata database, importing metadata.json on first use.
+
+    With a chunk store, chunks left unrecorded by ingests that crashed are
+    recovered from the store's journal, and the database syncs as the
+    store's durability setting asks.
+    """
+    created = not os.path.exists(path)
+    journal = chunk_store.journal if chunk_store is not None else None
+    meta = MetaStore(path, durability=journal.durability if journal is not None else "normal")
+    if chunk_store is not None:
+        if created and os.path.exists(json_path):
+            imported, skipped = import_metadata_json(meta, chunk_store, json_path)
+            print(f"Imported {imported} files from '{json_path}' ({skipped} skipped).")
+        if created or meta.needs_recount:
+            meta.recount(chunk_store)
+        if journal is not None:
+            recovered = journal.recover(meta, chunk_store)
+            if recovered:
+                print(f"Recovered {recovered} chunks left unrecorded by interrupted ingests.")
+    return meta
+
+if __name__ == "__main__":
+    import chunkstore
+    import storeconfig
+
+    parser = argparse.ArgumentParser(description="Metadata database maintenance.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="import a legacy metadata.json file")
+    import_parser.add_argument("json_path", nargs="?", default=LEGACY_METADATA_FILE)
+    subparsers.add_parser("recount", help="rebuild the storage statistics counters")
+    args = parser.parse_args()
+    store = chunkstore.open_chunk_store(storeconfig.load_store_config())
+    meta = MetaStore()
+
+    try:
+        if args.command == "import":
+            if not os.path.exists(args.json_path):
+                print(f"Error: File '{args.json_path}' not found.")
+                sys.exit(1)
+            imported, skipped = import_metadata_json(meta, store, args.json_path)
+            meta.recount(store)
+            print(f"Imported {imported} files from '{args.json_path}' ({skipped} skipped).")
+        elif args.command == "recount":
+            meta.recount(store)
+            print("Statistics rebuilt:")
+            for name, value in sorted(meta.get_stats().items()):
+                print(f"  {name}: {value}")
+    finally:
+        meta.close()
+        store.close()
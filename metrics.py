@@ -0,0 +1,119 @@
+import time
+import bisect
+import threading
+import contextlib
+
+# Configuration
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)  # Seconds
+
+DESCRIPTIONS = {
+    "dedup_ingest_stage_seconds": "Time spent in each ingest stage, per batch or file.",
+    "dedup_restore_stage_seconds": "Time spent in each download stage, per request.",
+    "dedup_http_request_seconds": "HTTP request latency by endpoint.",
+    "dedup_http_requests_total": "HTTP requests by endpoint and status code.",
+    "dedup_ingested_bytes_total": "Logical bytes ingested.",
+    "dedup_stored_bytes_total": "Bytes written to the chunk store after compression.",
+    "dedup_restored_bytes_total": "Bytes sent to clients by downloads.",
+    "dedup_chunks_total": "Chunks ingested, by whether they were new or duplicates.",
+    "dedup_whole_file_matches_total": "Files ingested by reusing the manifest of identical content.",
+}
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    """Process-wide counters and histograms, keyed by name and labels.
+
+    Updates take one lock and a dict lookup, so they are cheap enough for
+    per-batch and per-request use but are not meant for every chunk.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe the time spent in a with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self, extra=None):
+        """Return every metric in the Prometheus text exposition format.
+
+        extra maps more metric names to (type, help, value) and is rendered
+        as is, for values owned by other components such as the chunk cache.
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+            # Copy so the numbers of one histogram are consistent
+            histograms = [(key, list(h.counts), h.sum, h.count, h.buckets) for key, h in histograms]
+
+        declared = set()
+
+        def declare(name, kind, description):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name, "counter", DESCRIPTIONS.get(name, name))
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), counts, total, count, buckets in histograms:
+            declare(name, "histogram", DESCRIPTIONS.get(name, name))
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for name, (kind, description, value) in sorted((extra or {}).items()):
+            declare(name, kind, description)
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+registry = Registry()
+count = registry.count
+observe = registry.observe
+timer = registry.timer
+render = registry.render
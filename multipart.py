@@ -0,0 +1,215 @@
+import re
+import queue
+import threading
+
+# Configuration
+READ_SIZE = 1024 * 1024  # Bytes pulled off the socket per read
+READ_AHEAD = 4  # Blocks buffered ahead of the consumer
+MAX_HEADER_SIZE = 16 * 1024
+
+class MultipartError(ValueError):
+    pass
+
+def parse_boundary(content_type):
+    """Return the multipart boundary of a Content-Type header as bytes."""
+    match = re.search(r'boundary=(?:"([^"]+)"|([^;\s]+))', content_type or "")
+    if not match:
+        raise MultipartError("Missing multipart boundary")
+    return (match.group(1) or match.group(2)).encode()
+
+class Part:
+    """One part of a multipart body, readable as a stream until its boundary."""
+
+    def __init__(self, reader, headers):
+        self._reader = reader
+        self.headers = headers
+        disposition = headers.get("content-disposition", "")
+        name = re.search(r'\bname="([^"]*)"', disposition)
+        filename = re.search(r'\bfilename="([^"]*)"', disposition)
+        self.name = name.group(1) if name else None
+        self.filename = filename.group(1) if filename else None
+        self.done = False
+
+    def read(self, size=-1):
+        """Read up to size bytes of the part body; short only at its end."""
+        chunks = []
+        remaining = size
+        while not self.done and (size < 0 or remaining > 0):
+            data = self._reader._read_body(remaining if size >= 0 else READ_SIZE)
+            if not data:
+                self.done = True
+                break
+            chunks.append(data)
+            remaining -= len(data)
+        return b"".join(chunks)
+
+    def drain(self):
+        while self.read(READ_SIZE):
+            pass
+
+class MultipartReader:
+    """Incremental multipart/form-data parser over a bounded input stream.
+
+    Only a small window of the body is held in memory at any time, so parts
+    can be consumed as they arrive regardless of their size.
+    """
+
+    def __init__(self, stream, boundary, content_length, read_size=READ_SIZE):
+        self._stream = stream
+        self._remaining = content_length
+        self._read_size = read_size
+        self._delimiter = b"\r\n--" + boundary
+        self._buf = bytearray()
+        self._part = None
+        self._finished = False
+        # The first delimiter is not preceded by CRLF
+        self._buf += b"\r\n"
+        self._skip_to_delimiter()
+
+    def _fill(self):
+        """Read more input into the buffer. Returns False at end of input."""
+        if self._remaining <= 0:
+            return False
+        data = self._stream.read(min(self._read_size, self._remaining))
+        if not data:
+            raise MultipartError("Unexpected end of upload")
+        self._remaining -= len(data)
+        self._buf += data
+        return True
+
+    def _skip_to_delimiter(self):
+        while True:
+            pos = self._buf.find(self._delimiter)
+            if pos != -1:
+                del self._buf[:pos + len(self._delimiter)]
+                self._after_delimiter()
+                return
+            # Keep a tail that may hold the start of a split delimiter
+            del self._buf[:max(len(self._buf) - len(self._delimiter), 0)]
+            if not self._fill():
+                raise MultipartError("Multipart boundary not found")
+
+    def _after_delimiter(self):
+        while len(self._buf) < 2:
+            if not self._fill():
+                raise MultipartError("Truncated multipart body")
+        if self._buf[:2] == b"--":
+            self._finished = True
+        elif self._buf[:2] != b"\r\n":
+            raise MultipartError("Malformed multipart boundary")
+        del self._buf[:2]
+
+    def _read_headers(self):
+        while True:
+            pos = self._buf.find(b"\r\n\r\n")
+            if pos != -1:
+                break
+            if len(self._buf) > MAX_HEADER_SIZE:
+                raise MultipartError("Multipart headers too large")
+            if not self._fill():
+                raise MultipartError("Truncated multipart headers")
+        raw = bytes(self._buf[:pos]).decode("utf-8", "replace")
+        del self._buf[:pos + 4]
+        headers = {}
+        for line in raw.split("\r\n"):
+            key, sep, value = line.partition(":")
+            if sep:
+                headers[key.strip().lower()] = value.strip()
+        return headers
+
+    def _read_body(self, size):
+        """Return up to size bytes of the current part, b'' at its end."""
+        while True:
+            pos = self._buf.find(self._delimiter)
+            if pos != -1:
+                if pos == 0:
+                    del self._buf[:len(self._delimiter)]
+                    self._after_delimiter()
+                    return b""
+                take = min(pos, size)
+            else:
+                take = min(len(self._buf) - len(self._delimiter) + 1, size)
+                if take <= 0 or (take < size and self._remaining > 0):
+                    if not self._fill():
+                        raise MultipartError("Truncated multipart body")
+                    continue
+            data = bytes(memoryview(self._buf)[:take])
+            del self._buf[:take]
+            return data
+
+    def finish(self):
+        """Consume the rest of the body, such as an epilogue after the last part."""
+        if self._part is not None and not self._part.done:
+            self._part.drain()
+        self._buf.clear()
+        while self._remaining > 0:
+            data = self._stream.read(min(self._read_size, self._remaining))
+            if not data:
+                break
+            self._remaining -= len(data)
+
+    def next_part(self):
+        """Return the next Part, draining any unread previous one, or None."""
+        if self._part is not None and not self._part.done:
+            self._part.drain()
+        if self._finished:
+            return None
+        self._part = Part(self, self._read_headers())
+        return self._part
+
+class ReadAheadStream:
+    """Read a stream on a background thread, in blocks, ahead of the consumer.
+
+    The producer blocks once `depth` blocks are buffered, so memory stays
+    bounded while socket reads overlap with chunking and hashing.
+    """
+
+    def __init__(self, stream, block_size=READ_SIZE, depth=READ_AHEAD):
+        self._stream = stream
+        self._block_size = block_size
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._buf = b""
+        self._eof = False
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _produce(self):
+        try:
+            while not self._stop.is_set():
+                data = self._stream.read(self._block_size)
+                self._put(data)
+                if not data:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size=-1):
+        """Read up to size bytes; short only at end of stream."""
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if not item:
+                self._eof = True
+                break
+            self._buf += item
+        if size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def close(self):
+        """Stop the producer thread; unread data is discarded."""
+        self._stop.set()
+        # The producer may be blocked on a stalled client; don't wait on it forever
+        self._thread.join(timeout=1)
@@ -1,55 +1,267 @@
 import os
-import json
 import sys
+import time
+import fnmatch
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import chunkcache
+import chunkstore
+import compression
+import metastore
+import storeconfig
 
 # Configuration
 STORAGE_DIR = "storage"
-METADATA_FILE = "metadata.json"
-
-def load_metadata():
-    """Load metadata from JSON file."""
-    if os.path.exists(METADATA_FILE):
-        try:
-            with open(METADATA_FILE, 'r') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
-            return {}
-    return {}
-
-def reconstruct_file(target_filename):
-    """Reconstruct the original file from stored chunks."""
-    metadata = load_metadata()
+METADATA_DB = "metadata.db"
+RESTORE_DIR = "restored"
+JOBS = 8  # Threads reading chunks and writing restored files
+BATCH_SIZE = 4 * 1024 * 1024  # Bytes of stored chunks read per task
+MAX_OPEN_FILES = 256  # Files restored together; chunks are read once per group
+
+_pwrite_lock = threading.Lock()
+
+def reconstruct_file(target_filename, cache=None, version=None):
+    """Reconstruct the original file, or an older version of it, from stored chunks."""
+    try:
+        path = output_path(os.curdir, "reconstructed_" + target_filename)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    store = chunkstore.open_chunk_store(storeconfig.load_store_config(), STORAGE_DIR)
+    meta = metastore.open_metastore(store, METADATA_DB)
+    manifest = meta.get_manifest(target_filename, version)
+    meta.close()
+    if cache is None:
+        cache = chunkcache.ChunkCache()
     
-    if target_filename not in metadata:
-        print(f"Error: No metadata found for '{target_filename}'.")
+    if manifest is None:
+        if version is None:
+            print(f"Error: No metadata found for '{target_filename}'.")
+        else:
+            print(f"Error: No version {version} found for '{target_filename}'.")
+        store.close()
         return
 
-    chunk_hashes = metadata[target_filename]
-    output_path = os.path.join("reconstructed_" + target_filename)
+    # Files ingested from a directory are named by their relative path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
     
     print(f"Reconstructing '{target_filename}'...")
     
     try:
-        with open(output_path, 'wb') as out_file:
-            for chunk_hash in chunk_hashes:
-                chunk_path = os.path.join(STORAGE_DIR, chunk_hash)
+        with open(path, 'wb') as out_file:
+            for chunk_hash, _ in manifest:
+                # Repeated chunks, such as zero-filled regions, are read once
+                data = cache.fetch(store, chunk_hash)
                 
-                if not os.path.exists(chunk_path):
+                if data is None:
                     print(f"Critical Error: Chunk {chunk_hash} missing! Reconstruction failed.")
                     out_file.close()
-                    os.remove(output_path)
+                    os.remove(path)
                     return
                 
-                with open(chunk_path, 'rb') as chunk_file:
-                    out_file.write(chunk_file.read())
+                out_file.write(data)
                     
-        print(f"Success! File reconstructed as '{output_path}'.")
+        print(f"Success! File reconstructed as '{os.path.relpath(path)}'.")
         
     except IOError as e:
         print(f"Error writing reconstructed file: {e}")
+    finally:
+        store.close()
+
+def match_files(meta, patterns):
+    """Return the stored names matching names or glob patterns, without repeats.
+
+    Patterns are matched against whole names, so `logs/*` also matches
+    files in subdirectories of logs.
+    """
+    names = None
+    matched = {}
+    for pattern in patterns:
+        if any(c in pattern for c in "*?["):
+            if names is None:
+                names = [row[0] for row in meta.list_files()]
+            found = fnmatch.filter(names, pattern)
+        else:
+            found = [pattern] if meta.has_file(pattern) else []
+        if not found:
+            print(f"Error: No stored files match '{pattern}'.")
+        matched.update(dict.fromkeys(found))
+    return list(matched)
+
+def output_path(output_dir, name):
+    """Return where a stored file is restored, refusing names that leave output_dir."""
+    root = os.path.abspath(output_dir)
+    path = os.path.abspath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root or path == root:
+        raise ValueError(f"Refusing to restore '{name}' outside '{output_dir}'")
+    return path
+
+def _pwrite(fd, data, offset):
+    """Write all of data at offset, without moving a file position other threads use."""
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        with _pwrite_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+
+def _read_chunk(store, cache, chunk_hash):
+    """Read and decode a chunk, keeping delta bases in the cache."""
+    stored = store.read_stored(chunk_hash)
+    if stored is None:
+        return None
+    payload, codec = stored
+    if codec == compression.DELTA:
+        base = cache.fetch(store, compression.delta_header(payload)[1].hex())
+        if base is None:
+            return None
+        return compression.decode_delta(payload, base)
+    return compression.decode(codec, payload)
+
+def _restore_batch(store, cache, reads, fds):
+    """Read a run of chunks and write each to every place it occurs. Returns failed file indexes."""
+    failed = set()
+    for _, _, _, chunk_hash, places in reads:
+        data = _read_chunk(store, cache, chunk_hash)
+        if data is None:
+            failed.update(i for i, _ in places)
+            continue
+        for i, offset in places:
+            _pwrite(fds[i], data, offset)
+    return failed
+
+def _restore_group(store, meta, names, output_dir, pool, cache):
+    """Restore files together. Returns (bytes restored, names that failed)."""
+    fds = []
+    sizes = []
+    targets = {}  # Chunk hash -> [(file index, offset), ...]
+    failed = set()
+    try:
+        for name in names:
+            manifest = meta.get_manifest(name)
+            path = output_path(output_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+                         0o666)
+            fds.append(fd)
+            offset = 0
+            for chunk_hash, length in manifest or ():
+                targets.setdefault(chunk_hash, []).append((len(fds) - 1, offset))
+                offset += length
+            os.ftruncate(fd, offset)
+            sizes.append(offset)
+            if manifest is None:
+                failed.add(len(fds) - 1)  # Deleted since it was matched
+
+        # Read every chunk once, in the order it lies in storage
+        reads = []
+        for chunk_hash, places in targets.items():
+            location = store.locate(chunk_hash)
+            if location is None:
+                failed.update(i for i, _ in places)
+            else:
+                reads.append((location[0], location[1], location[2], chunk_hash, places))
+        reads.sort(key=lambda read: read[:2])
+
+        futures = []
+        batch = []
+        batch_bytes = 0
+        for read in reads:
+            batch.append(read)
+            batch_bytes += read[2]
+            if batch_bytes >= BATCH_SIZE:
+                futures.append(pool.submit(_restore_batch, store, cache, batch, fds))
+                batch = []
+                batch_bytes = 0
+        if batch:
+            futures.append(pool.submit(_restore_batch, store, cache, batch, fds))
+        for future in futures:
+            failed.update(future.result())
+    finally:
+        for fd in fds:
+            os.close(fd)
+    restored = sum(size for i, size in enumerate(sizes) if i not in failed)
+    return restored, [names[i] for i in sorted(failed)]
+
+def restore_files(patterns, output_dir=RESTORE_DIR, jobs=JOBS, cache=None):
+    """Restore every stored file matching names or glob patterns into output_dir.
+
+    Instead of reading each file's chunks in manifest order, the chunks of
+    up to MAX_OPEN_FILES files are located first and read once each in the
+    order they lie in storage. A thread pool reads runs of them and writes
+    every chunk to each place it occurs with pwrite at precomputed offsets.
+    Returns the number of files that could not be restored.
+    """
+    store = chunkstore.open_chunk_store(storeconfig.load_store_config(), STORAGE_DIR)
+    meta = metastore.open_metastore(store, METADATA_DB)
+    if cache is None:
+        cache = chunkcache.ChunkCache()
+    failures = 0
+
+    try:
+        names = []
+        for name in match_files(meta, patterns):
+            try:
+                output_path(output_dir, name)
+                names.append(name)
+            except ValueError as e:
+                print(f"Error: {e}")
+                failures += 1
+        print(f"Restoring {len(names)} files into '{output_dir}' with {jobs} threads...")
+
+        start = time.time()
+        restored = 0
+        done = 0
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="restore") as pool:
+            for i in range(0, len(names), MAX_OPEN_FILES):
+                group = names[i:i + MAX_OPEN_FILES]
+                size, failed = _restore_group(store, meta, group, output_dir, pool, cache)
+                restored += size
+                done += len(group) - len(failed)
+                for name in failed:
+                    print(f"Critical Error: Chunks of '{name}' are missing! Restore failed.")
+                    os.remove(output_path(output_dir, name))
+                failures += len(failed)
+
+        elapsed = time.time() - start
+        print(f"Restored {done} files ({restored / (1024 * 1024):.1f} MB) in {elapsed:.2f}s"
+              f" - {restored / (1024 * 1024) / elapsed if elapsed else 0:.1f} MB/s,"
+              f" {failures} failed.")
+    except OSError as e:
+        print(f"Error writing restored files: {e}")
+        failures += 1
+    finally:
+        meta.close()
+        store.close()
+    return failures
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python reconstruct.py <filename>")
+    parser = argparse.ArgumentParser(description="Rebuild stored files from their chunks.")
+    parser.add_argument("names", nargs="+", metavar="name",
+                        help="name of a stored file, or a glob pattern such as 'logs/*'")
+    parser.add_argument("--output-dir",
+                        help=f"restore into this directory (default '{RESTORE_DIR}' for several files)")
+    parser.add_argument("--jobs", type=int, default=JOBS, help="threads for bulk restore")
+    parser.add_argument("--cache-size", type=int, default=chunkcache.CACHE_SIZE // (1024 * 1024),
+                        help="chunk cache budget in MB")
+    parser.add_argument("--version", type=int, help="version to restore, the latest by default")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    cache = chunkcache.ChunkCache(args.cache_size * 1024 * 1024)
+    single = len(args.names) == 1 and not any(c in args.names[0] for c in "*?[")
+    if single and args.output_dir is None:
+        reconstruct_file(args.names[0], cache, args.version)
     else:
-        reconstruct_file(sys.argv[1])
+        if args.version is not None:
+            parser.error("--version needs a single file name and no --output-dir")
+        if restore_files(args.names, args.output_dir or RESTORE_DIR, args.jobs, cache):
+            sys.exit(1)
@@ -0,0 +1,168 @@
+import os
+import zlib
+import struct
+import hashlib
+import threading
+
+import chunker
+import compression
+
+# Configuration
+SIMILARITY_FILE = ".similarity"  # Super-feature index, kept in the storage directory
+ANCHOR_BITS = 6  # Sub-blocks end where this many gear hash bits are zero (~64 bytes)
+MIN_SUBBLOCK = 32
+MIN_SUBBLOCKS = 8  # Chunks with fewer sub-blocks are too small to sketch
+FEATURES = 12
+SUPER_FEATURES = 3  # Each groups FEATURES // SUPER_FEATURES features
+MAX_DELTA_DEPTH = 3  # Bases a read may have to decode before the chunk itself
+MAX_DELTA_RATIO = 0.5  # Keep a delta only if it is at most half the chunk
+
+# Super-features, digest, delta depth of the chunk
+RECORD = struct.Struct(f"<{SUPER_FEATURES}Q32sB")
+
+def sketch(data):
+    """Return the super-features of a chunk, or None if it is too small.
+
+    The chunk is cut into content-defined sub-blocks with the chunker's
+    gear hash, so an edit only changes the sub-blocks it touches. Each
+    sub-block hash lands in one of FEATURES buckets and a feature is the
+    largest hash in its bucket. Groups of features are hashed into
+    super-features: two chunks sharing a super-feature very likely share
+    most of their content. A super-feature of an all-empty group is 0.
+    """
+    gear_map, = chunker.gear_maps(data, (chunker.spread_mask(ANCHOR_BITS),))
+    features = [0] * FEATURES
+    blocks = 0
+    start = 0
+    while start < len(data):
+        pos = chunker.find_match(gear_map, start + MIN_SUBBLOCK, len(data))
+        end = pos + 1 if pos != -1 else len(data)
+        h = zlib.crc32(data[start:end])
+        bucket = h % FEATURES
+        features[bucket] = max(features[bucket], h // FEATURES + 1)
+        blocks += 1
+        start = end
+    if blocks < MIN_SUBBLOCKS:
+        return None
+
+    group = FEATURES // SUPER_FEATURES
+    supers = []
+    for i in range(0, FEATURES, group):
+        values = features[i:i + group]
+        if any(values):
+            digest = hashlib.blake2b(struct.pack(f"<{group}I", *values), digest_size=8).digest()
+            supers.append(int.from_bytes(digest, 'little') or 1)
+        else:
+            supers.append(0)
+    return tuple(supers)
+
+class SimilarityIndex:
+    """Map from super-features to the stored chunks that have them.
+
+    Every sketched chunk appends one record to a log file, which is loaded
+    into one dict per super-feature. A later chunk replaces an earlier one
+    with the same super-feature, so new versions of a file delta against
+    the most recent version. Records appended by other processes are
+    picked up on the next lookup.
+
+    Entries are hints: a chunk may have been garbage collected since it
+    was indexed, and callers must cope with a base they cannot read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tables = [{} for _ in range(SUPER_FEATURES)]
+        self._pos = 0
+        self._lock = threading.Lock()
+        self._log = open(path, 'ab', buffering=0)
+        size = os.path.getsize(path)
+        if size % RECORD.size:
+            # Drop a torn trailing record so new appends stay aligned
+            self._log.truncate(size - size % RECORD.size)
+        self._load()
+
+    def _load(self):
+        """Read records appended since the last load."""
+        size = os.path.getsize(self.path)
+        if size < self._pos + RECORD.size:
+            return
+        with self._lock:
+            with open(self.path, 'rb') as f:
+                f.seek(self._pos)
+                data = f.read(size - self._pos)
+            # A partial record is still being written by another process
+            usable = len(data) - len(data) % RECORD.size
+            for record in RECORD.iter_unpack(data[:usable]):
+                self._insert(record[:SUPER_FEATURES], record[SUPER_FEATURES],
+                             record[SUPER_FEATURES + 1])
+            self._pos += usable
+
+    def _insert(self, supers, digest, depth):
+        for table, feature in zip(self._tables, supers):
+            if feature:
+                table[feature] = (digest, depth)
+
+    def add(self, supers, digest, depth):
+        """Index a stored chunk by its super-features."""
+        self._log.write(RECORD.pack(*supers, digest, depth))
+        with self._lock:
+            self._insert(supers, digest, depth)
+
+    def find(self, supers, max_depth=MAX_DELTA_DEPTH):
+        """Return (digest, depth) of the chunk sharing the most super-features.
+
+        Only chunks shallower than max_depth are considered, so a delta
+        against the result stays within the depth cap. Returns None if no
+        chunk qualifies.
+        """
+        self._load()
+        votes = {}
+        for table, feature in zip(self._tables, supers):
+            match = table.get(feature) if feature else None
+            if match is not None and match[1] < max_depth:
+                votes[match] = votes.get(match, 0) + 1
+        if not votes:
+            return None
+        return max(votes, key=votes.get)
+
+    def close(self):
+        self._log.close()
+
+def _depends_on(store, base_digest, digest):
+    """Return whether a chunk's delta chain passes through digest."""
+    while base_digest is not None:
+        if base_digest == digest:
+            return True
+        base_digest = store.base_of(base_digest.hex())
+    return False
+
+def encode_delta(store, data, max_depth=MAX_DELTA_DEPTH, chunk_hash=None):
+    """Try to store a new chunk as a delta against a similar stored chunk.
+
+    Returns (super-features, depth, payload). payload is None when no
+    similar chunk gives a delta of at most MAX_DELTA_RATIO of the chunk,
+    in which case the chunk is stored whole at depth 0. super-features is
+    None for chunks too small to sketch. Given the chunk's own digest, a
+    base whose chain runs through it is refused: that happens when a
+    collected chunk is stored again while a delta against its old copy
+    survives, and encoding against it would make a cycle no read resolves.
+    """
+    supers = sketch(data)
+    if supers is None:
+        return None, 0, None
+    match = store.similarity.find(supers, max_depth)
+    if match is None:
+        return supers, 0, None
+    base_digest, base_depth = match
+    if chunk_hash is not None and _depends_on(store, base_digest, bytes.fromhex(chunk_hash)):
+        return supers, 0, None
+    base = store.get(base_digest.hex())
+    if base is None:
+        return supers, 0, None  # Collected since it was indexed
+    payload = compression.encode_delta(data, base, base_digest, base_depth + 1)
+    if len(payload) > len(data) * MAX_DELTA_RATIO:
+        return supers, 0, None
+    return supers, base_depth + 1, payload
+
+def open_similarity_index(root):
+    return SimilarityIndex(os.path.join(root, SIMILARITY_FILE))
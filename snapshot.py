@@ -0,0 +1,232 @@
+import json
+import time
+import socket
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+# Configuration
+STATS_TTL = 5  # Seconds a stats snapshot is served before it is rebuilt
+PAGE_CACHE = 64  # File list pages kept until the file list changes
+PAGE_SIZE = 100  # Files per page when the client does not ask for a size
+MAX_PAGE_SIZE = 1000
+CHANGE_LOG = 1024  # File list changes remembered for event subscribers
+COALESCE = 0.1  # Seconds to gather changes before pushing them
+KEEPALIVE = 15  # Seconds between comments that keep idle event streams open
+MAX_SUBSCRIBERS = 256
+SEND_TIMEOUT = 5  # Seconds a subscriber may block a push before it is dropped
+
+# Stats that change whenever the file list does
+FILE_LIST_KEYS = ("file_count", "version_count", "logical")
+
+def etag(body):
+    """Return a strong ETag for a response body."""
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+def etag_matches(header, tag):
+    """Return whether an If-None-Match header lists tag."""
+    if not header:
+        return False
+    return any(candidate.strip() in ("*", tag, "W/" + tag) for candidate in header.split(","))
+
+class Snapshot:
+    """Cached JSON renderings of the storage stats and the file list.
+
+    Rendering the stats or a page of the file list queries the metadata
+    database, and the shard stats look at every volume, so each rendering is
+    kept with its ETag and shared by all clients. invalidate() drops them
+    after this process changes the file list. Stats are also rebuilt every
+    ttl seconds, which picks up the garbage collector, the chunk cache and
+    ingests by other processes. When the file and version counters moved
+    without an invalidate(), the cached pages are dropped too.
+
+    Every change bumps generation. Subscribers wait for it to move and read
+    what changed with changes_since().
+    """
+
+    def __init__(self, build_stats, list_files, ttl=STATS_TTL, pages=PAGE_CACHE):
+        self.build_stats = build_stats
+        self.list_files = list_files
+        self.ttl = ttl
+        self.pages = pages
+        self.generation = 0
+        self._stats = None  # (body, etag, time built)
+        self._counts = None  # FILE_LIST_KEYS of the cached stats
+        self._pages = OrderedDict()
+        self._changes = deque(maxlen=CHANGE_LOG)  # (generation, change)
+        self._cond = threading.Condition()
+
+    def invalidate(self, change=None):
+        """Drop the cached renderings after the file list changed.
+
+        change describes it for event subscribers, such as
+        {"op": "add", "name": name, "version": 2}. Without one, subscribers
+        are told to reload the list.
+        """
+        with self._cond:
+            self._stats = None
+            self._counts = None
+            self._bump(change or {"op": "reset"})
+
+    def _bump(self, change):
+        self._pages.clear()
+        self.generation += 1
+        self._changes.append((self.generation, change))
+        self._cond.notify_all()
+
+    def _refresh(self):
+        if self._stats is not None and time.monotonic() - self._stats[2] < self.ttl:
+            return
+        stats = self.build_stats()
+        counts = tuple(stats[key] for key in FILE_LIST_KEYS)
+        if self._counts is not None and counts != self._counts:
+            self._bump({"op": "reset"})  # Changed by another process
+        self._counts = counts
+        body = json.dumps(stats).encode()
+        self._stats = (body, etag(body), time.monotonic())
+
+    def stats(self):
+        """Return (body, etag) of the current stats."""
+        with self._cond:
+            self._refresh()
+            return self._stats[:2]
+
+    def files(self, offset=0, limit=None, sort="name", descending=False):
+        """Return (body, etag) of a page of the file list.
+
+        Without a limit the body is the whole list, as the file list API
+        returned it before it was paginated. Otherwise it is an object with
+        the page's files and the total number of files.
+        """
+        key = (offset, limit, sort, descending)
+        with self._cond:
+            self._refresh()
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+                return page
+            files = [{"name": name, "size": size, "chunks": chunks, "version": version}
+                     for name, size, chunks, version in self.list_files(
+                         offset, -1 if limit is None else limit, sort, descending)]
+            if limit is not None:
+                files = {"total": self._counts[0], "offset": offset, "limit": limit,
+                         "sort": sort, "order": "desc" if descending else "asc",
+                         "files": files}
+            body = json.dumps(files).encode()
+            page = self._pages[key] = (body, etag(body))
+            while len(self._pages) > self.pages:
+                self._pages.popitem(last=False)
+            return page
+
+    def wait(self, generation, timeout):
+        """Wait until generation moves on or timeout passes. Returns the current one."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.generation != generation, timeout)
+            return self.generation
+
+    def changes_since(self, generation):
+        """Return the changes after generation, or a reset if some were forgotten."""
+        with self._cond:
+            if self.generation == generation:
+                return []
+            if not self._changes or self._changes[0][0] > generation + 1:
+                return [{"op": "reset"}]
+            return [change for g, change in self._changes if g > generation]
+
+def _event(name, data):
+    return f"event: {name}\ndata: {data}\n\n".encode()
+
+class EventStream(threading.Thread):
+    """Pushes stats and file list changes to dashboards as Server-Sent Events.
+
+    Subscribers are connections whose response headers were sent. One
+    thread writes to all of them, so an open dashboard does not hold a
+    request worker. It wakes when the snapshot changes, or every ttl
+    seconds to push stats that moved on their own. A "files" event carries
+    the list of changes, and a "stats" event the stats body whenever its
+    ETag differs from the last one pushed. A subscriber that cannot take a
+    push within SEND_TIMEOUT is dropped and reconnects by itself.
+    """
+
+    def __init__(self, snapshot, max_subscribers=MAX_SUBSCRIBERS):
+        super().__init__(daemon=True, name="events")
+        self.snapshot = snapshot
+        self.max_subscribers = max_subscribers
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def full(self):
+        with self._lock:
+            return len(self._subscribers) >= self.max_subscribers
+
+    def count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def subscribe(self, sock):
+        """Take over a connection, sending it the current stats first."""
+        body, _ = self.snapshot.stats()
+        sock.settimeout(SEND_TIMEOUT)
+        try:
+            sock.sendall(b"retry: 5000\n\n" + _event("stats", body.decode()))
+        except OSError:
+            _close(sock)
+            return
+        with self._lock:
+            self._subscribers.append(sock)
+
+    def run(self):
+        generation = self.snapshot.generation
+        sent_tag = None
+        last_push = time.monotonic()
+        while not self._stopped.is_set():
+            if self.snapshot.wait(generation, self.snapshot.ttl) != generation:
+                time.sleep(COALESCE)  # Let a burst of ingests land in one push
+            changes = self.snapshot.changes_since(generation)
+            generation = self.snapshot.generation
+            if not self.count():
+                sent_tag = None
+                continue
+            messages = []
+            if changes:
+                messages.append(_event("files", json.dumps(changes)))
+            body, tag = self.snapshot.stats()
+            if tag != sent_tag:
+                messages.append(_event("stats", body.decode()))
+                sent_tag = tag
+            if not messages and time.monotonic() - last_push >= KEEPALIVE:
+                messages.append(b": keepalive\n\n")
+            if messages:
+                self._push(b"".join(messages))
+                last_push = time.monotonic()
+
+    def _push(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        dropped = []
+        for sock in subscribers:
+            try:
+                sock.sendall(message)
+            except OSError:
+                dropped.append(sock)
+        if dropped:
+            with self._lock:
+                self._subscribers = [s for s in self._subscribers if s not in dropped]
+            for sock in dropped:
+                _close(sock)
+
+    def stop(self):
+        """Stop pushing and close every subscriber."""
+        self._stopped.set()
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+        for sock in subscribers:
+            _close(sock)
+
+def _close(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
@@ -0,0 +1,100 @@
+import os
+import json
+import argparse
+
+import chunker
+import chunkstore
+import compression
+import ingest
+import journal
+
+# Configuration
+STORE_CONFIG_FILE = "store.json"
+
+def default_config():
+    """Return the settings used when a store has no config file yet."""
+    config = chunker.default_settings()
+    # Existing per-file storage directories keep working as legacy stores
+    config["backend"] = chunkstore.detect_backend() or "pack"
+    config["segment_size"] = chunkstore.SEGMENT_SIZE
+    config["fingerprint"] = "sha256"
+    config["compression"] = "none"
+    config["compression_level"] = None
+    config["delta"] = False
+    config["shards"] = []  # Storage roots to spread chunks over; none keeps one root
+    config["replicas"] = 1
+    config["durability"] = "normal"  # See journal.DURABILITY
+    return config
+
+def load_store_config():
+    """Load the store settings, filling in defaults for missing keys."""
+    config = default_config()
+    if os.path.exists(STORE_CONFIG_FILE):
+        try:
+            with open(STORE_CONFIG_FILE, 'r') as f:
+                config.update(json.load(f))
+        except (json.JSONDecodeError, IOError):
+            pass
+    return config
+
+def save_store_config(config):
+    """Save the store settings to the config file."""
+    with open(STORE_CONFIG_FILE, 'w') as f:
+        json.dump(config, f, indent=4)
+
+def add_store_arguments(parser):
+    """Register the store configuration options on an argparse parser."""
+    parser.add_argument("--backend", choices=chunkstore.BACKENDS,
+                        help="chunk storage backend for a new store (saved in store.json)")
+    parser.add_argument("--fingerprint", choices=sorted(ingest.FINGERPRINTS),
+                        help="chunk fingerprint algorithm for this store (saved in store.json)")
+    parser.add_argument("--chunker", choices=chunker.CHUNKERS,
+                        help="chunking strategy for this store (saved in store.json)")
+    parser.add_argument("--min-size", type=int, help="minimum chunk size for fastcdc")
+    parser.add_argument("--avg-size", type=int, help="average chunk size for fastcdc")
+    parser.add_argument("--max-size", type=int, help="maximum chunk size for fastcdc")
+    parser.add_argument("--compression", choices=compression.CHOICES,
+                        help="codec for newly stored chunks (saved in store.json)")
+    parser.add_argument("--compression-level", type=int,
+                        help="compression level for newly stored chunks")
+    parser.add_argument("--delta", action=argparse.BooleanOptionalAction,
+                        help="store new chunks as deltas against similar stored chunks "
+                             "(saved in store.json)")
+    parser.add_argument("--durability", choices=journal.DURABILITY,
+                        help="how much is synced to disk before an ingest is recorded "
+                             "(saved in store.json)")
+
+def apply_store_arguments(args):
+    """Merge store options from the command line into the store config."""
+    config = load_store_config()
+    current = chunkstore.detect_backend(shards=config["shards"])
+    if args.backend and current and args.backend != current:
+        message = f"Store already uses the '{current}' backend."
+        if current == "file":
+            message += " Run 'python chunkstore.py migrate' to convert it."
+        raise ValueError(message)
+    if args.fingerprint and current and args.fingerprint != config["fingerprint"]:
+        raise ValueError(f"Store already uses the '{config['fingerprint']}' fingerprint; "
+                         "it can only be chosen when the store is created.")
+    overrides = {
+        "backend": args.backend,
+        "fingerprint": args.fingerprint,
+        "chunker": args.chunker,
+        "min_size": args.min_size,
+        "avg_size": args.avg_size,
+        "max_size": args.max_size,
+        "compression": args.compression,
+        "compression_level": args.compression_level,
+        "delta": args.delta,
+        "durability": args.durability,
+    }
+    overrides = {k: v for k, v in overrides.items() if v is not None}
+    if args.compression and args.compression_level is None:
+        overrides["compression_level"] = None  # Each codec has its own default level
+    if overrides:
+        config.update(overrides)
+        # Validate before persisting
+        chunker.get_chunker(config)
+        compression.codec_level(config["compression"], config["compression_level"])
+        save_store_config(config)
+    return config
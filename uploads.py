@@ -0,0 +1,192 @@
+import time
+import secrets
+import threading
+
+import ingest
+import metastore
+import metrics
+
+# Configuration
+SESSION_TIMEOUT = 3600  # Seconds an unfinished upload is kept
+MAX_CHUNK_SIZE = 16 * 1024 * 1024  # Largest chunk accepted from a client
+BATCH_SIZE = ingest.BATCH_SIZE  # Bytes of received chunks stored at a time
+
+class UploadError(ValueError):
+    pass
+
+class IncompleteUpload(UploadError):
+    """Raised on commit while the store still lacks some of the file's chunks."""
+
+    def __init__(self, missing):
+        super().__init__(f"{len(missing)} chunks are missing")
+        self.missing = missing
+
+class UploadSession:
+    def __init__(self, name, chunks, missing):
+        self.id = secrets.token_hex(16)
+        self.name = name
+        self.chunks = chunks
+        self.sizes = dict(chunks)
+        self.missing = set(missing)
+        self.stored = []  # (hex digest, length) of chunks this upload wrote
+        self.new_chunks = 0
+        self.new_bytes = 0
+        self.new_raw_bytes = 0
+        self.touched = time.time()
+        self.lock = threading.Lock()
+
+class UploadManager:
+    """Negotiated uploads, where clients send only the chunks the store lacks.
+
+    A client chunks and fingerprints the file itself with the store's
+    settings, then:
+    1. begin() takes the file's manifest and returns the digests the store
+       does not have.
+    2. receive() takes batches of those chunks, checks every digest and
+       stores them.
+    3. commit() records the file through the group committer once every
+       chunk is present, which also makes the received chunks durable.
+
+    Sessions live in memory. Chunks of a session that is aborted or expires
+    are recorded without references, so the garbage collector reclaims them.
+    """
+
+    def __init__(self, meta, store, committer, timeout=SESSION_TIMEOUT):
+        self.meta = meta
+        self.store = store
+        self.committer = committer
+        self.timeout = timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def begin(self, name, manifest):
+        """Start an upload from a manifest blob. Returns the session."""
+        self.expire()
+        if not name:
+            raise UploadError("Missing file name")
+        if len(manifest) % metastore.MANIFEST_ENTRY.size:
+            raise UploadError("Manifest is truncated")
+        chunks = metastore.unpack_manifest(manifest)
+        missing = [chunk_hash for chunk_hash in dict.fromkeys(h for h, _ in chunks)
+                   if not self.store.has(chunk_hash)]
+        session = UploadSession(name, chunks, missing)
+        with self._lock:
+            self._sessions[session.id] = session
+        return session
+
+    def _get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        session.touched = time.time()
+        return session
+
+    def receive(self, session_id, stream, length, config):
+        """Store a batch of chunks read from a stream. Returns the chunks accepted.
+
+        The batch is a sequence of manifest entries, each followed by the
+        chunk bytes. Only chunks of the session's manifest are accepted, and
+        each must match its digest under the store's fingerprint.
+        """
+        session = self._get(session_id)
+        fingerprint = ingest.get_fingerprint(config.get("fingerprint", "sha256"))
+        header_size = metastore.MANIFEST_ENTRY.size
+        pending = []
+        pending_bytes = 0
+        accepted = 0
+        while length > 0:
+            if length < header_size:
+                raise UploadError("Upload body ended early")
+            header = _read_exactly(stream, header_size)
+            digest, size = metastore.MANIFEST_ENTRY.unpack(header)
+            chunk_hash = digest.hex()
+            length -= header_size
+            if session.sizes.get(chunk_hash) != size:
+                raise UploadError(f"Chunk {chunk_hash} is not part of this upload")
+            if size > min(length, MAX_CHUNK_SIZE):
+                raise UploadError(f"Chunk {chunk_hash} is truncated or too large")
+            data = _read_exactly(stream, size)
+            length -= size
+            if fingerprint(data) != chunk_hash:
+                raise UploadError(f"Chunk {chunk_hash} does not match its digest")
+            pending.append((chunk_hash, data))
+            pending_bytes += size
+            accepted += 1
+            if pending_bytes >= BATCH_SIZE:
+                self._store(session, pending, config)
+                pending = []
+                pending_bytes = 0
+        if pending:
+            self._store(session, pending, config)
+        return accepted
+
+    def _store(self, session, chunks, config):
+        new_chunks, new_bytes, new_raw_bytes = ingest.store_chunks(chunks, config, self.store)
+        with session.lock:
+            session.new_chunks += new_chunks
+            session.new_bytes += new_bytes
+            session.new_raw_bytes += new_raw_bytes
+            session.stored.extend((h, len(data)) for h, data in chunks)
+            session.missing.difference_update(h for h, _ in chunks)
+
+    def commit(self, session_id):
+        """Record the uploaded file. Returns its version, or None if unchanged.
+
+        Raises IncompleteUpload, keeping the session open, if chunks are
+        still missing. That includes chunks the garbage collector removed
+        after begin() found them.
+        """
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            raise KeyError(session_id)
+        missing = [chunk_hash for chunk_hash in session.sizes
+                   if not self.store.has(chunk_hash) and not self.store.verify(chunk_hash)]
+        try:
+            if not missing:
+                version = self.committer.add_file(session.name, session.chunks,
+                                                  session.new_chunks, session.new_bytes,
+                                                  session.new_raw_bytes)
+                metrics.count("dedup_ingested_bytes_total", sum(size for _, size in session.chunks))
+                metrics.count("dedup_chunks_total", session.new_chunks, kind="new")
+                metrics.count("dedup_chunks_total", len(session.chunks) - session.new_chunks,
+                              kind="duplicate")
+                return version
+        except metastore.MissingChunkError:
+            missing = [chunk_hash for chunk_hash in session.sizes
+                       if not self.store.verify(chunk_hash)]
+        session.missing = set(missing)
+        session.touched = time.time()
+        with self._lock:
+            self._sessions[session.id] = session
+        raise IncompleteUpload(missing)
+
+    def abort(self, session_id):
+        """Drop an upload, leaving the chunks it stored to the garbage collector."""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            raise KeyError(session_id)
+        self._release(session)
+
+    def _release(self, session):
+        if session.stored or session.new_chunks:
+            self.meta.add_chunks(session.stored, session.new_chunks, session.new_bytes,
+                                 session.new_raw_bytes, self.store)
+
+    def expire(self):
+        """Abort sessions idle for longer than the timeout."""
+        cutoff = time.time() - self.timeout
+        with self._lock:
+            expired = [s for s in self._sessions.values() if s.touched < cutoff]
+            for session in expired:
+                del self._sessions[session.id]
+        for session in expired:
+            self._release(session)
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise UploadError("Upload body ended early")
+    return data